@@ -0,0 +1,59 @@
+from django.core.cache import cache
+from .caching import cache_timeout
+from .models import Address, address_hash
+
+
+DEFAULT_ADDRESSES_KEY = 'default-addresses:{}'
+DEFAULT_ADDRESSES_TIMEOUT = 60 * 60
+
+
+def get_default_addresses(user):
+    # every default of the user in one query, keyed by address_type
+    key = DEFAULT_ADDRESSES_KEY.format(user.pk)
+    defaults = cache.get(key)
+    if defaults is None:
+        defaults = {}
+        addresses = Address.objects.filter(
+            user=user, default=True).order_by('pk')
+        for address in addresses:
+            defaults.setdefault(address.address_type, address)
+        cache.set(key, defaults, cache_timeout(DEFAULT_ADDRESSES_TIMEOUT))
+    return defaults
+
+
+def get_default_address(user, address_type):
+    return get_default_addresses(user).get(address_type)
+
+
+def invalidate_default_addresses(user_id):
+    cache.delete(DEFAULT_ADDRESSES_KEY.format(user_id))
+
+
+def resolve_address(user, address_type, address, secondary_addrs, division,
+                    country, zip_code, default=False):
+    # reuse the user's identical address row instead of inserting a copy;
+    # get_or_create retries the lookup when a concurrent checkout wins the
+    # insert on core_address_unique_content
+    content_hash = address_hash(
+        address, secondary_addrs, division, country, zip_code)
+    resolved, _ = Address.objects.get_or_create(
+        user=user, address_type=address_type, content_hash=content_hash,
+        defaults={
+            'address': address,
+            'secondary_addrs': secondary_addrs,
+            'division': division,
+            'country': country,
+            'zip_code': zip_code,
+            'default': default,
+        })
+    if default and not resolved.default:
+        Address.objects.filter(pk=resolved.pk).update(default=True)
+        resolved.default = True
+
+    if default:
+        Address.objects.filter(
+            user=user, address_type=address_type, default=True).exclude(
+                pk=resolved.pk).update(default=False)
+        # .update() skips the post_save handler
+        invalidate_default_addresses(user.pk)
+    return resolved
@@ -1,14 +1,23 @@
 from django.contrib import admin
-from .models import Item, OrderItem, Order, Payment, Cupon, Refund, Address
+from .models import (Item, OrderItem, Order, Payment, Cupon, Refund, Address,
+                     PaymentJob)
+from .refunds import grant_refunds
 
 
 def make_refund_accepted(modeladmin, request, queryset):
-    queryset.update(refund_requested=False, refund_granted=True)
+    grant_refunds(queryset.values_list('pk', flat=True))
 
 
 make_refund_accepted.short_description = 'Update orders to make refund granted'
 
 
+def accept_refunds(modeladmin, request, queryset):
+    grant_refunds(queryset.values_list('order_id', flat=True).distinct())
+
+
+accept_refunds.short_description = 'Accept refunds and mark their orders granted'
+
+
 class OrderAdmin(admin.ModelAdmin):
     list_display = [
         'user',
@@ -68,10 +77,53 @@ class AddressAdmin(admin.ModelAdmin):
     ]
 
 
+class CuponAdmin(admin.ModelAdmin):
+    list_display = [
+        'cupon',
+        'amount',
+        'valid_from',
+        'valid_until',
+        'max_uses',
+        'times_used'
+    ]
+    search_fields = ['cupon']
+
+
+class RefundAdmin(admin.ModelAdmin):
+    list_display = [
+        'order',
+        'email',
+        'accepted'
+    ]
+    list_filter = [
+        'accepted'
+    ]
+    search_fields = ['order__ref_code', 'email']
+    actions = [accept_refunds]
+
+
+class PaymentJobAdmin(admin.ModelAdmin):
+    list_display = [
+        'order',
+        'user',
+        'amount',
+        'status',
+        'attempts',
+        'error',
+        'created',
+        'updated'
+    ]
+    list_filter = [
+        'status'
+    ]
+    exclude = ['token']
+
+
 admin.site.register(Item)
 admin.site.register(OrderItem)
 admin.site.register(Order, OrderAdmin)
 admin.site.register(Payment)
-admin.site.register(Cupon)
-admin.site.register(Refund)
+admin.site.register(Cupon, CuponAdmin)
+admin.site.register(Refund, RefundAdmin)
 admin.site.register(Address, AddressAdmin)
+admin.site.register(PaymentJob, PaymentJobAdmin)
@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class CoreConfig(AppConfig):
     name = 'core'
+
+    def ready(self):
+        from . import signals
+        from .catalog import get_stats
+        from .timing import register_counters
+        register_counters('catalog_cache', get_stats)
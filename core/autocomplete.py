@@ -0,0 +1,142 @@
+import re
+import threading
+from bisect import bisect_left, insort
+
+from django.db import connection
+from .catalog import get_catalog_version, get_catalog_changes
+from .models import Item
+
+
+AUTOCOMPLETE_LIMIT = 8
+MAX_KEY_LENGTH = 32
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def normalize(text):
+    return ' '.join(WORD_RE.findall(text.casefold()))
+
+
+def title_keys(title):
+    # one key per word start, so "denim" also finds "Blue denim shirt"
+    title = normalize(title)
+    starts = [0] + [i + 1 for i, char in enumerate(title) if char == ' ']
+    return {title[start:start + MAX_KEY_LENGTH] for start in starts}
+
+
+class PrefixIndex:
+    # sorted (key, pk) pairs searched with bisect; swapped wholesale on
+    # refresh so lookups in other threads never see a half-applied change
+
+    def __init__(self):
+        self.entries = []
+        self.items = {}
+        self.version = None
+        self.lock = threading.Lock()
+        self.rebuilding = False
+
+    def load(self):
+        items = {}
+        entries = []
+        rows = Item.objects.values_list('pk', 'title', 'slug')
+        for pk, title, slug in rows.iterator(chunk_size=2000):
+            items[pk] = (title, slug)
+            entries.extend((key, pk) for key in title_keys(title))
+        entries.sort()
+        return entries, items
+
+    def build(self, version):
+        # with self.lock held
+        entries, items = self.load()
+        self.entries, self.items, self.version = entries, items, version
+
+    def apply_changes(self, pks, version):
+        entries, items = list(self.entries), dict(self.items)
+        for pk in pks:
+            if pk not in items:
+                continue
+            title, slug = items.pop(pk)
+            for key in title_keys(title):
+                position = bisect_left(entries, (key, pk))
+                if position < len(entries) and entries[position] == (key, pk):
+                    del entries[position]
+
+        rows = Item.objects.filter(pk__in=pks).values_list(
+            'pk', 'title', 'slug')
+        for pk, title, slug in rows:
+            items[pk] = (title, slug)
+            for key in title_keys(title):
+                insort(entries, (key, pk))
+        self.entries, self.items, self.version = entries, items, version
+
+    def refresh(self, wait=False):
+        version = get_catalog_version()
+        if version == self.version:
+            return
+        with self.lock:
+            if version == self.version:
+                return
+            if self.version is None:
+                self.build(version)
+                return
+            changes = get_catalog_changes(self.version, version)
+            if changes is not None:
+                self.apply_changes(changes, version)
+            elif wait:
+                self.build(version)
+            elif not self.rebuilding:
+                # a gap in the change log, usually the version key aging out
+                # of a per-process cache and being re-seeded; the lookups
+                # keep using the old index while it is rebuilt
+                self.rebuilding = True
+                self.start_rebuild(version)
+
+    def start_rebuild(self, version):
+        threading.Thread(target=self.rebuild, args=(version,),
+                         daemon=True).start()
+
+    def rebuild(self, version):
+        # the table scan runs outside the lock, so lookups and logged changes
+        # carry on meanwhile; if those moved the index past this version,
+        # the older result is thrown away
+        try:
+            entries, items = self.load()
+            with self.lock:
+                if self.version is None or self.version < version:
+                    self.entries, self.items, self.version = \
+                        entries, items, version
+        finally:
+            self.rebuilding = False
+            # the thread's own connection, opened by load()
+            connection.close()
+
+    def lookup(self, prefix, limit=AUTOCOMPLETE_LIMIT):
+        prefix = normalize(prefix)[:MAX_KEY_LENGTH]
+        if not prefix:
+            return []
+        self.refresh()
+        entries, items = self.entries, self.items
+        results = []
+        seen = set()
+        position = bisect_left(entries, (prefix,))
+        while position < len(entries) and len(results) < limit:
+            key, pk = entries[position]
+            if not key.startswith(prefix):
+                break
+            position += 1
+            if pk in seen or pk not in items:
+                continue
+            seen.add(pk)
+            title, slug = items[pk]
+            results.append({'title': title, 'slug': slug})
+        return results
+
+
+index = PrefixIndex()
+
+
+def autocomplete(prefix, limit=AUTOCOMPLETE_LIMIT):
+    return index.lookup(prefix, limit)
+
+
+def warm():
+    index.refresh(wait=True)
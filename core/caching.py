@@ -0,0 +1,60 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from .models import CacheVersion
+
+
+def cache_timeout(timeout):
+    # signals only invalidate the cache of the process they fire in, so
+    # without a shared backend every entry has to age out on its own within
+    # LOCAL_CACHE_TIMEOUT; version keys are then re-read from the database
+    if settings.CACHE_SHARED:
+        return timeout
+    if timeout is None:
+        return settings.LOCAL_CACHE_TIMEOUT
+    return min(timeout, settings.LOCAL_CACHE_TIMEOUT)
+
+
+def stored_version(key):
+    version = CacheVersion.objects.filter(name=key).values_list(
+        'version', flat=True).first()
+    if version is None:
+        # start from a timestamp so a reset database never revives entries
+        # a persistent cache still holds for an earlier run
+        try:
+            with transaction.atomic():
+                version = CacheVersion.objects.create(
+                    name=key, version=int(time.time() * 1000)).version
+        except IntegrityError:
+            version = CacheVersion.objects.get(name=key).version
+    return version
+
+
+def get_version(key):
+    version = cache.get(key)
+    if version is None:
+        version = stored_version(key)
+        cache.add(key, version, cache_timeout(None))
+    return version
+
+
+def bump_version(key):
+    cached = cache.get(key)
+    with transaction.atomic():
+        updated = CacheVersion.objects.filter(name=key).update(
+            version=F('version') + 1)
+        if not updated:
+            stored_version(key)
+            CacheVersion.objects.filter(name=key).update(
+                version=F('version') + 1)
+        version = CacheVersion.objects.get(name=key).version
+        if cached is not None and version <= cached:
+            # a bump that was rolled back still reached the cache, and so
+            # may entries built under its number; never hand that out again
+            version = cached + 1
+            CacheVersion.objects.filter(name=key).update(version=version)
+    cache.set(key, version, cache_timeout(None))
+    return version
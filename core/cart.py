@@ -0,0 +1,406 @@
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import (Case, Exists, ExpressionWrapper, F, FloatField,
+                              OuterRef, Subquery, Sum, Value, When)
+from django.db.models.functions import Coalesce, Least
+from django.utils import timezone
+from .caching import cache_timeout
+from .catalog import get_catalog_version
+from .models import PAYMENT_JOB_ACTIVE, Item, Order, OrderItem, PaymentJob
+
+
+CART_COUNT_KEY = 'cart-count:{}'
+CART_COUNT_TIMEOUT = 60 * 60
+SESSION_CART_KEY = 'cart'
+# catalog version the session cart was last checked for deleted items at
+SESSION_CART_CHECKED_KEY = 'cart-checked'
+# the user whose cart has been saved to the database, at checkout or login
+SESSION_CART_SAVED_KEY = 'cart-saved'
+# most of one item a cart line can hold
+CART_MAX_QUANTITY = 1000
+
+
+def get_cart_count(user):
+    if not user.is_authenticated:
+        return 0
+    # memoized on the user object, which lives exactly as long as the request
+    count = getattr(user, '_cart_count', None)
+    if count is not None:
+        return count
+
+    key = CART_COUNT_KEY.format(user.pk)
+    count = cache.get(key)
+    if count is None:
+        count = Order.items.through.objects.filter(
+            order__user=user, order__ordered=False).count()
+        cache.set(key, count, cache_timeout(CART_COUNT_TIMEOUT))
+    user._cart_count = count
+    return count
+
+
+def get_request_cart_count(request):
+    if cart_in_database(request):
+        return get_cart_count(request.user)
+    return SessionCart(request.session).count()
+
+
+def invalidate_cart_count(user):
+    cache.delete(CART_COUNT_KEY.format(user.pk))
+    if hasattr(user, '_cart_count'):
+        del user._cart_count
+
+
+def invalidate_cart_counts(user_ids):
+    cache.delete_many([CART_COUNT_KEY.format(pk) for pk in user_ids])
+
+
+class CartLocked(Exception):
+    message = ('Your payment is being processed. The cart can be changed '
+               'again once it has gone through.')
+
+
+def _add_to_open_order_totals(user, amount):
+    # every cart write starts here: the UPDATE row-locks the open order on
+    # Postgres (the write lock on SQLite) before any line is touched, so
+    # concurrent calls for one user always lock in the same order. A cart
+    # with a queued or running payment is left alone; a line added during
+    # the charge would be placed at the amount charged before it
+    paying = PaymentJob.objects.filter(
+        order=OuterRef('pk'), status__in=PAYMENT_JOB_ACTIVE)
+    touched = Order.objects.filter(user=user, ordered=False).filter(
+        ~Exists(paying)).update(
+        subtotal=F('subtotal') + amount, total=F('total') + amount)
+    if not touched and Order.objects.filter(
+            user=user, ordered=False).exists():
+        raise CartLocked()
+    return touched
+
+
+def open_lines(user):
+    # lines attached to the open order, never a line left detached by a
+    # deleted cart (see delete_open_lines in signals)
+    return OrderItem.objects.filter(
+        user=user, ordered=False, order__ordered=False)
+
+
+def _add_item(user, item, quantity, create):
+    # the common case, an item already in the cart, is two UPDATEs. A line
+    # stops at CART_MAX_QUANTITY, so the order is only charged for the
+    # units the line actually gains, priced inside the UPDATE as in
+    # remove_item
+    quantity = min(quantity, CART_MAX_QUANTITY)
+    line = open_lines(user).filter(item=item)
+    held = Coalesce(Subquery(line.values('quantity')[:1]), 0)
+    amount = ExpressionWrapper(
+        (Least(held + quantity, CART_MAX_QUANTITY) - held) * item.get_price(),
+        output_field=FloatField())
+    if _add_to_open_order_totals(user, amount):
+        updated = line.update(
+            quantity=Least(F('quantity') + quantity, CART_MAX_QUANTITY))
+        if updated:
+            return False
+        order = Order.objects.get(user=user, ordered=False)
+    elif not create:
+        return None
+    else:
+        amount = quantity * item.get_price()
+        order = Order.objects.create(
+            user=user, order_date=timezone.now(), subtotal=amount,
+            total=amount)
+    order_item = OrderItem.objects.create(
+        user=user, item=item, quantity=quantity)
+    order.items.add(order_item)
+    return True
+
+
+def add_item(user, item, quantity=1, create=True):
+    # the partial unique constraints on open carts turn a lost race into an
+    # IntegrityError; the retry then lands on the UPDATE path. Without
+    # create, None means there was no open order to add to
+    for attempt in range(2):
+        try:
+            with transaction.atomic():
+                created = _add_item(user, item, quantity, create)
+            break
+        except IntegrityError:
+            if attempt:
+                raise
+    if created:
+        invalidate_cart_count(user)
+    return created
+
+
+def remove_item(user, item):
+    # price the line inside the UPDATE so both statements are writes and
+    # the transaction never has to upgrade a read lock
+    line = open_lines(user).filter(item=item)
+    amount = ExpressionWrapper(
+        Coalesce(Subquery(line.values('quantity')[:1]), 0) * item.get_price(),
+        output_field=FloatField())
+    with transaction.atomic():
+        _add_to_open_order_totals(user, -amount)
+        deleted = line.delete()[1]
+    if not deleted.get(OrderItem._meta.label):
+        return False
+    invalidate_cart_count(user)
+    return True
+
+
+def remove_single_item(user, item):
+    # as in remove_item, the order is written first and only charged for
+    # a unit that is actually there
+    line = open_lines(user).filter(item=item)
+    amount = Case(When(Exists(line), then=Value(item.get_price())),
+                  default=Value(0.0), output_field=FloatField())
+    with transaction.atomic():
+        _add_to_open_order_totals(user, -amount)
+        updated = line.filter(quantity__gt=1).update(
+            quantity=F('quantity') - 1)
+        removed_line = False
+        if not updated:
+            deleted = line.delete()[1]
+            if not deleted.get(OrderItem._meta.label):
+                return False
+            removed_line = True
+    if removed_line:
+        invalidate_cart_count(user)
+    return True
+
+
+def apply_changes(user, items, deltas, create=True):
+    # apply {item pk: quantity delta} to the user's open order with bulk
+    # writes, a fixed number of queries however many lines change; False
+    # when there was no open order and create is off
+    deltas = {pk: delta for pk, delta in deltas.items()
+              if pk in items and delta}
+    if not deltas:
+        return True
+
+    with transaction.atomic():
+        # touching the open order first row-locks it on Postgres and takes
+        # the write lock on SQLite, so batches for one user serialize
+        touched = _add_to_open_order_totals(user, 0)
+        if touched:
+            order = Order.objects.get(user=user, ordered=False)
+        elif not create:
+            return False
+        elif any(delta > 0 for delta in deltas.values()):
+            order = Order.objects.create(user=user, order_date=timezone.now())
+        else:
+            return True
+
+        existing = {
+            order_item.item_id: order_item
+            for order_item in OrderItem.objects.filter(
+                order=order, item_id__in=list(deltas))
+        }
+        changed, removed, created = [], [], []
+        amount = 0
+        for pk, delta in deltas.items():
+            price = items[pk].get_price()
+            order_item = existing.get(pk)
+            if order_item is None:
+                if delta > 0:
+                    quantity = min(delta, CART_MAX_QUANTITY)
+                    created.append(OrderItem(
+                        user=user, item_id=pk, quantity=quantity))
+                    amount += quantity * price
+                continue
+            quantity = min(max(order_item.quantity + delta, 0),
+                           CART_MAX_QUANTITY)
+            amount += (quantity - order_item.quantity) * price
+            if quantity:
+                order_item.quantity = quantity
+                changed.append(order_item)
+            else:
+                removed.append(order_item.pk)
+
+        OrderItem.objects.bulk_update(changed, ['quantity'])
+        if removed:
+            OrderItem.objects.filter(pk__in=removed).delete()
+        if created:
+            OrderItem.objects.bulk_create(created)
+            new_ids = OrderItem.objects.filter(
+                user=user, ordered=False,
+                item_id__in=[order_item.item_id for order_item in created]
+            ).values_list('pk', flat=True)
+            Order.items.through.objects.bulk_create([
+                Order.items.through(order_id=order.pk, orderitem_id=pk)
+                for pk in new_ids
+            ])
+        order.add_to_subtotal(amount)
+
+    if created or removed:
+        invalidate_cart_count(user)
+    return True
+
+
+def reprice_open_carts(item):
+    # after a price change: one UPDATE re-sums every open cart holding the
+    # item from its lines, however many carts that is
+    return resum_orders(Order.objects.filter(ordered=False, items__item=item))
+
+
+def resum_orders(orders):
+    price = Case(When(item__discount_price__gt=0,
+                      then=F('item__discount_price')),
+                 default=F('item__price'), output_field=FloatField())
+    line_total = Sum(F('quantity') * price, output_field=FloatField())
+    lines = OrderItem.objects.filter(order=OuterRef('pk')).order_by().values(
+        'order').annotate(subtotal=line_total).values('subtotal')
+    subtotal = Coalesce(Subquery(lines, output_field=FloatField()),
+                        Value(0.0))
+    return orders.update(subtotal=subtotal, total=subtotal - F('discount'))
+
+
+def merge_items(user, quantities):
+    items = Item.objects.in_bulk(list(quantities))
+    apply_changes(user, items, {
+        pk: quantity for pk, quantity in quantities.items() if quantity > 0})
+
+
+def summarize(order, order_items):
+    lines = []
+    for order_item in order_items:
+        lines.append({
+            'slug': order_item.item.slug,
+            'title': order_item.item.title,
+            'quantity': order_item.quantity,
+            'price': order_item.item.price,
+            'line_total': order_item.get_final_price(),
+            'amount_saved': (order_item.get_amount_saved()
+                             if order_item.item.discount_price else 0),
+        })
+    return {
+        'lines': lines,
+        'count': len(lines),
+        'subtotal': order.subtotal,
+        'discount': order.discount,
+        'total': order.total,
+    }
+
+
+def get_summary(user):
+    order = Order.objects.filter(user=user, ordered=False).first()
+    if order is None:
+        return summarize(Order(), [])
+    return summarize(order, order.items.select_related('item'))
+
+
+class SessionCart:
+    # a cart of {item pk: quantity} kept in the session, for visitors and
+    # for logged-in users alike; it only reaches the database at checkout
+
+    def __init__(self, session):
+        self.session = session
+        self.lines = session.get(SESSION_CART_KEY, {})
+
+    def save(self):
+        self.session[SESSION_CART_KEY] = self.lines
+        self.session.modified = True
+
+    def count(self):
+        # items can be deleted while they sit in a session cart; they are
+        # dropped here, with a query only when the catalog has changed
+        # since the last check, so the badge matches get_order_items()
+        version = get_catalog_version()
+        if self.lines and \
+                self.session.get(SESSION_CART_CHECKED_KEY) != version:
+            existing = set(Item.objects.filter(
+                pk__in=list(self.quantities())).values_list('pk', flat=True))
+            self.lines = {key: quantity for key, quantity in self.lines.items()
+                          if int(key) in existing}
+            self.session[SESSION_CART_CHECKED_KEY] = version
+            self.save()
+        return len(self.lines)
+
+    def quantities(self):
+        return {int(pk): quantity for pk, quantity in self.lines.items()}
+
+    def add(self, item, quantity=1):
+        key = str(item.pk)
+        created = key not in self.lines
+        self.lines[key] = min(self.lines.get(key, 0) + quantity,
+                              CART_MAX_QUANTITY)
+        self.save()
+        return created
+
+    def remove(self, item):
+        if self.lines.pop(str(item.pk), None) is None:
+            return False
+        self.save()
+        return True
+
+    def remove_single(self, item):
+        key = str(item.pk)
+        if key not in self.lines:
+            return False
+        if self.lines[key] > 1:
+            self.lines[key] = min(self.lines[key] - 1, CART_MAX_QUANTITY)
+        else:
+            del self.lines[key]
+        self.save()
+        return True
+
+    def apply(self, deltas):
+        for pk, delta in deltas.items():
+            key = str(pk)
+            quantity = min(self.lines.get(key, 0) + delta, CART_MAX_QUANTITY)
+            if quantity > 0:
+                self.lines[key] = quantity
+            else:
+                self.lines.pop(key, None)
+        self.save()
+
+    def summary(self):
+        order_items = self.get_order_items()
+        return summarize(self.as_order(order_items), order_items)
+
+    def clear(self):
+        self.lines = {}
+        self.save()
+
+    def get_order_items(self):
+        # unsaved OrderItems, so templates can use the usual price helpers
+        quantities = self.quantities()
+        items = Item.objects.in_bulk(list(quantities))
+        return [OrderItem(item=items[pk], quantity=quantity)
+                for pk, quantity in quantities.items() if pk in items]
+
+    def as_order(self, order_items):
+        subtotal = sum(order_item.get_final_price()
+                       for order_item in order_items)
+        return Order(subtotal=subtotal, total=subtotal)
+
+
+def cart_in_database(request):
+    # carts are edited in the session until checkout saves them; from then
+    # on, until the order is placed, the open order is the cart
+    return request.user.is_authenticated and \
+        request.session.get(SESSION_CART_SAVED_KEY) == request.user.pk
+
+
+def save_session_cart(request, user):
+    # one bulk merge into the open order, which is created if need be
+    if request.session.get(SESSION_CART_SAVED_KEY) != user.pk:
+        request.session[SESSION_CART_SAVED_KEY] = user.pk
+    cart = SessionCart(request.session)
+    if cart.count():
+        try:
+            merge_items(user, cart.quantities())
+        except CartLocked:
+            # kept in the session until the payment has gone through
+            return
+        cart.clear()
+
+
+def forget_database_cart(request):
+    # the saved cart was placed or deleted; the next one starts in the session
+    request.session.pop(SESSION_CART_SAVED_KEY, None)
+
+
+def merge_session_cart(request, user):
+    # a cart that already reached the database stays there; any other cart
+    # stays in the session until checkout
+    if Order.objects.filter(user=user, ordered=False).exists():
+        save_session_cart(request, user)
@@ -0,0 +1,146 @@
+from collections import Counter
+
+from django.core.cache import cache
+from django.db.models import Max
+from django.utils import timezone
+from .caching import bump_version, cache_timeout, get_version
+from .models import Item, CATEGORY_CHOICES
+
+
+CATALOG_VERSION_KEY = 'catalog-version'
+CATALOG_CHANGE_KEY = 'catalog-change:{}'
+CATALOG_MODIFIED_KEY = 'catalog-modified'
+ITEM_KEY = 'item:{}'
+CATALOG_TIMEOUT = 60 * 60 * 24
+CATEGORY_PAGE_SIZE = 12
+
+stats = Counter()
+
+
+def get_catalog_version():
+    return get_version(CATALOG_VERSION_KEY)
+
+
+def get_catalog_last_modified():
+    modified = cache.get(CATALOG_MODIFIED_KEY)
+    if modified is None:
+        modified = Item.objects.aggregate(
+            Max('updated_at'))['updated_at__max'] or timezone.now()
+        cache.add(CATALOG_MODIFIED_KEY, modified, cache_timeout(None))
+    return modified
+
+
+def bump_catalog_version(changed_pk=None):
+    # deletes leave no updated_at behind, so track the change time here
+    cache.set(CATALOG_MODIFIED_KEY, timezone.now(), cache_timeout(None))
+    version = bump_version(CATALOG_VERSION_KEY)
+    if changed_pk is not None:
+        cache.set(CATALOG_CHANGE_KEY.format(version), changed_pk,
+                  cache_timeout(CATALOG_TIMEOUT))
+    return version
+
+
+def get_catalog_changes(since, until, limit=1000):
+    # item pks changed after version `since`, None if the log has a gap
+    if until - since > limit:
+        return None
+    keys = [CATALOG_CHANGE_KEY.format(v) for v in range(since + 1, until + 1)]
+    changes = cache.get_many(keys)
+    if len(changes) != len(keys):
+        return None
+    return set(changes.values())
+
+
+def get_cached(name, build):
+    key = f'catalog:{get_catalog_version()}:{name}'
+    value = cache.get(key)
+    if value is None:
+        stats['misses'] += 1
+        value = build()
+        cache.set(key, value, cache_timeout(CATALOG_TIMEOUT))
+    else:
+        stats['hits'] += 1
+    return value
+
+
+def get_item(slug):
+    key = ITEM_KEY.format(slug)
+    item = cache.get(key)
+    if item is None:
+        stats['misses'] += 1
+        item = Item.objects.filter(slug=slug).first()
+        if item is not None:
+            cache.set(key, item, cache_timeout(CATALOG_TIMEOUT))
+    else:
+        stats['hits'] += 1
+    return item
+
+
+def invalidate_item(*slugs):
+    cache.delete_many([ITEM_KEY.format(slug) for slug in slugs if slug])
+
+
+def get_stats():
+    return {'hits': stats['hits'], 'misses': stats['misses']}
+
+
+def _home_listings():
+    latest = Item.objects.order_by('-id')
+    return {
+        'items': list(latest[:8]),
+        'shirts': list(latest.filter(category='S')[:4]),
+        'outwears': list(latest.filter(category='OW')[:4]),
+        'sportwears': list(latest.filter(category='SW')[:4]),
+    }
+
+
+def get_home_listings():
+    return get_cached('home', _home_listings)
+
+
+def _category_page(category, after, before, size):
+    products = Item.objects.filter(category=category)
+    if before is not None:
+        # walk backwards in ascending order, then flip the page around
+        rows = list(products.filter(id__gt=before).order_by('id')[:size + 1])
+        has_prev = len(rows) > size
+        rows = rows[:size][::-1]
+        has_next = True
+    else:
+        if after is not None:
+            products = products.filter(id__lt=after)
+        rows = list(products.order_by('-id')[:size + 1])
+        has_next = len(rows) > size
+        rows = rows[:size]
+        has_prev = after is not None
+    return {
+        'products': rows,
+        'next_cursor': rows[-1].id if rows and has_next else None,
+        'prev_cursor': rows[0].id if rows and has_prev else None,
+    }
+
+
+def get_category_page(category, after=None, before=None,
+                      size=CATEGORY_PAGE_SIZE):
+    if category not in dict(CATEGORY_CHOICES):
+        return {'products': [], 'next_cursor': None, 'prev_cursor': None}
+    if after is not None or before is not None:
+        # cursors come from the client, so caching them would let any value
+        # claim its own entry; a keyset page is one indexed query anyway
+        return _category_page(category, after, before, size)
+    return get_cached(f'category:{category}:{size}',
+                      lambda: _category_page(category, None, None, size))
+
+
+def serialize_item(item):
+    return {
+        'id': item.id,
+        'title': item.title,
+        'slug': item.slug,
+        'url': item.get_absolute_url(),
+        'img': item.img.url,
+        'price': item.price,
+        'discount_price': item.discount_price,
+        'category': item.category,
+        'label': item.label,
+    }
@@ -0,0 +1,57 @@
+import hashlib
+
+from django.contrib import messages
+from django.views.decorators.http import condition
+from .cart import get_request_cart_count
+from .catalog import get_catalog_version, get_catalog_last_modified, get_item
+
+
+def viewer_state(request):
+    # every page renders the cart badge and any pending flash messages, so
+    # they have to be part of the validator; None disables the 304 path
+    if len(messages.get_messages(request)):
+        return None
+    return f'{request.user.pk}:{get_request_cart_count(request)}'
+
+
+def make_etag(request, *parts):
+    viewer = viewer_state(request)
+    if viewer is None:
+        return None
+    value = ':'.join(str(part) for part in parts + (viewer,))
+    return hashlib.md5(value.encode()).hexdigest()
+
+
+def shared_last_modified(request, value):
+    # Last-Modified can't tell users apart, so only anonymous pages get it
+    if request.user.is_authenticated or viewer_state(request) is None:
+        return None
+    return value
+
+
+def catalog_etag(request, *args, **kwargs):
+    return make_etag(request, request.get_full_path(), get_catalog_version())
+
+
+def catalog_last_modified(request, *args, **kwargs):
+    return shared_last_modified(request, get_catalog_last_modified())
+
+
+def item_etag(request, slug, *args, **kwargs):
+    item = get_item(slug)
+    if item is None:
+        return None
+    return make_etag(request, item.pk, item.updated_at.isoformat())
+
+
+def item_last_modified(request, slug, *args, **kwargs):
+    item = get_item(slug)
+    if item is None:
+        return None
+    return shared_last_modified(request, item.updated_at)
+
+
+catalog_condition = condition(etag_func=catalog_etag,
+                              last_modified_func=catalog_last_modified)
+item_condition = condition(etag_func=item_etag,
+                           last_modified_func=item_last_modified)
@@ -0,0 +1,134 @@
+import threading
+from collections import OrderedDict
+
+from django.db.models import F, Q
+from django.utils import timezone
+from .caching import bump_version, get_version
+from .models import Cupon, Order
+
+
+COUPON_VERSION_KEY = 'coupon-version'
+COUPON_CACHE_SIZE = 256
+
+
+class CouponError(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+def get_coupon_version():
+    return get_version(COUPON_VERSION_KEY)
+
+
+def bump_coupon_version():
+    return bump_version(COUPON_VERSION_KEY)
+
+
+class CouponCache:
+    # per-process LRU of coupons, by code and by pk; any change to a coupon
+    # bumps the cached version and every process sharing that cache drops
+    # its copy on next use (see CACHE_SHARED in settings)
+
+    def __init__(self, maxsize=COUPON_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.version = None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, load):
+        version = get_coupon_version()
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        # unknown codes are cached too, as None, so guessing costs no query
+        coupon = load()
+        with self.lock:
+            if self.version == version:
+                self.entries[key] = coupon
+                if len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+        return coupon
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.version = None
+
+
+_coupons = CouponCache()
+
+
+def get_coupon(code):
+    code = code.strip()
+    return _coupons.get(
+        ('code', code), lambda: Cupon.objects.filter(cupon=code).first())
+
+
+def get_coupon_by_id(pk):
+    return _coupons.get(
+        ('pk', pk), lambda: Cupon.objects.filter(pk=pk).first())
+
+
+def check_coupon(code, now=None):
+    coupon = get_coupon(code)
+    if coupon is None:
+        raise CouponError('This Cupon does not exist')
+    now = now or timezone.now()
+    if coupon.valid_from and now < coupon.valid_from:
+        raise CouponError('This Cupon is not active yet')
+    if coupon.valid_until and now > coupon.valid_until:
+        raise CouponError('This Cupon has expired')
+    if not coupon.is_valid(now):
+        raise CouponError('This Cupon has been used up')
+    return coupon
+
+
+def redeem_coupon(pk, now=None):
+    # the checks and the increment are one conditional UPDATE, so the cap
+    # holds however many buyers redeem the last use at the same time
+    now = now or timezone.now()
+    redeemed = Cupon.objects.filter(
+        Q(valid_from__isnull=True) | Q(valid_from__lte=now),
+        Q(valid_until__isnull=True) | Q(valid_until__gte=now),
+        Q(max_uses__isnull=True) | Q(times_used__lt=F('max_uses')),
+        pk=pk,
+    ).update(times_used=F('times_used') + 1)
+    if redeemed and Cupon.objects.filter(
+            pk=pk, times_used__gte=F('max_uses')).exists():
+        # the last use is gone; stop offering the coupon at checkout
+        bump_coupon_version()
+    return bool(redeemed)
+
+
+def release_coupon(pk):
+    released = Cupon.objects.filter(pk=pk, times_used__gt=0).update(
+        times_used=F('times_used') - 1)
+    if released and Cupon.objects.filter(
+            pk=pk, times_used=F('max_uses') - 1).exists():
+        bump_coupon_version()
+    return bool(released)
+
+
+def drop_invalid_coupon(order, now=None):
+    # an expired or used-up coupon would fail every payment of the order;
+    # returns the coupon that was taken off, if any
+    coupon = order.cupon
+    if coupon is None or coupon.is_valid(now):
+        return None
+    order.set_cupon(None)
+    return coupon
+
+
+def reprice_open_orders(coupon, amount):
+    # carts holding the coupon follow an edit of its amount, or lose the
+    # discount when it is deleted (amount None)
+    orders = Order.objects.filter(ordered=False, cupon=coupon)
+    if amount is None:
+        return orders.update(cupon=None, discount=0, total=F('subtotal'))
+    return orders.update(discount=amount, total=F('subtotal') - amount)
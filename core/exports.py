@@ -0,0 +1,164 @@
+import csv
+import json
+from datetime import timedelta
+
+from django.db.models import Prefetch, prefetch_related_objects
+from .models import Order, OrderItem
+from .rollups import day_start, parse_date
+
+
+EXPORT_CHUNK_SIZE = 1000
+EXPORT_FORMATS = ('csv', 'jsonl')
+
+ORDER_COLUMNS = [
+    'ref_code', 'order_date', 'user_id', 'username', 'email',
+    'shipping_address', 'shipping_division', 'shipping_country',
+    'shipping_zip', 'billing_address', 'billing_division', 'billing_country',
+    'billing_zip', 'charge_id', 'paid', 'paid_at', 'cupon', 'subtotal',
+    'discount', 'total', 'being_delivered', 'received', 'refund_requested',
+    'refund_granted',
+]
+LINE_COLUMNS = ['item_slug', 'item_title', 'quantity', 'unit_price']
+CSV_COLUMNS = ORDER_COLUMNS + LINE_COLUMNS
+
+
+def parse_day(value, end=False):
+    # the start of a parse_date day in the current timezone; an end day is
+    # inclusive, so it maps to the next midnight
+    day = parse_date(value)
+    if day is None:
+        return None
+    if end:
+        day += timedelta(days=1)
+    return day_start(day)
+
+
+def export_queryset(since=None, until=None):
+    # one row per placed order with its user, addresses, payment and coupon
+    # joined in; only the columns the export writes are loaded
+    orders = Order.objects.filter(ordered=True).select_related(
+        'user', 'shipping_address', 'billing_address', 'payment', 'cupon',
+    ).only(
+        'ref_code', 'order_date', 'subtotal', 'discount', 'total',
+        'being_delicered', 'received', 'refund_requested', 'refund_granted',
+        'user__username', 'user__email',
+        'shipping_address__address', 'shipping_address__secondary_addrs',
+        'shipping_address__division', 'shipping_address__country',
+        'shipping_address__zip_code',
+        'billing_address__address', 'billing_address__secondary_addrs',
+        'billing_address__division', 'billing_address__country',
+        'billing_address__zip_code',
+        'payment__stripe_charge_id', 'payment__amount', 'payment__timestamp',
+        'cupon__cupon',
+    ).order_by('pk')
+    # by payment time, like the rollups; order_date is when the cart started
+    if since is not None:
+        orders = orders.filter(payment__timestamp__gte=since)
+    if until is not None:
+        orders = orders.filter(payment__timestamp__lt=until)
+    return orders
+
+
+def iter_order_chunks(orders, chunk_size=EXPORT_CHUNK_SIZE):
+    # iterator() streams the orders without filling the queryset cache;
+    # Django ignores prefetch_related on it, so the lines are prefetched
+    # per chunk instead, one extra query for every chunk_size orders
+    lines = Prefetch('items', queryset=OrderItem.objects.select_related(
+        'item').only('quantity', 'unit_price', 'item__slug', 'item__title'))
+    chunk = []
+    for order in orders.iterator(chunk_size=chunk_size):
+        chunk.append(order)
+        if len(chunk) == chunk_size:
+            prefetch_related_objects(chunk, lines)
+            yield chunk
+            chunk = []
+    if chunk:
+        prefetch_related_objects(chunk, lines)
+        yield chunk
+
+
+def _address(address, prefix):
+    if address is None:
+        return dict.fromkeys(
+            [f'{prefix}_address', f'{prefix}_division', f'{prefix}_country',
+             f'{prefix}_zip'])
+    street = ', '.join(part for part in (address.address,
+                                         address.secondary_addrs) if part)
+    return {f'{prefix}_address': street, f'{prefix}_division': address.division,
+            f'{prefix}_country': str(address.country),
+            f'{prefix}_zip': address.zip_code}
+
+
+def order_record(order):
+    payment = order.payment
+    record = {
+        'ref_code': order.ref_code,
+        'order_date': order.order_date.isoformat(),
+        'user_id': order.user_id,
+        'username': order.user.username,
+        'email': order.user.email,
+        'charge_id': payment.stripe_charge_id if payment else None,
+        'paid': payment.amount if payment else None,
+        'paid_at': payment.timestamp.isoformat() if payment else None,
+        'cupon': order.cupon.cupon if order.cupon else None,
+        'subtotal': order.subtotal,
+        'discount': order.discount,
+        'total': order.total,
+        'being_delivered': order.being_delicered,
+        'received': order.received,
+        'refund_requested': order.refund_requested,
+        'refund_granted': order.refund_granted,
+    }
+    record.update(_address(order.shipping_address, 'shipping'))
+    record.update(_address(order.billing_address, 'billing'))
+    return record
+
+
+def line_record(line):
+    item = line.item
+    return {'item_slug': item.slug, 'item_title': item.title,
+            'quantity': line.quantity,
+            'unit_price': line.unit_price}
+
+
+class Echo:
+    # csv.writer wants a file; this one hands each row straight back
+
+    def write(self, value):
+        return value
+
+
+def iter_csv(orders, chunk_size=EXPORT_CHUNK_SIZE):
+    # one row per order line, the order columns repeated on each
+    writer = csv.writer(Echo())
+    yield writer.writerow(CSV_COLUMNS)
+    for chunk in iter_order_chunks(orders, chunk_size):
+        rows = []
+        for order in chunk:
+            record = order_record(order)
+            head = [record[column] for column in ORDER_COLUMNS]
+            lines = order.items.all() or [None]
+            for line in lines:
+                tail = ([None] * len(LINE_COLUMNS) if line is None else
+                        list(line_record(line).values()))
+                rows.append(writer.writerow(head + tail))
+        yield ''.join(rows)
+
+
+def iter_jsonl(orders, chunk_size=EXPORT_CHUNK_SIZE):
+    # one object per order with its lines nested
+    for chunk in iter_order_chunks(orders, chunk_size):
+        rows = []
+        for order in chunk:
+            record = order_record(order)
+            record['lines'] = [line_record(line) for line in order.items.all()]
+            rows.append(json.dumps(record) + '\n')
+        yield ''.join(rows)
+
+
+def export_orders(format, since=None, until=None,
+                  chunk_size=EXPORT_CHUNK_SIZE):
+    orders = export_queryset(since, until)
+    if format == 'csv':
+        return iter_csv(orders, chunk_size)
+    return iter_jsonl(orders, chunk_size)
@@ -0,0 +1,128 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from django.conf import settings
+from PIL import Image
+
+# keep this module free of model imports: it is what the pool's spawned
+# worker processes import, and they never set Django up
+
+
+VARIANT_DIR = 'variants'
+VARIANT_WIDTHS = (150, 300, 500)
+VARIANT_FORMATS = (
+    ('webp', 'WEBP', {'quality': 80, 'method': 4}),
+    ('jpg', 'JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+)
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.gif')
+# seconds before an incomplete set of variants is looked for on disk again
+VARIANT_RECHECK = 60
+VARIANT_CACHE_SIZE = 10000
+
+
+def variant_name(name, width, ext):
+    # products/shirt.jpeg -> variants/products/shirt-300.webp
+    stem = os.path.splitext(name)[0]
+    return f'{VARIANT_DIR}/{stem}-{width}.{ext}'
+
+
+def generate_variants(name, media_root, widths=VARIANT_WIDTHS, force=False):
+    # runs in a pool worker; returns how many files it wrote
+    source = os.path.join(media_root, name)
+    source_mtime = os.path.getmtime(source)
+    written = 0
+    with Image.open(source) as original:
+        original.load()
+        for width in widths:
+            if width > original.width:
+                # never upscale; the largest variant is the original size
+                continue
+            height = max(1, round(original.height * width / original.width))
+            resized = None
+            for ext, fmt, params in VARIANT_FORMATS:
+                path = os.path.join(media_root, variant_name(name, width, ext))
+                if not force and os.path.exists(path) and \
+                        os.path.getmtime(path) >= source_mtime:
+                    continue
+                if resized is None:
+                    resized = original.convert('RGB').resize(
+                        (width, height), Image.LANCZOS)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # write beside the target and rename, so a request never
+                # sees half a file
+                tmp = f'{path}.{os.getpid()}.tmp'
+                resized.save(tmp, fmt, **params)
+                os.replace(tmp, path)
+                written += 1
+    return written
+
+
+# (name, ext) -> (source mtime, checked at, variants), per process
+_variants = {}
+
+
+def get_variants(name, ext):
+    # (name, width) of the variants already on disk, remembered for as long
+    # as the source is unchanged; one stat per render instead of one per
+    # variant. A set missing widths, still being generated or smaller than
+    # the original, is looked for again after VARIANT_RECHECK seconds
+    try:
+        source_mtime = os.path.getmtime(os.path.join(settings.MEDIA_ROOT, name))
+    except OSError:
+        return []
+    now = time.monotonic()
+    cached = _variants.get((name, ext))
+    if cached is not None:
+        mtime, checked, variants = cached
+        if mtime == source_mtime and (len(variants) == len(VARIANT_WIDTHS) or
+                                      now - checked < VARIANT_RECHECK):
+            return variants
+
+    variants = []
+    for width in VARIANT_WIDTHS:
+        variant = variant_name(name, width, ext)
+        if os.path.exists(os.path.join(settings.MEDIA_ROOT, variant)):
+            variants.append((variant, width))
+    if len(_variants) >= VARIANT_CACHE_SIZE:
+        _variants.clear()
+    _variants[(name, ext)] = (source_mtime, now, variants)
+    return variants
+
+
+def forget_variants(name):
+    for ext, fmt, params in VARIANT_FORMATS:
+        _variants.pop((name, ext), None)
+
+
+_pool = None
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        # spawn rather than fork: the web process may be running threads
+        _pool = ProcessPoolExecutor(
+            max_workers=settings.IMAGE_VARIANT_WORKERS,
+            mp_context=get_context('spawn'))
+    return _pool
+
+
+def schedule_variants(name):
+    if not name or not os.path.isfile(os.path.join(settings.MEDIA_ROOT, name)):
+        return None
+    future = get_pool().submit(generate_variants, name, settings.MEDIA_ROOT)
+    # this process picks the new files up at once, others on their recheck
+    future.add_done_callback(lambda future: forget_variants(name))
+    return future
+
+
+def find_images(directory):
+    root = os.path.join(settings.MEDIA_ROOT, directory)
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in sorted(filenames):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                path = os.path.join(dirpath, filename)
+                yield os.path.relpath(path, settings.MEDIA_ROOT).replace(
+                    os.sep, '/')
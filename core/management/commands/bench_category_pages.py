@@ -0,0 +1,52 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from core.catalog import CATEGORY_PAGE_SIZE, _category_page
+from core.models import Item
+
+
+class Command(BaseCommand):
+    help = 'Compare keyset and OFFSET page latency for a category listing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--category', default='S')
+        parser.add_argument('--size', type=int, default=CATEGORY_PAGE_SIZE)
+        parser.add_argument('--pages', type=int, nargs='+',
+                            default=[1, 10, 100, 1000, 10000])
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def timed(self, fetch, repeat):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fetch()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best * 1000
+
+    def handle(self, *args, **options):
+        category = options['category']
+        size = options['size']
+        products = Item.objects.filter(category=category)
+        total = products.count()
+        if not total:
+            raise CommandError(f'No items in category {category}')
+
+        self.stdout.write(f'{total} items in {category}, {size} per page')
+        self.stdout.write(f'{"page":>8} {"keyset ms":>10} {"offset ms":>10}')
+        for page in options['pages']:
+            offset = (page - 1) * size
+            if offset >= total:
+                break
+            after = None
+            if offset:
+                after = products.order_by(
+                    '-id').values_list('id', flat=True)[offset - 1]
+
+            keyset = self.timed(
+                lambda: _category_page(category, after, None, size),
+                options['repeat'])
+            offset_ms = self.timed(
+                lambda: list(products.order_by('-id')[offset:offset + size]),
+                options['repeat'])
+            self.stdout.write(f'{page:>8} {keyset:>10.3f} {offset_ms:>10.3f}')
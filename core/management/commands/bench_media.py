@@ -0,0 +1,63 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory
+from django.views.static import serve
+from core.images import find_images
+from core.media import serve_media
+
+
+class Command(BaseCommand):
+    help = ('Compare media throughput of django.views.static.serve with '
+            'core.media.serve_media, in process')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='products',
+                            help='Directory under MEDIA_ROOT to sample')
+        parser.add_argument('--requests', type=int, default=2000)
+
+    def run(self, view, path, count, **headers):
+        factory = RequestFactory()
+        sent = 0
+        start = time.perf_counter()
+        for _ in range(count):
+            request = factory.get(f'{settings.MEDIA_URL}{path}', **headers)
+            response = view(request, path)
+            if response.streaming:
+                body = b''.join(response.streaming_content)
+            else:
+                body = response.content
+            sent += len(body)
+            response.close()
+        elapsed = time.perf_counter() - start
+        return count / elapsed, sent / elapsed / 1024 / 1024, response
+
+    def handle(self, *args, **options):
+        names = list(find_images(options['path']))
+        if not names:
+            raise CommandError(f'No images under {options["path"]}')
+        path = names[0]
+        count = options['requests']
+
+        def static_serve(request, path):
+            return serve(request, path, document_root=settings.MEDIA_ROOT)
+
+        _, _, first = self.run(serve_media, path, 1)
+        etag, modified = first['ETag'], first['Last-Modified']
+        cases = [
+            ('full GET', {}),
+            ('If-Modified-Since', {'HTTP_IF_MODIFIED_SINCE': modified}),
+            ('If-None-Match', {'HTTP_IF_NONE_MATCH': etag}),
+            ('Range 0-1023', {'HTTP_RANGE': 'bytes=0-1023'}),
+        ]
+        self.stdout.write(f'{path}, {count} requests per case')
+        self.stdout.write(
+            f'{"case":<20} {"view":<14} {"status":>6} {"req/s":>10} {"MB/s":>8}')
+        for label, headers in cases:
+            for name, view in (('static.serve', static_serve),
+                               ('serve_media', serve_media)):
+                rate, mbps, response = self.run(view, path, count, **headers)
+                self.stdout.write(
+                    f'{label:<20} {name:<14} {response.status_code:>6} '
+                    f'{rate:>10.0f} {mbps:>8.1f}')
@@ -0,0 +1,62 @@
+import random
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from core.models import Order
+from core.payments import create_ref_code
+
+
+class Command(BaseCommand):
+    help = ('Time refund lookups by ref_code as the order table grows; '
+            'the generated orders are rolled back afterwards')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, nargs='+',
+                            default=[1000, 10000, 100000])
+        parser.add_argument('--lookups', type=int, default=2000)
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.run(options)
+            transaction.set_rollback(True)
+
+    def grow(self, user, count, batch_size):
+        now = timezone.now()
+        for start in range(0, count, batch_size):
+            Order.objects.bulk_create([
+                Order(user=user, ref_code=create_ref_code(), ordered=True,
+                      order_date=now)
+                for _ in range(min(batch_size, count - start))
+            ])
+
+    def timed(self, codes):
+        start = time.perf_counter()
+        for code in codes:
+            Order.objects.filter(ref_code=code).only('pk').first()
+        return (time.perf_counter() - start) / len(codes) * 1e6
+
+    def measure(self, options):
+        codes = list(Order.objects.exclude(ref_code=None).values_list(
+            'ref_code', flat=True))
+        hits = random.choices(codes, k=options['lookups'])
+        misses = [create_ref_code() for _ in range(options['lookups'])]
+        return self.timed(hits), self.timed(misses)
+
+    def run(self, options):
+        user = get_user_model().objects.create(
+            username=f'bench-{create_ref_code()}')
+        self.stdout.write(f'{"orders":>10} {"hit us":>10} {"miss us":>10}')
+        for target in sorted(options['orders']):
+            size = Order.objects.count()
+            if target > size:
+                self.grow(user, target - size, options['batch_size'])
+            hit, miss = self.measure(options)
+            self.stdout.write(
+                f'{Order.objects.count():>10} {hit:>10.1f} {miss:>10.1f}')
+
+        plan = Order.objects.filter(ref_code='x').only('pk').explain()
+        self.stdout.write(f'plan: {plan}')
@@ -0,0 +1,95 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Min
+from core.addresses import invalidate_default_addresses
+from core.models import Address, Order
+
+
+class Command(BaseCommand):
+    help = ('Collapse identical addresses of a user into one row and leave '
+            'one default per address type')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report what would change, do not write')
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            with transaction.atomic():
+                rehashed, removed, cleared = self.dedupe(options['batch_size'])
+                transaction.set_rollback(True)
+            self.stdout.write(self.style.SUCCESS(
+                f'Found {rehashed} stale hashes, {removed} duplicates and '
+                f'{cleared} extra defaults'))
+            return
+
+        rehashed, removed, cleared = self.dedupe(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Rehashed {rehashed} addresses, removed {removed} duplicates, '
+            f'cleared {cleared} extra defaults'))
+
+    def dedupe(self, batch_size):
+        rehashed, removed = self.refresh_hashes(batch_size)
+        return rehashed, removed, self.normalize_defaults()
+
+    def refresh_hashes(self, batch_size):
+        # core_address_unique_content keeps rows with a current hash apart;
+        # a row changed through .update() kept its old one and may now be a
+        # copy of another row
+        rehashed = removed = 0
+        deleted = set()
+        last_pk = 0
+        while True:
+            with transaction.atomic():
+                chunk = list(Address.objects.filter(
+                    pk__gt=last_pk).order_by('pk')[:batch_size])
+                if not chunk:
+                    return rehashed, removed
+                last_pk = chunk[-1].pk
+                for address in chunk:
+                    content_hash = address.compute_hash()
+                    if (address.pk in deleted
+                            or content_hash == address.content_hash):
+                        continue
+                    rehashed += 1
+                    twin = Address.objects.filter(
+                        user=address.user_id,
+                        address_type=address.address_type,
+                        content_hash=content_hash).first()
+                    if twin is not None:
+                        keep, drop = sorted((address, twin),
+                                            key=lambda row: row.pk)
+                        self.collapse(keep, drop)
+                        deleted.add(drop.pk)
+                        removed += 1
+                        if keep is not address:
+                            continue
+                    Address.objects.filter(pk=address.pk).update(
+                        content_hash=content_hash)
+
+    def collapse(self, keep, drop):
+        # the older row stays, orders move over to it
+        Order.objects.filter(shipping_address=drop).update(
+            shipping_address=keep)
+        Order.objects.filter(billing_address=drop).update(
+            billing_address=keep)
+        if drop.default and not keep.default:
+            Address.objects.filter(pk=keep.pk).update(default=True)
+            keep.default = True
+        drop.delete()
+        invalidate_default_addresses(keep.user_id)
+
+    def normalize_defaults(self):
+        # the oldest default is the one get_default_addresses hands out
+        groups = (Address.objects.filter(default=True)
+                  .values('user', 'address_type')
+                  .annotate(rows=Count('pk'), keep=Min('pk'))
+                  .filter(rows__gt=1).order_by())
+        cleared = 0
+        for group in groups:
+            cleared += Address.objects.filter(
+                user=group['user'], address_type=group['address_type'],
+                default=True).exclude(pk=group['keep']).update(default=False)
+            invalidate_default_addresses(group['user'])
+        return cleared
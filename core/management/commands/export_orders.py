@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+from core.exports import (EXPORT_CHUNK_SIZE, EXPORT_FORMATS, export_orders,
+                          parse_day)
+
+
+class Command(BaseCommand):
+    help = 'Stream placed orders and their lines as CSV or JSON lines'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv')
+        parser.add_argument('--since', help='First payment day, YYYY-MM-DD')
+        parser.add_argument('--until', help='Last payment day, YYYY-MM-DD')
+        parser.add_argument('--output', '-o',
+                            help='File to write (default stdout)')
+        parser.add_argument('--chunk-size', type=int,
+                            default=EXPORT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            since = parse_day(options['since'])
+            until = parse_day(options['until'], end=True)
+        except ValueError:
+            raise CommandError('--since and --until must be YYYY-MM-DD')
+
+        chunks = export_orders(options['format'], since, until,
+                               options['chunk_size'])
+        if options['output']:
+            with open(options['output'], 'w', newline='',
+                      encoding='utf-8') as out:
+                out.writelines(chunks)
+        else:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
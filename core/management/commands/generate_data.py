@@ -0,0 +1,328 @@
+import hashlib
+import random
+import time
+from contextlib import contextmanager
+from datetime import datetime, time as dt_time, timedelta
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+from core.catalog import bump_catalog_version
+from core.coupons import bump_coupon_version
+from core.images import find_images
+from core.models import (CATEGORY_CHOICES, DIVISION_CHOICES, LABEL_CHOICES,
+                         Address, Cupon, Item, Order, OrderItem, Payment,
+                         Refund, address_hash)
+from core.search import rebuild_index
+
+
+def next_pk(model):
+    return (model.objects.aggregate(last=Max('pk'))['last'] or 0) + 1
+
+
+def prefixed_code(prefix, kind, n, length):
+    # the whole prefix goes into the hash, so codes never repeat across
+    # prefixes however long they are or however much of them is shared
+    digest = hashlib.sha1(f'{prefix}:{kind}:{n}'.encode()).hexdigest()
+    return digest[:length]
+
+
+@contextmanager
+def historical_timestamps():
+    # let bulk_create keep the dates generated for past orders and payments
+    fields = [Order._meta.get_field('start_date'),
+              Payment._meta.get_field('timestamp')]
+    for field in fields:
+        field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field in fields:
+            field.auto_now_add = True
+
+
+# a fixed end date, so the same --seed gives the same history on any day
+DEFAULT_UNTIL = '2025-12-31'
+
+
+class Command(BaseCommand):
+    help = ('Bulk-generate a catalog, users, addresses, coupons and order '
+            'history for benchmarking. With the same --seed, --prefix and '
+            'options the rows, dates, prices and codes are the same on '
+            'every run; only the primary keys depend on the rows already '
+            'in the database')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=10000)
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--orders', type=int, default=200000)
+        parser.add_argument('--lines', type=int, default=5,
+                            help='Most lines per order; the mean is about half')
+        parser.add_argument('--coupons', type=int, default=50)
+        parser.add_argument('--coupon-rate', type=float, default=0.1)
+        parser.add_argument('--refund-rate', type=float, default=0.02)
+        parser.add_argument('--days', type=int, default=365,
+                            help='Spread the orders over this many days')
+        parser.add_argument('--until', default=DEFAULT_UNTIL,
+                            help=f'Last order date, YYYY-MM-DD (default '
+                                 f'{DEFAULT_UNTIL}); pass today\'s date for a '
+                                 'history that ends now')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--prefix',
+                            help='Prefix for slugs, usernames and codes '
+                                 '(default gen<seed>)')
+        parser.add_argument('--chunk-size', type=int, default=5000,
+                            help='Rows per transaction')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Rows per INSERT')
+        parser.add_argument('--no-index', action='store_true',
+                            help='Skip rebuilding the search index')
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options['seed'])
+        self.prefix = options['prefix'] or f'gen{options["seed"]}'
+        self.batch_size = options['batch_size']
+        self.chunk_size = options['chunk_size']
+        try:
+            until = datetime.combine(
+                datetime.strptime(options['until'], '%Y-%m-%d').date(),
+                dt_time(23, 59, 59))
+        except ValueError:
+            raise CommandError('--until must be YYYY-MM-DD')
+        self.until = timezone.make_aware(until, timezone.utc)
+        self.days = options['days']
+        self.check_options(options)
+
+        if Item.objects.filter(slug__startswith=f'{self.prefix}-').exists():
+            raise CommandError(
+                f'Rows with prefix {self.prefix} exist; pass another --prefix')
+        self.coupon_codes = [
+            prefixed_code(self.prefix, 'coupon', n, 15).upper()
+            for n in range(options['coupons'])]
+        for start in range(0, len(self.coupon_codes), 500):
+            if Cupon.objects.filter(
+                    cupon__in=self.coupon_codes[start:start + 500]).exists():
+                raise CommandError(
+                    f'Coupon codes for prefix {self.prefix} exist; '
+                    f'pass another --prefix')
+
+        started = time.perf_counter()
+        items = self.timed('items', self.create_items, options['items'])
+        users = self.timed('users', self.create_users, options['users'])
+        addresses = self.timed('addresses', self.create_addresses, users)
+        coupons = self.timed('coupons', self.create_coupons)
+        with historical_timestamps():
+            self.timed('orders', self.create_orders, options, items, users,
+                       addresses, coupons)
+        self.reset_sequences()
+
+        bump_catalog_version()
+        bump_coupon_version()
+        if not options['no_index']:
+            self.timed('search index', rebuild_index)
+        self.stdout.write(self.style.SUCCESS(
+            f'Done in {time.perf_counter() - started:.1f}s'))
+
+    def check_options(self, options):
+        for name in ('items', 'users', 'orders', 'coupons', 'days'):
+            if options[name] < 0:
+                raise CommandError(f'--{name} must not be negative')
+        for name in ('lines', 'chunk_size', 'batch_size'):
+            if options[name] < 1:
+                raise CommandError(
+                    f'--{name.replace("_", "-")} must be at least 1')
+        for name in ('coupon_rate', 'refund_rate'):
+            if not 0 <= options[name] <= 1:
+                raise CommandError(
+                    f'--{name.replace("_", "-")} must be between 0 and 1')
+        if options['orders'] and not (options['items'] and options['users']):
+            raise CommandError('--orders needs at least one item and one user')
+
+    def timed(self, label, create, *args):
+        start = time.perf_counter()
+        result = create(*args)
+        count = len(result) if isinstance(result, (list, dict)) else result
+        suffix = '' if count is None else f'{count} '
+        self.stdout.write(
+            f'{suffix}{label} in {time.perf_counter() - start:.1f}s')
+        return result
+
+    def insert(self, model, rows):
+        # explicit pks, so no backend has to return ids from bulk_create
+        with transaction.atomic():
+            model.objects.bulk_create(rows, batch_size=self.batch_size)
+
+    def chunked(self, count, build):
+        for start in range(0, count, self.chunk_size):
+            yield [build(n) for n in range(start, min(count, start + self.chunk_size))]
+
+    def create_items(self, count):
+        rng = self.rng
+        images = sorted(find_images('products')) or ['products/item.jpeg']
+        categories = [code for code, _ in CATEGORY_CHOICES]
+        labels = [code for code, _ in LABEL_CHOICES]
+        words = ['Cotton', 'Linen', 'Denim', 'Slim', 'Classic', 'Sport',
+                 'Winter', 'Summer', 'Striped', 'Plain', 'Hooded', 'Leather']
+        first = next_pk(Item)
+
+        def build(n):
+            price = round(rng.uniform(5, 200), 2)
+            title = f'{rng.choice(words)} {rng.choice(words)} {n}'
+            return Item(
+                pk=first + n,
+                title=title,
+                slug=f'{self.prefix}-item-{n}',
+                img=rng.choice(images),
+                price=price,
+                discount_price=round(price * rng.uniform(0.5, 0.9), 2)
+                if rng.random() < 0.3 else None,
+                description=f'{title}, generated for benchmarking',
+                category=rng.choice(categories),
+                label=rng.choice(labels),
+            )
+
+        for rows in self.chunked(count, build):
+            self.insert(Item, rows)
+        return list(Item.objects.filter(pk__gte=first).order_by('pk')
+                    .values_list('pk', 'price', 'discount_price'))
+
+    def create_users(self, count):
+        User = get_user_model()
+        # one unusable password for all; hashing a real one per row is the
+        # slowest thing this command could do
+        password = make_password(None)
+        first = next_pk(User)
+
+        def build(n):
+            return User(pk=first + n, username=f'{self.prefix}-user-{n}',
+                        email=f'{self.prefix}-user-{n}@example.com',
+                        password=password)
+
+        for rows in self.chunked(count, build):
+            self.insert(User, rows)
+        return list(range(first, first + count))
+
+    def create_addresses(self, users):
+        rng = self.rng
+        divisions = [code for code, _ in DIVISION_CHOICES]
+        first = next_pk(Address)
+        # shipping and billing default per user
+        addresses = {}
+
+        def build(n):
+            user = users[n // 2]
+            address_type = 'SB'[n % 2]
+            fields = {
+                'address': f'{rng.randint(1, 999)} Road {rng.randint(1, 99)}',
+                'secondary_addrs': '',
+                'division': rng.choice(divisions),
+                'country': 'BD',
+                'zip_code': str(rng.randint(1000, 9999)),
+            }
+            addresses[user, address_type] = first + n
+            return Address(pk=first + n, user_id=user,
+                           address_type=address_type, default=True,
+                           content_hash=address_hash(
+                               fields['address'], fields['secondary_addrs'],
+                               fields['division'], fields['country'],
+                               fields['zip_code']),
+                           **fields)
+
+        for rows in self.chunked(len(users) * 2, build):
+            self.insert(Address, rows)
+        return addresses
+
+    def create_coupons(self):
+        first = next_pk(Cupon)
+        rows = [Cupon(pk=first + n, cupon=code,
+                      amount=self.rng.choice([5, 10, 15, 20]))
+                for n, code in enumerate(self.coupon_codes)]
+        self.insert(Cupon, rows)
+        return [(row.pk, row.amount) for row in rows]
+
+    def create_orders(self, options, items, users, addresses, coupons):
+        rng = self.rng
+        count = options['orders']
+        order_pk = next_pk(Order)
+        line_pk = next_pk(OrderItem)
+        payment_pk = next_pk(Payment)
+        seconds = self.days * 24 * 60 * 60
+        Through = Order.items.through
+        lines_total = 0
+
+        for start in range(0, count, self.chunk_size):
+            orders, lines, through, payments, refunds = [], [], [], [], []
+            for n in range(start, min(count, start + self.chunk_size)):
+                user = rng.choice(users)
+                placed = self.until - timedelta(
+                    seconds=rng.randint(0, seconds))
+                subtotal = 0
+                for item_pk, price, discount_price in rng.sample(
+                        items, rng.randint(1, min(options['lines'], len(items)))):
+                    quantity = rng.randint(1, 3)
+                    subtotal += (discount_price or price) * quantity
+                    lines.append(OrderItem(
+                        pk=line_pk, user_id=user, ordered=True,
+                        item_id=item_pk, quantity=quantity,
+                        unit_price=discount_price or price))
+                    through.append(Through(order_id=order_pk,
+                                           orderitem_id=line_pk))
+                    line_pk += 1
+
+                cupon = discount = None
+                if coupons and rng.random() < options['coupon_rate']:
+                    cupon, discount = rng.choice(coupons)
+                discount = discount or 0
+                total = round(subtotal - discount, 2)
+                refunded = rng.random() < options['refund_rate']
+                refund_requested = refunded and rng.random() < 0.5
+
+                payments.append(Payment(
+                    pk=payment_pk, stripe_charge_id=f'ch_gen_{payment_pk}',
+                    user_id=user, amount=total, timestamp=placed))
+                orders.append(Order(
+                    pk=order_pk, user_id=user,
+                    ref_code=prefixed_code(self.prefix, 'order', n, 20),
+                    start_date=placed, order_date=placed, ordered=True,
+                    shipping_address_id=addresses[user, 'S'],
+                    billing_address_id=addresses[user, 'B'],
+                    payment_id=payment_pk, cupon_id=cupon,
+                    being_delicered=True, received=not refunded,
+                    refund_requested=refund_requested,
+                    refund_granted=False,
+                    subtotal=round(subtotal, 2), discount=discount,
+                    total=total))
+                # a Refund row is the request; the others were returned
+                # without one
+                if refund_requested:
+                    refunds.append(Refund(
+                        order_id=order_pk, email=f'{user}@example.com',
+                        reason='Generated refund request', accepted=False))
+                order_pk += 1
+                payment_pk += 1
+
+            with transaction.atomic():
+                Payment.objects.bulk_create(payments, batch_size=self.batch_size)
+                Order.objects.bulk_create(orders, batch_size=self.batch_size)
+                OrderItem.objects.bulk_create(lines, batch_size=self.batch_size)
+                Through.objects.bulk_create(through, batch_size=self.batch_size)
+                Refund.objects.bulk_create(refunds, batch_size=self.batch_size)
+            lines_total += len(lines)
+            self.stdout.write(
+                f'  {min(count, start + self.chunk_size)}/{count} orders, '
+                f'{lines_total} lines')
+        return count
+
+    def reset_sequences(self):
+        # rows went in with explicit pks; move the sequences past them
+        models = [Item, get_user_model(), Address, Cupon, Order, OrderItem,
+                  Payment]
+        statements = connection.ops.sequence_reset_sql(no_style(), models)
+        if statements:
+            with connection.cursor() as cursor:
+                for sql in statements:
+                    cursor.execute(sql)
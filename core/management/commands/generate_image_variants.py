@@ -0,0 +1,37 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from core.images import find_images, generate_variants
+
+
+class Command(BaseCommand):
+    help = 'Generate the responsive WebP and JPEG variants of stored images'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='products',
+                            help='Directory under MEDIA_ROOT to walk')
+        parser.add_argument('--workers', type=int,
+                            default=settings.IMAGE_VARIANT_WORKERS)
+        parser.add_argument('--force', action='store_true',
+                            help='Regenerate variants that are up to date')
+
+    def handle(self, *args, **options):
+        names = list(find_images(options['path']))
+        written = failed = 0
+        with ProcessPoolExecutor(max_workers=options['workers']) as pool:
+            futures = {
+                pool.submit(generate_variants, name, settings.MEDIA_ROOT,
+                            force=options['force']): name
+                for name in names
+            }
+            for future in as_completed(futures):
+                try:
+                    written += future.result()
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f'{futures[future]}: {e}')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Checked {len(names)} images, wrote {written} variants, '
+            f'{failed} failed'))
@@ -0,0 +1,50 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from core.models import PaymentJob
+from core.payments import (FakeGateway, claim_jobs, requeue_stale_jobs,
+                           run_job, set_gateway)
+
+
+class Command(BaseCommand):
+    help = 'Run a pool of payment workers that charge queued orders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--poll-interval', type=float, default=1.0)
+        parser.add_argument('--stale-after', type=int, default=300,
+                            help='Requeue jobs running longer than this')
+        parser.add_argument('--once', action='store_true',
+                            help='Drain the queue and exit')
+        parser.add_argument('--fake', action='store_true',
+                            help='Charge against the local fake gateway')
+        parser.add_argument('--fake-latency', type=float)
+        parser.add_argument('--fake-failure-rate', type=float)
+
+    def handle(self, *args, **options):
+        if options['fake']:
+            set_gateway(FakeGateway(options['fake_latency'],
+                                    options['fake_failure_rate']))
+
+        workers = options['workers']
+        processed = 0
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while True:
+                requeue_stale_jobs(options['stale_after'])
+                claimed = claim_jobs(workers * 2)
+                if claimed:
+                    list(pool.map(run_job, claimed))
+                    processed += len(claimed)
+                    continue
+                if options['once']:
+                    break
+                time.sleep(options['poll_interval'])
+
+        elapsed = time.perf_counter() - start
+        failed = PaymentJob.objects.filter(status='F').count()
+        self.stdout.write(self.style.SUCCESS(
+            f'Processed {processed} jobs in {elapsed:.2f}s '
+            f'({processed / elapsed if elapsed else 0:.1f}/s), '
+            f'{failed} failed jobs in the queue'))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from core.models import Refund
+from core.refunds import REFUND_CHUNK_SIZE, grant_pending_refunds
+
+
+class Command(BaseCommand):
+    help = 'Accept pending refund requests and mark their orders refunded'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=REFUND_CHUNK_SIZE,
+                            help='Orders per transaction')
+        parser.add_argument('--limit', type=int,
+                            help='Stop after this many orders')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count the pending refunds')
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            pending = Refund.objects.filter(accepted=False).values(
+                'order_id').distinct().count()
+            self.stdout.write(self.style.SUCCESS(
+                f'{pending} orders have pending refunds'))
+            return
+
+        granted = grant_pending_refunds(
+            options['chunk_size'], options['limit'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Granted refunds on {granted} orders'))
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+from core.models import Order
+
+
+TOLERANCE = 0.005
+
+
+class Command(BaseCommand):
+    help = 'Recompute the stored totals of open orders and fix any that drifted'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help='Only report mismatches, do not write')
+        parser.add_argument('--placed', action='store_true',
+                            help='Also report placed orders; they are never '
+                                 'rewritten, their totals are what was charged')
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        orders = Order.objects.order_by('pk')
+        if not options['placed']:
+            orders = orders.filter(ordered=False)
+
+        checked = mismatched = fixed = 0
+        for order in orders.iterator(chunk_size=options['chunk_size']):
+            checked += 1
+            stored = (order.subtotal, order.discount, order.total)
+            computed = order.compute_totals()
+            if all(abs(a - b) < TOLERANCE for a, b in zip(stored, computed)):
+                continue
+            mismatched += 1
+            self.stdout.write(
+                f'order {order.pk}: stored {stored} != computed {computed}')
+            # a placed order's discount was priced from the coupon as it was
+            # then, compute_totals prices it from the coupon as it is now
+            if not options['check'] and not order.ordered:
+                order.recalculate_totals()
+                fixed += 1
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Checked {checked} orders, found {mismatched} mismatches, '
+            f'fixed {fixed}'))
+        if mismatched > fixed:
+            raise CommandError(f'{mismatched - fixed} mismatches left')
@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from core.rollups import (ROLLUP_DAYS_PER_CHUNK, parse_date,
+                          refresh_rollups)
+
+
+class Command(BaseCommand):
+    help = ('Bring the daily sales rollups up to date from the last '
+            'Payment.timestamp they have read')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since',
+                            help='Recompute from this day, YYYY-MM-DD')
+        parser.add_argument('--full', action='store_true',
+                            help='Recompute from the first payment')
+        parser.add_argument('--days-per-chunk', type=int,
+                            default=ROLLUP_DAYS_PER_CHUNK,
+                            help='Days rebuilt per transaction')
+
+    def handle(self, *args, **options):
+        try:
+            since = parse_date(options['since'])
+        except ValueError:
+            raise CommandError('--since must be YYYY-MM-DD')
+
+        start = time.perf_counter()
+        days = refresh_rollups(since, options['full'],
+                               options['days_per_chunk'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Refreshed {days} days in {time.perf_counter() - start:.1f}s'))
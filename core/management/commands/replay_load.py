@@ -0,0 +1,376 @@
+import io
+import json
+import math
+import random
+import time
+from collections import defaultdict
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode, urlsplit
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, \
+    SESSION_KEY, get_user_model
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.core.signals import request_finished, request_started
+from django.db import DatabaseError, close_old_connections, connection, \
+    transaction
+from django.http import HttpRequest
+from django.middleware.csrf import get_token
+from django.urls import Resolver404, resolve
+from core.addresses import invalidate_default_addresses
+from core.cart import invalidate_cart_count
+from core.models import CATEGORY_CHOICES, Item
+from core.payments import (FakeGateway, attempt_job, claim_jobs, run_job,
+                           set_gateway)
+
+
+WORKER_ROUTE = 'payment-worker'
+
+
+def percentile(values, q):
+    # nearest rank on the sorted sample
+    if not values:
+        return None
+    rank = max(0, min(len(values) - 1, math.ceil(q * len(values)) - 1))
+    return values[rank]
+
+
+class Session:
+    # one virtual browser: its cookies, and a logged-in user if any
+
+    def __init__(self, user=None):
+        self.cookies = {}
+        # what CsrfViewMiddleware would have set on a first visit
+        request = HttpRequest()
+        self.csrf = get_token(request)
+        self.cookies[settings.CSRF_COOKIE_NAME] = request.META['CSRF_COOKIE']
+        if user is not None:
+            store = SessionStore()
+            store[SESSION_KEY] = str(user.pk)
+            store[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+            store[HASH_SESSION_KEY] = user.get_session_auth_hash()
+            store.create()
+            self.cookies[settings.SESSION_COOKIE_NAME] = store.session_key
+
+    def update(self, headers):
+        for name, value in headers:
+            if name.lower() != 'set-cookie':
+                continue
+            for morsel in SimpleCookie(value).values():
+                if morsel['max-age'] == '0' or not morsel.value:
+                    self.cookies.pop(morsel.key, None)
+                else:
+                    self.cookies[morsel.key] = morsel.value
+
+
+class Command(BaseCommand):
+    help = ('Replay a JSONL request stream through ecommerce.wsgi.application '
+            'in process and report per-route latency and query counts')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--input',
+                            help='JSONL stream to replay; synthetic if omitted')
+        parser.add_argument('--record',
+                            help='Write the synthetic stream here as JSONL')
+        parser.add_argument('--sessions', type=int, default=20,
+                            help='Synthetic shoppers')
+        parser.add_argument('--browse', type=int, default=5,
+                            help='Product pages each synthetic shopper views')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--gateway-latency', type=float, default=0,
+                            help='Seconds the fake gateway takes per charge')
+        parser.add_argument('--output', help='Write the results as JSON')
+        parser.add_argument('--compare',
+                            help='Earlier --output file to diff against')
+        parser.add_argument('--commit', action='store_true',
+                            help='Keep the users, carts and orders the '
+                                 'replay creates, each request committing '
+                                 'its own writes as in production. By '
+                                 'default the whole replay runs in one '
+                                 'transaction that is rolled back, so '
+                                 'commit cost is not in the latencies')
+
+    def synthesize(self, options):
+        rng = random.Random(options['seed'])
+        slugs = list(Item.objects.order_by('pk').values_list('slug', flat=True))
+        if not slugs:
+            raise CommandError('There are no items to browse')
+        categories = [code for code, _ in CATEGORY_CHOICES]
+
+        scripts = []
+        for n in range(options['sessions']):
+            session = f'shopper-{n}'
+            steps = [
+                {'path': '/'},
+                {'path': f'/category/{rng.choice(categories)}/'},
+            ]
+            viewed = rng.sample(slugs, min(options['browse'], len(slugs)))
+            steps += [{'path': f'/product/{slug}/'} for slug in viewed]
+            steps += [{'path': f'/add-to-cart/{slug}/'}
+                      for slug in viewed[:rng.randint(1, len(viewed))]]
+            steps += [
+                {'path': '/order-summary/'},
+                {'path': '/checkout/'},
+                {'path': '/checkout/', 'method': 'POST', 'data': {
+                    'shipping_address': f'{n} Main St',
+                    'shipping_address2': '',
+                    'shipping_country': 'BD',
+                    'shipping_division': 'DHA',
+                    'shipping_zip': '1000',
+                    'billing_division': 'DHA',
+                    'billing_zip': '1000',
+                    'same_billing_address': 'on',
+                    'payment_option': 'C',
+                }},
+                {'path': '/payment/credit/'},
+                {'path': '/payment/credit/', 'method': 'POST',
+                 'data': {'stripeToken': f'tok_{n}'}, 'pay': True},
+            ]
+            scripts.append([dict(step, session=session, user=True)
+                            for step in steps])
+
+        # interleave the shoppers the way concurrent traffic would arrive
+        stream = []
+        while scripts:
+            script = rng.choice(scripts)
+            stream.append(script.pop(0))
+            if not script:
+                scripts.remove(script)
+        return stream
+
+    def load(self, path):
+        with open(path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def environ(self, step, session):
+        method = step.get('method', 'GET').upper()
+        url = urlsplit(step['path'])
+        body = b''
+        content_type = ''
+        if 'json' in step:
+            body = json.dumps(step['json']).encode()
+            content_type = 'application/json'
+        elif 'data' in step:
+            body = urlencode(step['data'], doseq=True).encode()
+            content_type = 'application/x-www-form-urlencoded'
+        return {
+            'REQUEST_METHOD': method,
+            'PATH_INFO': url.path,
+            'QUERY_STRING': url.query,
+            'SERVER_NAME': 'localhost',
+            'SERVER_PORT': '80',
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'HTTP_HOST': 'localhost',
+            'HTTP_COOKIE': '; '.join(
+                f'{k}={v}' for k, v in session.cookies.items()),
+            'HTTP_X_CSRFTOKEN': session.csrf,
+            'CONTENT_TYPE': content_type,
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': io.StringIO(),
+            'wsgi.multithread': False,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+
+    def route(self, step):
+        try:
+            name = resolve(urlsplit(step['path']).path).view_name
+        except Resolver404:
+            name = 'unresolved'
+        method = step.get('method', 'GET').upper()
+        return name if method == 'GET' else f'{name} {method}'
+
+    def timed(self, call):
+        queries = 0
+
+        def count(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        start = time.perf_counter()
+        with connection.execute_wrapper(count):
+            result = call()
+        return result, time.perf_counter() - start, queries
+
+    def replay(self, application, stream, users, run):
+        sessions = {}
+        samples = defaultdict(list)
+        User = get_user_model()
+
+        start = time.perf_counter()
+        for step in stream:
+            name = step.get('session', 'anonymous')
+            session = sessions.get(name)
+            if session is None:
+                user = None
+                if step.get('user'):
+                    user = User.objects.get_or_create(
+                        username=f'loadtest-{name}')[0]
+                    users.append(user)
+                session = sessions[name] = Session(user)
+
+            status = []
+
+            def request():
+                body = application(
+                    self.environ(step, session),
+                    lambda s, headers, exc_info=None: status.append(
+                        (s, headers)))
+                try:
+                    for _ in body:
+                        pass
+                finally:
+                    if hasattr(body, 'close'):
+                        body.close()
+
+            _, elapsed, queries = self.timed(request)
+            code, headers = status[0]
+            session.update(headers)
+            samples[self.route(step)].append(
+                (elapsed, queries, int(code.split()[0])))
+
+            if step.get('pay'):
+                # what the process_payments worker would do next
+                def work():
+                    for pk in claim_jobs(100):
+                        run(pk)
+                try:
+                    _, elapsed, queries = self.timed(work)
+                except DatabaseError:
+                    elapsed, queries, code = 0, 0, 500
+                else:
+                    code = 200
+                samples[WORKER_ROUTE].append((elapsed, queries, code))
+        return samples, time.perf_counter() - start
+
+    def summarize(self, samples, wall):
+        routes = {}
+        for name, rows in sorted(samples.items()):
+            latencies = sorted(row[0] * 1000 for row in rows)
+            queries = [row[1] for row in rows]
+            routes[name] = {
+                'count': len(rows),
+                'errors': sum(1 for row in rows if row[2] >= 500),
+                # this route's share of the requests per wall-clock second
+                'throughput': round(len(rows) / wall, 1) if wall else None,
+                'mean_ms': round(sum(latencies) / len(rows), 3),
+                'p50_ms': round(percentile(latencies, 0.50), 3),
+                'p95_ms': round(percentile(latencies, 0.95), 3),
+                'p99_ms': round(percentile(latencies, 0.99), 3),
+                'queries_mean': round(sum(queries) / len(rows), 2),
+                'queries_max': max(queries),
+            }
+        requests = sum(route['count'] for route in routes.values())
+        return {
+            'requests': requests,
+            'wall_seconds': round(wall, 3),
+            'throughput': round(requests / wall, 1) if wall else None,
+            'routes': routes,
+        }
+
+    def handle(self, *args, **options):
+        from ecommerce.wsgi import application
+
+        stream = self.load(options['input']) if options['input'] \
+            else self.synthesize(options)
+        if options['record']:
+            with open(options['record'], 'w') as f:
+                for step in stream:
+                    f.write(json.dumps(step, sort_keys=True) + '\n')
+
+        set_gateway(FakeGateway(latency=options['gateway_latency'],
+                                failure_rate=0))
+        users = []
+        if options['commit']:
+            # autocommit, as in production: every request and payment job
+            # commits its own writes, and pays for it in its latency
+            samples, wall = self.replay(application, stream, users, run_job)
+        else:
+            samples, wall = self.rolled_back(application, stream, users)
+            self.forget(users)
+        results = self.summarize(samples, wall)
+        results['meta'] = {
+            'input': options['input'] or 'synthetic',
+            'seed': options['seed'],
+            'debug': settings.DEBUG,
+            'database': connection.vendor,
+            'committed': options['commit'],
+        }
+
+        self.stdout.write(
+            f'{"route":<32} {"count":>6} {"req/s":>8} {"p50":>8} {"p95":>8} '
+            f'{"p99":>8} {"q mean":>7} {"q max":>6} {"5xx":>4}')
+        for name, route in results['routes'].items():
+            self.stdout.write(
+                f'{name:<32} {route["count"]:>6} {route["throughput"]:>8} '
+                f'{route["p50_ms"]:>8} {route["p95_ms"]:>8} '
+                f'{route["p99_ms"]:>8} {route["queries_mean"]:>7} '
+                f'{route["queries_max"]:>6} {route["errors"]:>4}')
+        self.stdout.write(
+            f'{results["requests"]} requests in {results["wall_seconds"]}s, '
+            f'{results["throughput"]} req/s')
+
+        if options['compare']:
+            self.compare(results, options['compare'])
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+                f.write('\n')
+
+    def rolled_back(self, application, stream, users):
+        # the handler would close the connection around every request,
+        # which ends the transaction; the test client unhooks it the same way
+        def attempt(pk):
+            # run_job minus the connection recycling
+            with transaction.atomic():
+                attempt_job(pk)
+
+        request_started.disconnect(close_old_connections)
+        request_finished.disconnect(close_old_connections)
+        try:
+            with transaction.atomic():
+                result = self.replay(application, stream, users, attempt)
+                transaction.set_rollback(True)
+        finally:
+            request_started.connect(close_old_connections)
+            request_finished.connect(close_old_connections)
+        return result
+
+    def forget(self, users):
+        # the rollback cannot reach the cache. A per-process cache only ever
+        # served this replay, so it goes as a whole; a shared one serves the
+        # site, so only the keys of the load test users are dropped from it
+        if not settings.CACHE_SHARED:
+            cache.clear()
+            return
+        for user in users:
+            invalidate_cart_count(user)
+            invalidate_default_addresses(user.pk)
+
+    def compare(self, results, path):
+        with open(path) as f:
+            before = json.load(f)
+
+        def delta(old, new):
+            if not old:
+                return '   n/a'
+            return f'{(new - old) / old * 100:+6.1f}%'
+
+        self.stdout.write(f'\nchange against {path}')
+        self.stdout.write(
+            f'{"route":<32} {"p50":>8} {"p95":>8} {"q mean":>8}')
+        for name, route in results['routes'].items():
+            old = before['routes'].get(name)
+            if old is None:
+                self.stdout.write(f'{name:<32} new')
+                continue
+            self.stdout.write(
+                f'{name:<32} {delta(old["p50_ms"], route["p50_ms"]):>8} '
+                f'{delta(old["p95_ms"], route["p95_ms"]):>8} '
+                f'{delta(old["queries_mean"], route["queries_mean"]):>8}')
@@ -0,0 +1,57 @@
+import json
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from core.timing import load_counters, load_timings, summarize
+
+
+def fmt_bound(bound):
+    return '>max' if bound is None else str(bound)
+
+
+class Command(BaseCommand):
+    help = 'Dump the per-route query and timing histograms of the web processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--minutes', type=int,
+                            help='Only windows from the last N minutes')
+        parser.add_argument('--json', action='store_true',
+                            help='Print the full histograms as JSON')
+        parser.add_argument('--reset', action='store_true',
+                            help='Delete the snapshots after dumping them')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['minutes']:
+            since = time.time() - options['minutes'] * 60
+        summary = summarize(load_timings(since))
+
+        if options['json']:
+            self.stdout.write(json.dumps(summary, indent=2))
+        else:
+            self.stdout.write(
+                f'{"route":<32} {"count":>7} {"view avg":>9} {"p50":>6} '
+                f'{"p95":>6} {"p99":>6} {"db avg":>8} {"tpl avg":>8} '
+                f'{"q avg":>6} {"q p95":>6} {"q max":>6}')
+            for row in summary:
+                self.stdout.write(
+                    f'{row["route"]:<32} {row["count"]:>7} '
+                    f'{row["view_avg"]:>9.1f} {fmt_bound(row["view_p50"]):>6} '
+                    f'{fmt_bound(row["view_p95"]):>6} '
+                    f'{fmt_bound(row["view_p99"]):>6} '
+                    f'{row["db_avg"]:>8.1f} {row["template_avg"]:>8.1f} '
+                    f'{row["queries_avg"]:>6.1f} '
+                    f'{fmt_bound(row["queries_p95"]):>6} '
+                    f'{row["queries_max"]:>6}')
+            stats = load_counters('catalog_cache')
+            self.stdout.write(
+                f'catalog cache: {stats.get("hits", 0)} hits, '
+                f'{stats.get("misses", 0)} misses')
+
+        if options['reset']:
+            directory = settings.REQUEST_TIMING_DIR
+            if os.path.isdir(directory):
+                for filename in os.listdir(directory):
+                    os.remove(os.path.join(directory, filename))
@@ -0,0 +1,173 @@
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils._os import safe_join
+from django.utils.http import http_date, parse_http_date_safe
+from django.views.decorators.http import require_safe
+
+
+MEDIA_MAX_AGE = 60 * 60 * 24 * 365
+MEDIA_REVALIDATE = 'public, max-age=0, must-revalidate'
+MEDIA_IMMUTABLE = f'public, max-age={MEDIA_MAX_AGE}, immutable'
+DIGEST_CACHE_SIZE = 4096
+# read size when the server has no file_wrapper to hand the file to
+MEDIA_BLOCK_SIZE = 64 * 1024
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+_digests = {}
+_digests_lock = threading.Lock()
+
+
+def file_digest(path, stat=None):
+    # sha1 of the bytes, recomputed only when size or mtime move
+    stat = stat or os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = _digests.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+    digest = digest.hexdigest()
+    with _digests_lock:
+        if len(_digests) >= DIGEST_CACHE_SIZE:
+            _digests.clear()
+        _digests[path] = (key, digest)
+    return digest
+
+
+def media_url(name):
+    # the version pins the URL to the file's content, which is what lets
+    # the response be cached as immutable
+    try:
+        digest = file_digest(safe_join(settings.MEDIA_ROOT, name))
+    except (OSError, ValueError):
+        return settings.MEDIA_URL + name
+    return f'{settings.MEDIA_URL}{name}?v={digest[:12]}'
+
+
+class RangeFile:
+    # a window onto an open file: read() stops at the end of the range, while
+    # fileno() and tell() let a sendfile-capable file_wrapper go zero-copy
+    # using the Content-Length as the count
+
+    def __init__(self, f, start, length):
+        self.file = f
+        self.remaining = length
+        f.seek(start)
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+def parse_range(header, size):
+    # a single byte range as (start, end) inclusive; None means serve the
+    # whole file, False means unsatisfiable. A malformed header, such as a
+    # last byte before the first, is ignored (RFC 7233 section 3.1)
+    match = RANGE_RE.match(header.replace(' ', ''))
+    if not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if first and last and int(last) < int(first):
+        return None
+    # an empty file has no byte any range could select
+    if not size:
+        return False
+    if not first:
+        length = int(last)
+        if not length:
+            return False
+        return max(0, size - length), size - 1
+    start = int(first)
+    if start >= size:
+        return False
+    end = min(int(last), size - 1) if last else size - 1
+    return start, end
+
+
+def etag_matches(header, etag):
+    if header.strip() == '*':
+        return True
+    return etag in (tag.strip() for tag in header.split(','))
+
+
+def with_headers(response, headers):
+    for header, value in headers.items():
+        response[header] = value
+    return response
+
+
+@require_safe
+def serve_media(request, path):
+    try:
+        fullpath = safe_join(settings.MEDIA_ROOT, path)
+        stat = os.stat(fullpath)
+    except (OSError, ValueError):
+        raise Http404('Media file not found')
+    if not os.path.isfile(fullpath):
+        raise Http404('Media file not found')
+
+    digest = file_digest(fullpath, stat)
+    etag = f'"{digest[:32]}"'
+    versioned = request.GET.get('v') == digest[:12]
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(stat.st_mtime),
+        'Cache-Control': MEDIA_IMMUTABLE if versioned else MEDIA_REVALIDATE,
+        'Accept-Ranges': 'bytes',
+    }
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if_modified_since = parse_http_date_safe(
+        request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    if (if_none_match and etag_matches(if_none_match, etag)) or (
+            not if_none_match and if_modified_since and
+            int(stat.st_mtime) <= if_modified_since):
+        return with_headers(HttpResponse(status=304), headers)
+
+    size = stat.st_size
+    byte_range = None
+    range_header = request.META.get('HTTP_RANGE')
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if range_header and (not if_range or if_range.strip() == etag):
+        byte_range = parse_range(range_header, size)
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return with_headers(response, headers)
+
+    content_type = mimetypes.guess_type(fullpath)[0] or \
+        'application/octet-stream'
+    f = open(fullpath, 'rb')
+    if byte_range:
+        start, end = byte_range
+        response = FileResponse(
+            RangeFile(f, start, end - start + 1), status=206,
+            content_type=content_type)
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = end - start + 1
+    else:
+        response = FileResponse(f, content_type=content_type)
+        response['Content-Length'] = size
+    response.block_size = MEDIA_BLOCK_SIZE
+    return with_headers(response, headers)
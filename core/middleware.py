@@ -0,0 +1,61 @@
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+from django.utils.functional import empty
+from .timing import (RequestTiming, current, install_template_timer,
+                     record_query, store)
+
+
+def loaded_user(request):
+    # request.user is lazy: loading it here would cost the session and user
+    # queries, outside the timings, on every request that never needed it
+    user = getattr(request, 'user', None)
+    user = getattr(user, '_wrapped', user)
+    return None if user is empty else user
+
+
+class RequestTimingMiddleware:
+    # goes first in MIDDLEWARE so the timings cover every later layer
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        install_template_timer()
+
+    def __call__(self, request):
+        timing = RequestTiming()
+        token = current.set(timing)
+        start = time.perf_counter()
+        request._timing_view_start = None
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(
+                        connection.execute_wrapper(record_query))
+                response = self.get_response(request)
+        finally:
+            current.reset(token)
+        end = time.perf_counter()
+        view_start = request._timing_view_start or start
+        timing.view = end - view_start
+
+        # query counts and timings are for staff eyes only
+        user = loaded_user(request)
+        if settings.SERVER_TIMING_HEADER and user is not None and \
+                user.is_staff:
+            response['Server-Timing'] = ', '.join([
+                f'db;dur={timing.db * 1000:.1f};desc="{timing.queries} queries"',
+                f'tpl;dur={timing.template * 1000:.1f}',
+                f'view;dur={timing.view * 1000:.1f}',
+                f'total;dur={(end - start) * 1000:.1f}',
+            ])
+
+        match = getattr(request, 'resolver_match', None)
+        name = match.view_name if match and match.view_name else 'unresolved'
+        store.add(name, timing)
+        store.maybe_flush()
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._timing_view_start = time.perf_counter()
@@ -0,0 +1,40 @@
+from django.db import migrations, models
+
+
+def populate_order_totals(apps, schema_editor):
+    Order = apps.get_model('core', 'Order')
+    for order in Order.objects.select_related('cupon').iterator():
+        subtotal = 0
+        for order_item in order.items.select_related('item'):
+            price = order_item.item.discount_price or order_item.item.price
+            subtotal += order_item.quantity * price
+        discount = order.cupon.amount if order.cupon else 0
+        Order.objects.filter(pk=order.pk).update(
+            subtotal=subtotal, discount=discount, total=subtotal - discount)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='discount',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='subtotal',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='total',
+            field=models.FloatField(default=0),
+        ),
+        migrations.RunPython(populate_order_totals,
+                             migrations.RunPython.noop),
+    ]
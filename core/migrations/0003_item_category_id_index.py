@@ -0,0 +1,17 @@
+# Generated by Django 3.1.5 on 2026-10-18 16:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_order_totals'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(fields=['category', '-id'], name='core_item_category_id_idx'),
+        ),
+    ]
@@ -0,0 +1,79 @@
+import django.contrib.postgres.search
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# frozen copies of the statements core.search used when this migration was
+# written, so later changes to the app code can't alter it
+FTS_TABLE_SQL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS core_item_fts "
+    "USING fts5(title, description, tokenize='porter unicode61')"
+)
+FTS_INSERT_SQL = (
+    'INSERT INTO core_item_fts (rowid, title, description) VALUES (%s, %s, %s)'
+)
+GIN_INDEX_SQL = (
+    'CREATE INDEX IF NOT EXISTS core_item_search_document_idx '
+    'ON core_item_search USING GIN (document)'
+)
+DOCUMENT_INSERT_SQL = (
+    "INSERT INTO core_item_search (item_id, document) VALUES (%s, "
+    "setweight(to_tsvector('english', %s), 'A') || "
+    "setweight(to_tsvector('english', %s), 'B'))"
+)
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(FTS_TABLE_SQL)
+        insert_sql = FTS_INSERT_SQL
+    elif vendor == 'postgresql':
+        # the table is the ItemSearchDocument model created above
+        schema_editor.execute(GIN_INDEX_SQL)
+        insert_sql = DOCUMENT_INSERT_SQL
+    else:
+        # other databases fall back to an unindexed search
+        return
+
+    Item = apps.get_model('core', 'Item')
+    rows = Item.objects.values_list('pk', 'title', 'description')
+    chunk = []
+    with schema_editor.connection.cursor() as cursor:
+        for row in rows.iterator(chunk_size=1000):
+            chunk.append(row)
+            if len(chunk) == 1000:
+                cursor.executemany(insert_sql, chunk)
+                chunk = []
+        if chunk:
+            cursor.executemany(insert_sql, chunk)
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS core_item_fts')
+    elif vendor == 'postgresql':
+        schema_editor.execute(
+            'DROP INDEX IF EXISTS core_item_search_document_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_item_category_id_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ItemSearchDocument',
+            fields=[
+                ('item', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='core.item')),
+                ('document', django.contrib.postgres.search.SearchVectorField()),
+            ],
+            options={
+                'db_table': 'core_item_search',
+            },
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
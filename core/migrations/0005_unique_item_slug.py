@@ -0,0 +1,38 @@
+from django.db import migrations, models
+
+
+def dedupe_slugs(apps, schema_editor):
+    Item = apps.get_model('core', 'Item')
+    taken = set(Item.objects.values_list('slug', flat=True).distinct())
+    seen = set()
+    for item in Item.objects.order_by('pk').only('pk', 'slug').iterator():
+        if item.slug not in seen:
+            seen.add(item.slug)
+            continue
+        # the oldest row keeps the slug, later ones get a numeric suffix
+        suffix = 2
+        while True:
+            tail = f'-{suffix}'
+            slug = item.slug[:50 - len(tail)] + tail
+            if slug not in taken:
+                break
+            suffix += 1
+        taken.add(slug)
+        seen.add(slug)
+        Item.objects.filter(pk=item.pk).update(slug=slug)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_item_search_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_slugs, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='item',
+            name='slug',
+            field=models.SlugField(unique=True),
+        ),
+    ]
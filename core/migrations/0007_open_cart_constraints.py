@@ -0,0 +1,71 @@
+from django.db import migrations, models
+
+
+def recalculate_totals(order):
+    subtotal = 0
+    for order_item in order.items.select_related('item'):
+        price = order_item.item.discount_price or order_item.item.price
+        subtotal += order_item.quantity * price
+    discount = order.cupon.amount if order.cupon else 0
+    type(order).objects.filter(pk=order.pk).update(
+        subtotal=subtotal, discount=discount, total=subtotal - discount)
+
+
+def merge_open_carts(apps, schema_editor):
+    Order = apps.get_model('core', 'Order')
+    OrderItem = apps.get_model('core', 'OrderItem')
+    touched = set()
+
+    # fold any extra open orders into the user's oldest one
+    kept = {}
+    for order in Order.objects.filter(ordered=False).order_by('pk'):
+        if order.user_id not in kept:
+            kept[order.user_id] = order
+            continue
+        target = kept[order.user_id]
+        target.items.add(*order.items.all())
+        order.delete()
+        touched.add(target.pk)
+
+    # lines removed from a cart used to be left behind unattached
+    OrderItem.objects.filter(ordered=False, order__isnull=True).delete()
+
+    # merge duplicate open lines for the same item
+    lines = {}
+    for order_item in OrderItem.objects.filter(ordered=False).order_by('pk'):
+        key = (order_item.user_id, order_item.item_id)
+        if key not in lines:
+            lines[key] = order_item
+            continue
+        first = lines[key]
+        first.quantity += order_item.quantity
+        first.save(update_fields=['quantity'])
+        touched.update(Order.objects.filter(
+            items=order_item).values_list('pk', flat=True))
+        order_item.delete()
+
+    for order in Order.objects.filter(pk__in=touched):
+        recalculate_totals(order)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_item_updated_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_open_carts, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='order',
+            constraint=models.UniqueConstraint(
+                condition=models.Q(ordered=False), fields=('user',),
+                name='core_order_unique_open_cart'),
+        ),
+        migrations.AddConstraint(
+            model_name='orderitem',
+            constraint=models.UniqueConstraint(
+                condition=models.Q(ordered=False), fields=('user', 'item'),
+                name='core_orderitem_unique_open_line'),
+        ),
+    ]
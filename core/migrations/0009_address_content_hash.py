@@ -0,0 +1,50 @@
+import hashlib
+
+from django.db import migrations, models
+
+
+def address_hash(address, secondary_addrs, division, country, zip_code):
+    # a frozen copy of core.models.address_hash as of this migration
+    parts = [' '.join(str(part or '').split()).casefold()
+             for part in (address, secondary_addrs, division, country,
+                          zip_code)]
+    return hashlib.sha1('\x1f'.join(parts).encode()).hexdigest()
+
+
+def populate_hashes(apps, schema_editor):
+    Address = apps.get_model('core', 'Address')
+    addresses = Address.objects.order_by('pk')
+    last_pk = 0
+    while True:
+        chunk = list(addresses.filter(pk__gt=last_pk)[:1000])
+        if not chunk:
+            break
+        for address in chunk:
+            address.content_hash = address_hash(
+                address.address, address.secondary_addrs, address.division,
+                address.country, address.zip_code)
+        Address.objects.bulk_update(chunk, ['content_hash'])
+        last_pk = chunk[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_paymentjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='address',
+            name='content_hash',
+            field=models.CharField(default='', editable=False, max_length=40),
+            preserve_default=False,
+        ),
+        migrations.AddIndex(
+            model_name='address',
+            index=models.Index(
+                fields=['user', 'address_type', 'content_hash'],
+                name='core_address_lookup_idx'),
+        ),
+        migrations.RunPython(populate_hashes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,58 @@
+from django.db import migrations, models
+
+
+def dedupe_codes(apps, schema_editor):
+    Cupon = apps.get_model('core', 'Cupon')
+    taken = set(Cupon.objects.values_list('cupon', flat=True).distinct())
+    seen = set()
+    for cupon in Cupon.objects.order_by('pk').only('pk', 'cupon').iterator():
+        if cupon.cupon not in seen:
+            seen.add(cupon.cupon)
+            continue
+        # the oldest row keeps the code, later ones get a numeric suffix
+        suffix = 2
+        while True:
+            tail = f'-{suffix}'
+            code = cupon.cupon[:15 - len(tail)] + tail
+            if code not in taken:
+                break
+            suffix += 1
+        taken.add(code)
+        seen.add(code)
+        Cupon.objects.filter(pk=cupon.pk).update(cupon=code)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_address_default_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_codes, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='cupon',
+            name='cupon',
+            field=models.CharField(max_length=15, unique=True),
+        ),
+        migrations.AddField(
+            model_name='cupon',
+            name='valid_from',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='cupon',
+            name='valid_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='cupon',
+            name='max_uses',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='cupon',
+            name='times_used',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
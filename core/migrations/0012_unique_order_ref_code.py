@@ -0,0 +1,53 @@
+import random
+import string
+
+from django.db import migrations, models
+
+
+def new_code():
+    return ''.join(random.choices(string.ascii_lowercase + string.digits, k=20))
+
+
+def dedupe_ref_codes(apps, schema_editor):
+    Order = apps.get_model('core', 'Order')
+    # open carts never had a reference; store NULL so they do not collide
+    Order.objects.filter(ref_code='').update(ref_code=None)
+
+    taken = set(Order.objects.exclude(ref_code=None).values_list(
+        'ref_code', flat=True).distinct())
+    seen = set()
+    orders = Order.objects.exclude(ref_code=None).order_by('pk').only(
+        'pk', 'ref_code')
+    for order in orders.iterator():
+        if order.ref_code not in seen:
+            seen.add(order.ref_code)
+            continue
+        # the oldest order keeps the reference, later ones get a fresh one
+        code = new_code()
+        while code in taken:
+            code = new_code()
+        taken.add(code)
+        seen.add(code)
+        Order.objects.filter(pk=order.pk).update(ref_code=code)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_coupon_rules'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='order',
+            name='ref_code',
+            field=models.CharField(blank=True, max_length=20, null=True),
+        ),
+        migrations.RunPython(dedupe_ref_codes, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='order',
+            name='ref_code',
+            field=models.CharField(
+                blank=True, max_length=20, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,90 @@
+# Generated by Django 3.1.5 on 2026-10-18 17:18
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_unique_order_ref_code'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CategorySales',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('category', models.CharField(choices=[('S', 'Shirt'), ('SW', 'Sport Wear'), ('OW', 'Outwear')], max_length=2)),
+                ('orders', models.IntegerField(default=0)),
+                ('units', models.IntegerField(default=0)),
+                ('revenue', models.FloatField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CouponSales',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('orders', models.IntegerField(default=0)),
+                ('discount', models.FloatField(default=0)),
+                ('total', models.FloatField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DailySales',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(unique=True)),
+                ('orders', models.IntegerField(default=0)),
+                ('subtotal', models.FloatField(default=0)),
+                ('discount', models.FloatField(default=0)),
+                ('total', models.FloatField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ItemSales',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('orders', models.IntegerField(default=0)),
+                ('units', models.IntegerField(default=0)),
+                ('revenue', models.FloatField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RollupState',
+            fields=[
+                ('name', models.CharField(max_length=30, primary_key=True, serialize=False)),
+                ('high_water', models.DateTimeField(blank=True, null=True)),
+                ('refreshed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['timestamp'], name='core_payment_timestamp_idx'),
+        ),
+        migrations.AddField(
+            model_name='itemsales',
+            name='item',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.item'),
+        ),
+        migrations.AddField(
+            model_name='couponsales',
+            name='cupon',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.cupon'),
+        ),
+        migrations.AddConstraint(
+            model_name='categorysales',
+            constraint=models.UniqueConstraint(fields=('day', 'category'), name='core_categorysales_day_category'),
+        ),
+        migrations.AddConstraint(
+            model_name='itemsales',
+            constraint=models.UniqueConstraint(fields=('day', 'item'), name='core_itemsales_day_item'),
+        ),
+        migrations.AddConstraint(
+            model_name='couponsales',
+            constraint=models.UniqueConstraint(fields=('day', 'cupon'), name='core_couponsales_day_cupon'),
+        ),
+    ]
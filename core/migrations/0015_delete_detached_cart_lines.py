@@ -0,0 +1,20 @@
+from django.db import migrations
+
+
+def delete_detached_lines(apps, schema_editor):
+    # open lines whose cart order was deleted before the pre_delete signal
+    # existed; no order shows them and they block new lines for the item
+    OrderItem = apps.get_model('core', 'OrderItem')
+    OrderItem.objects.filter(ordered=False, order__isnull=True).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_sales_rollups'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_detached_lines,
+                             migrations.RunPython.noop),
+    ]
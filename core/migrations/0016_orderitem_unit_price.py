@@ -0,0 +1,30 @@
+from django.db import migrations, models
+from django.db.models import Case, F, OuterRef, Subquery, When
+
+
+def populate_unit_prices(apps, schema_editor):
+    # the price paid was never stored, so placed lines get the item's
+    # current price, the same figure the rollups used until now
+    Item = apps.get_model('core', 'Item')
+    OrderItem = apps.get_model('core', 'OrderItem')
+    price = Item.objects.filter(pk=OuterRef('item_id')).annotate(
+        unit_price=Case(When(discount_price__gt=0, then=F('discount_price')),
+                        default=F('price'))).values('unit_price')[:1]
+    OrderItem.objects.filter(ordered=True).update(unit_price=Subquery(price))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_delete_detached_cart_lines'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderitem',
+            name='unit_price',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.RunPython(populate_unit_prices,
+                             migrations.RunPython.noop),
+    ]
@@ -0,0 +1,78 @@
+import hashlib
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def address_hash(address, secondary_addrs, division, country, zip_code):
+    # a frozen copy of core.models.address_hash as of this migration
+    parts = [' '.join(str(part or '').split()).casefold()
+             for part in (address, secondary_addrs, division, country,
+                          zip_code)]
+    return hashlib.sha1('\x1f'.join(parts).encode()).hexdigest()
+
+
+def dedupe_addresses(apps, schema_editor):
+    Address = apps.get_model('core', 'Address')
+    Order = apps.get_model('core', 'Order')
+
+    # rows changed through .update() may carry a stale hash
+    addresses = Address.objects.order_by('pk')
+    last_pk = 0
+    while True:
+        chunk = list(addresses.filter(pk__gt=last_pk)[:1000])
+        if not chunk:
+            break
+        for address in chunk:
+            address.content_hash = address_hash(
+                address.address, address.secondary_addrs, address.division,
+                address.country, address.zip_code)
+        Address.objects.bulk_update(chunk, ['content_hash'])
+        last_pk = chunk[-1].pk
+
+    # the oldest row of each group stays, orders move over to it
+    groups = (Address.objects.values('user', 'address_type', 'content_hash')
+              .annotate(rows=Count('pk'), keep=Min('pk'))
+              .filter(rows__gt=1).order_by())
+    for group in groups:
+        duplicates = Address.objects.filter(
+            user=group['user'], address_type=group['address_type'],
+            content_hash=group['content_hash']).exclude(pk=group['keep'])
+        Order.objects.filter(shipping_address__in=duplicates).update(
+            shipping_address=group['keep'])
+        Order.objects.filter(billing_address__in=duplicates).update(
+            billing_address=group['keep'])
+        if duplicates.filter(default=True).exists():
+            Address.objects.filter(pk=group['keep']).update(default=True)
+        duplicates.delete()
+
+    # the oldest default is the one checkout has been showing
+    defaults = (Address.objects.filter(default=True)
+                .values('user', 'address_type')
+                .annotate(rows=Count('pk'), keep=Min('pk'))
+                .filter(rows__gt=1).order_by())
+    for group in defaults:
+        Address.objects.filter(
+            user=group['user'], address_type=group['address_type'],
+            default=True).exclude(pk=group['keep']).update(default=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0018_paymentjob_charge_id'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_addresses, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='address',
+            name='core_address_lookup_idx',
+        ),
+        migrations.AddConstraint(
+            model_name='address',
+            constraint=models.UniqueConstraint(
+                fields=('user', 'address_type', 'content_hash'),
+                name='core_address_unique_content'),
+        ),
+    ]
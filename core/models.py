@@ -1,7 +1,13 @@
+import hashlib
+
 from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.contrib.postgres.search import SearchVectorField
 from django.shortcuts import reverse
 from django_resized import ResizedImageField
 from django.db import models
+from django.db.models import F
+from django.utils import timezone
 from django_countries.fields import CountryField
 
 
@@ -20,7 +26,7 @@ LABEL_CHOICES = (
 
 class Item(models.Model):
     title = models.CharField(max_length=100)
-    slug = models.SlugField()
+    slug = models.SlugField(unique=True)
     img = ResizedImageField(size=[500, 500], crop=[
                             'middle', 'center'], upload_to='products')
     price = models.FloatField()
@@ -28,6 +34,14 @@ class Item(models.Model):
     discount_price = models.FloatField(blank=True, null=True)
     category = models.CharField(choices=CATEGORY_CHOICES, max_length=2)
     label = models.CharField(choices=LABEL_CHOICES, max_length=1)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # keyset pagination of category listings walks (category, id)
+            models.Index(fields=['category', '-id'],
+                         name='core_item_category_id_idx'),
+        ]
 
     def __str__(self):
         return self.title
@@ -35,6 +49,11 @@ class Item(models.Model):
     def get_absolute_url(self):
         return reverse("core:product", kwargs={"slug": self.slug})
 
+    def get_price(self):
+        if self.discount_price:
+            return self.discount_price
+        return self.price
+
     def get_absolute_category(self):
         return reverse("core:category-product", kwargs={"category": self.category})
 
@@ -45,12 +64,35 @@ class Item(models.Model):
         return reverse("core:remove-from-cart", kwargs={"slug": self.slug})
 
 
+class ItemSearchDocument(models.Model):
+    # the Postgres full-text index of core.search; a model, so flush, test
+    # truncation and Item deletes know about the table. Other databases
+    # keep it empty and use their own index
+    item = models.OneToOneField(Item, on_delete=models.CASCADE,
+                                primary_key=True)
+    document = SearchVectorField()
+
+    class Meta:
+        db_table = 'core_item_search'
+
+
 class OrderItem(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL,
                              on_delete=models.CASCADE)
     ordered = models.BooleanField(default=False)
     item = models.ForeignKey(Item, on_delete=models.CASCADE)
     quantity = models.IntegerField(default=1)
+    # the price the line was paid at, set when the order is placed; open
+    # cart lines follow the item's current price
+    unit_price = models.FloatField(blank=True, null=True)
+
+    class Meta:
+        constraints = [
+            # one cart line per item, so quantity changes can be UPDATEs
+            models.UniqueConstraint(
+                fields=['user', 'item'], condition=models.Q(ordered=False),
+                name='core_orderitem_unique_open_line'),
+        ]
 
     def __str__(self):
         return f'{self.quantity} of {self.item.title}'
@@ -64,7 +106,14 @@ class OrderItem(models.Model):
     def get_amount_saved(self):
         return self.get_total_item_price() - self.get_total_discount_item_price()
 
+    def get_unit_price(self):
+        if self.unit_price is not None:
+            return self.unit_price
+        return self.item.get_price()
+
     def get_final_price(self):
+        if self.unit_price is not None:
+            return self.quantity * self.unit_price
         if self.item.discount_price:
             return self.get_total_discount_item_price()
         else:
@@ -74,7 +123,8 @@ class OrderItem(models.Model):
 class Order(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL,
                              on_delete=models.CASCADE)
-    ref_code = models.CharField(max_length=20)
+    ref_code = models.CharField(
+        max_length=20, unique=True, blank=True, null=True)
     items = models.ManyToManyField(OrderItem)
     start_date = models.DateTimeField(auto_now_add=True)
     order_date = models.DateTimeField()
@@ -91,17 +141,53 @@ class Order(models.Model):
     received = models.BooleanField(default=False)
     refund_requested = models.BooleanField(default=False)
     refund_granted = models.BooleanField(default=False)
+    # denormalized cart totals, kept up to date by the cart views
+    subtotal = models.FloatField(default=0)
+    discount = models.FloatField(default=0)
+    total = models.FloatField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user'], condition=models.Q(ordered=False),
+                name='core_order_unique_open_cart'),
+        ]
 
     def __str__(self):
         return self.user.username
 
     def get_total(self):
-        total = 0
-        for order_item in self.items.all():
-            total += order_item.get_final_price()
-        if self.cupon:
-            total -= self.cupon.amount
-        return total
+        return self.total
+
+    def compute_totals(self):
+        subtotal = 0
+        for order_item in self.items.select_related('item'):
+            subtotal += order_item.get_final_price()
+        discount = 0
+        if self.cupon_id:
+            from .coupons import get_coupon_by_id
+            cupon = get_coupon_by_id(self.cupon_id)
+            discount = cupon.amount if cupon else 0
+        return subtotal, discount, subtotal - discount
+
+    def recalculate_totals(self):
+        self.subtotal, self.discount, self.total = self.compute_totals()
+        Order.objects.filter(pk=self.pk).update(
+            subtotal=self.subtotal, discount=self.discount, total=self.total)
+
+    def add_to_subtotal(self, amount):
+        Order.objects.filter(pk=self.pk).update(
+            subtotal=F('subtotal') + amount, total=F('total') + amount)
+        self.subtotal += amount
+        self.total += amount
+
+    def set_cupon(self, cupon):
+        self.cupon = cupon
+        self.discount = cupon.amount if cupon else 0
+        self.total = self.subtotal - self.discount
+        Order.objects.filter(pk=self.pk).update(
+            cupon=cupon, discount=self.discount,
+            total=F('subtotal') - self.discount)
 
 
 DIVISION_CHOICES = (
@@ -121,6 +207,14 @@ ADDRESS_CHOICES = (
 )
 
 
+def address_hash(address, secondary_addrs, division, country, zip_code):
+    # case and whitespace differences shouldn't make a new address row
+    parts = [' '.join(str(part or '').split()).casefold()
+             for part in (address, secondary_addrs, division, country,
+                          zip_code)]
+    return hashlib.sha1('\x1f'.join(parts).encode()).hexdigest()
+
+
 class Address(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL,
                              on_delete=models.CASCADE)
@@ -131,12 +225,43 @@ class Address(models.Model):
     zip_code = models.CharField(max_length=6)
     address_type = models.CharField(max_length=1, choices=ADDRESS_CHOICES)
     default = models.BooleanField(default=False)
+    content_hash = models.CharField(max_length=40, editable=False)
 
     def __str__(self):
         return self.user.username
 
+    def save(self, *args, **kwargs):
+        self.content_hash = self.compute_hash()
+        super().save(*args, **kwargs)
+
+    def compute_hash(self):
+        return address_hash(self.address, self.secondary_addrs,
+                            self.division, self.country, self.zip_code)
+
+    def clean(self):
+        # model forms don't check core_address_unique_content themselves,
+        # and content_hash isn't on the form to point it out
+        if self.user_id is None:
+            return
+        copies = Address.objects.filter(
+            user=self.user_id, address_type=self.address_type,
+            content_hash=self.compute_hash()).exclude(pk=self.pk)
+        if copies.exists():
+            raise ValidationError(
+                'This user already has the same address of this type.')
+
     class Meta:
         verbose_name_plural = 'Addresses'
+        indexes = [
+            models.Index(fields=['user', 'address_type', 'default'],
+                         name='core_address_default_idx'),
+        ]
+        constraints = [
+            # one row per distinct address, so checkout can get_or_create
+            models.UniqueConstraint(
+                fields=['user', 'address_type', 'content_hash'],
+                name='core_address_unique_content'),
+        ]
 
 
 class Payment(models.Model):
@@ -146,17 +271,73 @@ class Payment(models.Model):
     amount = models.FloatField()
     timestamp = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['timestamp'],
+                         name='core_payment_timestamp_idx'),
+        ]
+
     def __str__(self):
         return self.user.username
 
 
+PAYMENT_JOB_STATUS_CHOICES = (
+    ('P', 'Pending'),
+    ('R', 'Running'),
+    ('S', 'Succeeded'),
+    ('F', 'Failed')
+)
+# a job in one of these may still charge the card
+PAYMENT_JOB_ACTIVE = ('P', 'R')
+
+
+class PaymentJob(models.Model):
+    order = models.ForeignKey(Order, on_delete=models.CASCADE)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                             on_delete=models.CASCADE)
+    token = models.CharField(max_length=255, blank=True)
+    amount = models.FloatField()
+    idempotency_key = models.CharField(max_length=64, unique=True)
+    status = models.CharField(
+        choices=PAYMENT_JOB_STATUS_CHOICES, max_length=1, default='P')
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    # the gateway's charge, recorded before the order is placed with it
+    charge_id = models.CharField(max_length=50, blank=True)
+    payment = models.ForeignKey(
+        Payment, on_delete=models.SET_NULL, blank=True, null=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'id'],
+                         name='core_paymentjob_queue_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.pk} ({self.get_status_display()})'
+
+
 class Cupon(models.Model):
-    cupon = models.CharField(max_length=15)
+    cupon = models.CharField(max_length=15, unique=True)
     amount = models.FloatField()
+    valid_from = models.DateTimeField(blank=True, null=True)
+    valid_until = models.DateTimeField(blank=True, null=True)
+    max_uses = models.PositiveIntegerField(blank=True, null=True)
+    times_used = models.PositiveIntegerField(default=0, editable=False)
 
     def __str__(self):
         return self.cupon
 
+    def is_valid(self, now=None):
+        now = now or timezone.now()
+        if self.valid_from and now < self.valid_from:
+            return False
+        if self.valid_until and now > self.valid_until:
+            return False
+        return self.max_uses is None or self.times_used < self.max_uses
+
 
 class Refund(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE)
@@ -166,3 +347,85 @@ class Refund(models.Model):
 
     def __str__(self):
         return f'{self.pk}'
+
+
+class RollupState(models.Model):
+    # how far the rollups below have read Payment.timestamp
+    name = models.CharField(max_length=30, primary_key=True)
+    high_water = models.DateTimeField(blank=True, null=True)
+    refreshed_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return self.name
+
+
+class CacheVersion(models.Model):
+    # the numbers behind the versioned cache keys (core.caching); the cache
+    # only holds a copy, so an evicted or expired key comes back unchanged
+    name = models.CharField(max_length=30, primary_key=True)
+    version = models.BigIntegerField()
+
+    def __str__(self):
+        return self.name
+
+
+class DailySales(models.Model):
+    day = models.DateField(unique=True)
+    orders = models.IntegerField(default=0)
+    subtotal = models.FloatField(default=0)
+    discount = models.FloatField(default=0)
+    total = models.FloatField(default=0)
+
+    def __str__(self):
+        return f'{self.day}'
+
+
+class CategorySales(models.Model):
+    day = models.DateField()
+    category = models.CharField(choices=CATEGORY_CHOICES, max_length=2)
+    orders = models.IntegerField(default=0)
+    units = models.IntegerField(default=0)
+    revenue = models.FloatField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'category'],
+                                    name='core_categorysales_day_category'),
+        ]
+
+    def __str__(self):
+        return f'{self.day} {self.category}'
+
+
+class ItemSales(models.Model):
+    day = models.DateField()
+    item = models.ForeignKey(Item, on_delete=models.CASCADE)
+    orders = models.IntegerField(default=0)
+    units = models.IntegerField(default=0)
+    revenue = models.FloatField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'item'],
+                                    name='core_itemsales_day_item'),
+        ]
+
+    def __str__(self):
+        return f'{self.day} {self.item_id}'
+
+
+class CouponSales(models.Model):
+    day = models.DateField()
+    cupon = models.ForeignKey(Cupon, on_delete=models.CASCADE)
+    orders = models.IntegerField(default=0)
+    discount = models.FloatField(default=0)
+    total = models.FloatField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'cupon'],
+                                    name='core_couponsales_day_cupon'),
+        ]
+
+    def __str__(self):
+        return f'{self.day} {self.cupon_id}'
@@ -0,0 +1,318 @@
+import hashlib
+import random
+import string
+import time
+import uuid
+from datetime import timedelta
+
+import stripe
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import Case, F, OuterRef, Subquery, When
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from .cart import invalidate_cart_count
+from .coupons import redeem_coupon, release_coupon
+from .models import (PAYMENT_JOB_ACTIVE, Item, Order, OrderItem, Payment,
+                     PaymentJob)
+
+stripe.api_key = settings.STRIPE_SECRET_KEY
+
+
+REF_CODE_ATTEMPTS = 5
+# charged amounts are compared to the float order totals within a cent
+AMOUNT_TOLERANCE = 0.005
+# what each line is paid at when the order is placed; same rule as
+# Item.get_price
+PLACED_UNIT_PRICE = Subquery(Item.objects.filter(
+    pk=OuterRef('item_id')).annotate(unit_price=Case(
+        When(discount_price__gt=0, then=F('discount_price')),
+        default=F('price'))).values('unit_price')[:1])
+
+
+def create_ref_code():
+    return ''.join(random.choices(string.ascii_lowercase + string.digits, k=20))
+
+
+class PaymentError(Exception):
+    def __init__(self, message, retry=False):
+        super().__init__(message)
+        self.message = message
+        self.retry = retry
+
+
+class StripeGateway:
+    def charge(self, amount, token, idempotency_key):
+        try:
+            charge = stripe.Charge.create(
+                amount=amount,
+                currency="usd",
+                source=token,
+                idempotency_key=idempotency_key
+            )
+            return charge['id']
+
+        except stripe.error.CardError as e:
+            # Since it's a decline, stripe.error.CardError will be caught
+            raise PaymentError(f'{e.error.message}')
+
+        except stripe.error.RateLimitError:
+            # Too many requests made to the API too quickly
+            raise PaymentError('Rate limit error', retry=True)
+
+        except stripe.error.InvalidRequestError:
+            # Invalid parameters were supplied to Stripe's API
+            raise PaymentError('Invalid parameters')
+
+        except stripe.error.AuthenticationError:
+            # Authentication with Stripe's API failed
+            # (maybe you changed API keys recently)
+            raise PaymentError('Not authenticated')
+
+        except stripe.error.APIConnectionError:
+            # Network communication with Stripe failed
+            raise PaymentError('Network error', retry=True)
+
+        except stripe.error.StripeError:
+            raise PaymentError(
+                'Something went wrong. You were not charged. Pleage try again.')
+
+    def refund(self, charge_id):
+        try:
+            stripe.Refund.create(charge=charge_id)
+        except stripe.error.StripeError as e:
+            raise PaymentError(str(e))
+
+
+class FakeGateway:
+    # stands in for Stripe when load testing: a fixed round-trip latency,
+    # random declines, and idempotent replays like the real API
+
+    def __init__(self, latency=None, failure_rate=None):
+        self.latency = settings.FAKE_GATEWAY_LATENCY \
+            if latency is None else latency
+        self.failure_rate = settings.FAKE_GATEWAY_FAILURE_RATE \
+            if failure_rate is None else failure_rate
+        self.charges = {}
+        self.refunds = set()
+
+    def charge(self, amount, token, idempotency_key):
+        time.sleep(self.latency)
+        if idempotency_key in self.charges:
+            return self.charges[idempotency_key]
+        if random.random() < self.failure_rate:
+            raise PaymentError('Your card was declined.')
+        charge_id = f'ch_fake_{uuid.uuid4().hex[:24]}'
+        self.charges[idempotency_key] = charge_id
+        return charge_id
+
+    def refund(self, charge_id):
+        time.sleep(self.latency)
+        self.refunds.add(charge_id)
+
+
+_gateway = None
+
+
+def get_gateway():
+    global _gateway
+    if _gateway is None:
+        _gateway = import_string(settings.PAYMENT_GATEWAY)()
+    return _gateway
+
+
+def set_gateway(gateway):
+    global _gateway
+    _gateway = gateway
+
+
+def enqueue_payment(order, user, token):
+    # one queued or running job per order. The order row is locked first,
+    # so a double submit finds the first job instead of queueing another;
+    # returns the job and whether it was created
+    with transaction.atomic():
+        Order.objects.filter(pk=order.pk).update(total=F('total'))
+        jobs = list(PaymentJob.objects.filter(order=order).order_by('pk'))
+        for job in jobs:
+            if job.status in PAYMENT_JOB_ACTIVE:
+                return job, False
+        total = Order.objects.values_list('total', flat=True).get(pk=order.pk)
+        # the key names the order, its total and the attempt, not the card
+        # token: a new token must not make a second charge for the same cart
+        key = hashlib.sha256(
+            f'{order.pk}:{total:.2f}:{len(jobs)}'.encode()).hexdigest()
+        job = PaymentJob.objects.create(
+            order=order, user=user, token=token or '', amount=total,
+            idempotency_key=key)
+        return job, True
+
+
+def place_order(order, amount=None):
+    # ref_code is unique; on the rare collision draw another one, inside a
+    # savepoint so the surrounding transaction survives the failed UPDATE
+    orders = Order.objects.filter(pk=order.pk, ordered=False)
+    if amount is not None:
+        # only the cart that was charged gets placed
+        orders = orders.filter(total__gt=amount - AMOUNT_TOLERANCE,
+                               total__lt=amount + AMOUNT_TOLERANCE)
+    for _ in range(REF_CODE_ATTEMPTS):
+        try:
+            with transaction.atomic():
+                return orders.update(ordered=True, ref_code=create_ref_code())
+        except IntegrityError:
+            continue
+    raise PaymentError('Could not assign an order reference.')
+
+
+def finalize_order(order, user, charge_id, amount):
+    # one transaction and a fixed number of statements however big the cart
+    with transaction.atomic():
+        # the conditional UPDATE row-locks the order like select_for_update,
+        # and being a write it also serializes SQLite, where FOR UPDATE is
+        # a no-op and a read-then-write transaction can deadlock
+        placed = place_order(order, amount)
+        if not placed:
+            if Order.objects.filter(pk=order.pk, ordered=True).exists():
+                raise PaymentError('This order has already been placed.')
+            raise PaymentError(
+                'Your cart changed while the payment was processing.')
+
+        payment = Payment.objects.create(
+            stripe_charge_id=charge_id, user=user, amount=amount)
+        OrderItem.objects.filter(order=order).update(
+            ordered=True, unit_price=PLACED_UNIT_PRICE)
+        Order.objects.filter(pk=order.pk).update(payment=payment)
+    # this runs on the payment worker; the web processes only see it
+    # through a shared cache (see CACHE_SHARED in settings)
+    invalidate_cart_count(user)
+    return payment
+
+
+def refund_charge(charge_id, reason):
+    # a charge whose order could not be placed is handed straight back;
+    # returns the message the job fails with
+    try:
+        get_gateway().refund(charge_id)
+    except PaymentError as e:
+        return (f'{reason} Refunding charge {charge_id} failed ({e.message}), '
+                f'please contact us.')
+    return f'{reason} Your payment was refunded.'
+
+
+def charge_payment(order, charge_id):
+    # the payment the order was placed with, if it was this charge
+    return Payment.objects.filter(
+        order=order, order__ordered=True, stripe_charge_id=charge_id).first()
+
+
+def fail_job(job, message):
+    PaymentJob.objects.filter(pk=job.pk).update(
+        status='F', error=message, token='', updated=timezone.now())
+
+
+def succeed_job(job, payment):
+    PaymentJob.objects.filter(pk=job.pk).update(
+        status='S', payment=payment, token='', error='',
+        updated=timezone.now())
+
+
+def process_job(job):
+    order = job.order
+    if order.ordered:
+        # an earlier attempt of this same job may have placed it and died
+        # before saying so; any other charge placed it for another job
+        payment = job.charge_id and charge_payment(order, job.charge_id)
+        if payment:
+            return succeed_job(job, payment)
+        return fail_job(job, 'This order has already been placed.')
+    if abs(order.get_total() - job.amount) >= AMOUNT_TOLERANCE:
+        # never charge an amount the cart no longer adds up to
+        return fail_job(job, 'Your cart changed while the payment was queued.')
+
+    # take a use of the coupon before charging; it is handed back unless
+    # the order gets placed
+    if order.cupon_id and not redeem_coupon(order.cupon_id):
+        return fail_job(job, 'Your cupon is no longer valid.')
+    placed = False
+    try:
+        try:
+            # round, not int(): 19.99 * 100 is 1998.9999999999998
+            charge_id = get_gateway().charge(
+                round(job.amount * 100), job.token, job.idempotency_key)
+        except PaymentError as e:
+            if e.retry and job.attempts < settings.PAYMENT_MAX_ATTEMPTS:
+                PaymentJob.objects.filter(pk=job.pk).update(
+                    status='P', error=e.message, updated=timezone.now())
+            else:
+                fail_job(job, e.message)
+            return
+        PaymentJob.objects.filter(pk=job.pk).update(charge_id=charge_id)
+
+        try:
+            payment = finalize_order(order, job.user, charge_id, job.amount)
+            placed = True
+        except PaymentError as e:
+            # a requeued job replays the same charge, and the attempt it was
+            # requeued from may already have placed the order with it
+            payment = charge_payment(order, charge_id)
+            if payment is None:
+                return fail_job(job, refund_charge(charge_id, e.message))
+        except Exception:
+            # e.g. the database was locked. The next attempt replays the
+            # same charge, but after the last one nothing would, so the
+            # charge is handed back unless the order got placed with it
+            payment = charge_payment(order, charge_id)
+            if payment is None:
+                if job.attempts < settings.PAYMENT_MAX_ATTEMPTS:
+                    raise
+                return fail_job(job, refund_charge(
+                    charge_id, 'Your order could not be placed.'))
+            placed = True
+    finally:
+        if order.cupon_id and not placed:
+            release_coupon(order.cupon_id)
+    succeed_job(job, payment)
+
+
+def claim_jobs(limit):
+    # a conditional UPDATE per job, so competing workers never share one
+    pending = PaymentJob.objects.filter(status='P').order_by('pk')
+    claimed = []
+    for pk in pending.values_list('pk', flat=True)[:limit]:
+        if PaymentJob.objects.filter(pk=pk, status='P').update(
+                status='R', attempts=F('attempts') + 1,
+                updated=timezone.now()):
+            claimed.append(pk)
+    return claimed
+
+
+def attempt_job(pk):
+    job = None
+    try:
+        job = PaymentJob.objects.select_related('order', 'user').get(pk=pk)
+        process_job(job)
+    except Exception as e:
+        # e.g. a lock timeout while finalizing; running the job again is
+        # safe because the gateway replays the charge for the same key
+        retry = job and job.attempts < settings.PAYMENT_MAX_ATTEMPTS
+        status = 'P' if retry else 'F'
+        PaymentJob.objects.filter(pk=pk).update(
+            status=status, error=f'Unexpected error: {e}',
+            updated=timezone.now())
+
+
+def run_job(pk):
+    # worker threads recycle their connection around every job
+    close_old_connections()
+    try:
+        attempt_job(pk)
+    finally:
+        close_old_connections()
+
+
+def requeue_stale_jobs(seconds):
+    # jobs left running by a worker that died; the idempotency key makes
+    # a second charge attempt safe
+    cutoff = timezone.now() - timedelta(seconds=seconds)
+    return PaymentJob.objects.filter(status='R', updated__lt=cutoff).update(
+        status='P', updated=timezone.now())
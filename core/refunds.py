@@ -0,0 +1,48 @@
+from django.db import transaction
+from .models import Order, Refund
+
+
+REFUND_CHUNK_SIZE = 500
+
+
+def request_refund(ref_code, email, reason):
+    # the unique index on ref_code makes this a single index probe
+    order = Order.objects.filter(ref_code=ref_code, ordered=True).only(
+        'pk').first()
+    if order is None:
+        return None
+    with transaction.atomic():
+        Order.objects.filter(pk=order.pk).update(refund_requested=True)
+        return Refund.objects.create(order=order, email=email, reason=reason)
+
+
+def grant_refunds(order_pks, chunk_size=REFUND_CHUNK_SIZE):
+    # the order flags and the Refund rows of a chunk change together or
+    # not at all; short transactions keep the lock window small
+    order_pks = list(order_pks)
+    granted = 0
+    for start in range(0, len(order_pks), chunk_size):
+        chunk = order_pks[start:start + chunk_size]
+        with transaction.atomic():
+            granted += Order.objects.filter(pk__in=chunk).update(
+                refund_requested=False, refund_granted=True)
+            Refund.objects.filter(order__in=chunk, accepted=False).update(
+                accepted=True)
+    return granted
+
+
+def grant_pending_refunds(chunk_size=REFUND_CHUNK_SIZE, limit=None):
+    # walk the orders with an unaccepted refund by keyset, one chunk at a time
+    pending = Refund.objects.filter(accepted=False).order_by(
+        'order_id').values_list('order_id', flat=True).distinct()
+    granted = 0
+    last_pk = 0
+    while limit is None or granted < limit:
+        size = chunk_size if limit is None else min(
+            chunk_size, limit - granted)
+        chunk = list(pending.filter(order_id__gt=last_pk)[:size])
+        if not chunk:
+            break
+        granted += grant_refunds(chunk, chunk_size)
+        last_pk = chunk[-1]
+    return granted
@@ -0,0 +1,140 @@
+from datetime import datetime, time as dt_time, timedelta
+
+from django.db import transaction
+from django.db.models import Count, F, FloatField, Max, Min, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from .models import (CategorySales, CouponSales, DailySales, ItemSales, Order,
+                     OrderItem, Payment, RollupState)
+
+
+ROLLUP_NAME = 'sales'
+ROLLUP_DAYS_PER_CHUNK = 7
+# a payment is timestamped before its transaction commits, so each refresh
+# goes back this far behind the last high-water mark to catch stragglers
+ROLLUP_OVERLAP = timedelta(minutes=15)
+ROLLUP_MODELS = (DailySales, CategorySales, ItemSales, CouponSales)
+
+# at the price each line was paid, so a later price change never rewrites
+# the days already rolled up
+LINE_REVENUE = Sum(F('quantity') * F('unit_price'), output_field=FloatField())
+
+
+def parse_date(value):
+    # YYYY-MM-DD, the days the rollups are keyed by; None when empty,
+    # ValueError on anything else
+    if not value:
+        return None
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def day_start(day):
+    return timezone.make_aware(datetime.combine(day, dt_time.min))
+
+
+def paid_orders(first, end):
+    # placed orders whose payment falls on the days [first, end)
+    return Order.objects.filter(
+        ordered=True, payment__timestamp__gte=day_start(first),
+        payment__timestamp__lt=day_start(end)).annotate(
+        day=TruncDate('payment__timestamp')).order_by()
+
+
+def paid_lines(first, end):
+    return OrderItem.objects.filter(
+        order__ordered=True, order__payment__timestamp__gte=day_start(first),
+        order__payment__timestamp__lt=day_start(end)).annotate(
+        day=TruncDate('order__payment__timestamp')).order_by()
+
+
+def build_rollups(first, end):
+    # every aggregate is a single GROUP BY, whatever the number of orders
+    daily = paid_orders(first, end).values('day').annotate(
+        orders=Count('pk'), subtotal=Sum('subtotal'),
+        discount=Sum('discount'), total=Sum('total'))
+    coupons = paid_orders(first, end).filter(cupon__isnull=False).values(
+        'day', 'cupon_id').annotate(
+        orders=Count('pk'), discount=Sum('discount'), total=Sum('total'))
+    categories = paid_lines(first, end).values(
+        'day', category=F('item__category')).annotate(
+        orders=Count('order', distinct=True), units=Sum('quantity'),
+        revenue=LINE_REVENUE)
+    items = paid_lines(first, end).values('day', 'item_id').annotate(
+        orders=Count('order', distinct=True), units=Sum('quantity'),
+        revenue=LINE_REVENUE)
+    return {
+        DailySales: [DailySales(**row) for row in daily],
+        CategorySales: [CategorySales(**row) for row in categories],
+        ItemSales: [ItemSales(**row) for row in items],
+        CouponSales: [CouponSales(**row) for row in coupons],
+    }
+
+
+def rebuild_days(first, end, batch_size=1000):
+    # whole days are replaced, so running the same range twice is harmless
+    rows = build_rollups(first, end)
+    for model in ROLLUP_MODELS:
+        model.objects.filter(day__gte=first, day__lt=end).delete()
+        model.objects.bulk_create(rows[model], batch_size=batch_size)
+    return sum(len(built) for built in rows.values())
+
+
+def refresh_rollups(since=None, full=False,
+                    days_per_chunk=ROLLUP_DAYS_PER_CHUNK):
+    RollupState.objects.get_or_create(name=ROLLUP_NAME)
+    state = RollupState.objects.get(name=ROLLUP_NAME)
+    # taken up front; payments stamped after it are left for the next run
+    high_water = Payment.objects.aggregate(last=Max('timestamp'))['last']
+    if high_water is None:
+        return 0
+
+    if since is not None:
+        first = since
+    elif full or state.high_water is None:
+        first = timezone.localdate(
+            Payment.objects.aggregate(first=Min('timestamp'))['first'])
+    else:
+        first = timezone.localdate(state.high_water - ROLLUP_OVERLAP)
+    last = timezone.localdate(high_water)
+
+    days = 0
+    while first <= last:
+        end = min(first + timedelta(days=days_per_chunk),
+                  last + timedelta(days=1))
+        with transaction.atomic():
+            # one refresher at a time; the mark moves with each chunk so an
+            # interrupted backfill resumes where it stopped
+            RollupState.objects.select_for_update().get(name=ROLLUP_NAME)
+            rebuild_days(first, end)
+            RollupState.objects.filter(name=ROLLUP_NAME).update(
+                high_water=min(high_water, day_start(end)),
+                refreshed_at=timezone.now())
+        days += (end - first).days
+        first = end
+    return days
+
+
+def sales_report(first, last, top=20):
+    # reads the rollup tables only, never the orders behind them
+    days = {'day__gte': first, 'day__lte': last}
+    daily = list(DailySales.objects.filter(**days).order_by('day'))
+    totals = DailySales.objects.filter(**days).aggregate(
+        orders=Sum('orders'), subtotal=Sum('subtotal'),
+        discount=Sum('discount'), total=Sum('total'))
+    categories = list(CategorySales.objects.filter(**days).values(
+        'category').annotate(orders=Sum('orders'), units=Sum('units'),
+                             revenue=Sum('revenue')).order_by('-revenue'))
+    items = list(ItemSales.objects.filter(**days).values(
+        'item_id', 'item__title', 'item__slug').annotate(
+        orders=Sum('orders'), units=Sum('units'),
+        revenue=Sum('revenue')).order_by('-revenue')[:top])
+    coupons = list(CouponSales.objects.filter(**days).values(
+        'cupon__cupon').annotate(orders=Sum('orders'),
+                                 discount=Sum('discount'),
+                                 total=Sum('total')).order_by('-orders'))
+    state = RollupState.objects.filter(name=ROLLUP_NAME).first()
+    return {
+        'first': first, 'last': last, 'daily': daily, 'totals': totals,
+        'categories': categories, 'items': items, 'coupons': coupons,
+        'high_water': state.high_water if state else None,
+    }
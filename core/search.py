@@ -0,0 +1,178 @@
+import re
+
+from django.db import connection, transaction
+from django.db.models import Q
+from .models import Item
+
+
+SEARCH_PAGE_SIZE = 12
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+class SqliteSearchBackend:
+    table = 'core_item_fts'
+
+    def create_sql(self):
+        return [
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.table} "
+            f"USING fts5(title, description, tokenize='porter unicode61')",
+        ]
+
+    def drop_sql(self):
+        return [f'DROP TABLE IF EXISTS {self.table}']
+
+    def index(self, cursor, rows):
+        cursor.executemany(
+            f'DELETE FROM {self.table} WHERE rowid = %s',
+            [(pk,) for pk, title, description in rows])
+        cursor.executemany(
+            f'INSERT INTO {self.table} (rowid, title, description) '
+            f'VALUES (%s, %s, %s)', rows)
+
+    def remove(self, cursor, pk):
+        cursor.execute(f'DELETE FROM {self.table} WHERE rowid = %s', [pk])
+
+    def prune(self, cursor):
+        cursor.execute(f'DELETE FROM {self.table} WHERE rowid NOT IN '
+                       f'(SELECT id FROM core_item)')
+
+    def search(self, cursor, query, limit, offset):
+        words = WORD_RE.findall(query)
+        if not words:
+            return []
+        # quote every word so user input can't inject FTS5 syntax
+        match = ' '.join(f'"{word}"*' for word in words)
+        cursor.execute(
+            f'SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s '
+            f'ORDER BY bm25({self.table}, 10.0, 1.0) LIMIT %s OFFSET %s',
+            [match, limit, offset])
+        return [row[0] for row in cursor.fetchall()]
+
+
+class PostgresSearchBackend:
+    table = 'core_item_search'
+    document = ("setweight(to_tsvector('english', %s), 'A') || "
+                "setweight(to_tsvector('english', %s), 'B')")
+
+    # the table is the ItemSearchDocument model; only the GIN index, which
+    # other databases can't create, lives outside the model
+    def create_sql(self):
+        return [
+            f'CREATE INDEX IF NOT EXISTS {self.table}_document_idx '
+            f'ON {self.table} USING GIN (document)',
+        ]
+
+    def drop_sql(self):
+        return [f'DROP INDEX IF EXISTS {self.table}_document_idx']
+
+    def index(self, cursor, rows):
+        cursor.executemany(
+            f'INSERT INTO {self.table} (item_id, document) '
+            f'VALUES (%s, {self.document}) ON CONFLICT (item_id) '
+            f'DO UPDATE SET document = EXCLUDED.document', rows)
+
+    def remove(self, cursor, pk):
+        cursor.execute(f'DELETE FROM {self.table} WHERE item_id = %s', [pk])
+
+    def prune(self, cursor):
+        cursor.execute(f'DELETE FROM {self.table} WHERE item_id NOT IN '
+                       f'(SELECT id FROM core_item)')
+
+    def search(self, cursor, query, limit, offset):
+        cursor.execute(
+            f"SELECT item_id FROM {self.table}, "
+            f"plainto_tsquery('english', %s) query "
+            f"WHERE document @@ query "
+            f"ORDER BY ts_rank(document, query) DESC, item_id DESC "
+            f"LIMIT %s OFFSET %s",
+            [query, limit, offset])
+        return [row[0] for row in cursor.fetchall()]
+
+
+class FallbackSearchBackend:
+    # unindexed LIKE search for databases without a full-text engine here
+
+    def create_sql(self):
+        return []
+
+    def drop_sql(self):
+        return []
+
+    def index(self, cursor, rows):
+        pass
+
+    def remove(self, cursor, pk):
+        pass
+
+    def prune(self, cursor):
+        pass
+
+    def search(self, cursor, query, limit, offset):
+        words = WORD_RE.findall(query)
+        if not words:
+            return []
+        condition = Q()
+        for word in words:
+            condition &= Q(title__icontains=word) | Q(
+                description__icontains=word)
+        items = Item.objects.filter(condition).order_by('-id')
+        return list(items.values_list('id', flat=True)[offset:offset + limit])
+
+
+BACKENDS = {
+    'sqlite': SqliteSearchBackend,
+    'postgresql': PostgresSearchBackend,
+}
+
+
+def get_backend(conn=None):
+    conn = conn or connection
+    return BACKENDS.get(conn.vendor, FallbackSearchBackend)()
+
+
+def index_items(items):
+    rows = [(item.pk, item.title, item.description) for item in items]
+    if rows:
+        with connection.cursor() as cursor:
+            get_backend().index(cursor, rows)
+
+
+def remove_item(pk):
+    with connection.cursor() as cursor:
+        get_backend().remove(cursor, pk)
+
+
+def search_items(query, page=1, size=SEARCH_PAGE_SIZE):
+    offset = (page - 1) * size
+    with connection.cursor() as cursor:
+        ids = get_backend().search(cursor, query, size + 1, offset)
+    has_next = len(ids) > size
+    ids = ids[:size]
+    items = Item.objects.in_bulk(ids)
+    return {
+        'products': [items[pk] for pk in ids if pk in items],
+        'has_next': has_next,
+        'has_previous': page > 1,
+    }
+
+
+def rebuild_index(chunk_size=1000):
+    # walk the table by primary key, one short transaction per chunk; rows
+    # are overwritten in place, so searches keep their results throughout
+    backend = get_backend()
+    items = Item.objects.order_by('pk').values_list(
+        'pk', 'title', 'description')
+    indexed = last_pk = 0
+    while True:
+        rows = list(items.filter(pk__gt=last_pk)[:chunk_size])
+        if not rows:
+            break
+        with transaction.atomic(), connection.cursor() as cursor:
+            backend.index(cursor, rows)
+        indexed += len(rows)
+        last_pk = rows[-1][0]
+
+    # entries of items deleted behind the signals' back
+    with transaction.atomic(), connection.cursor() as cursor:
+        backend.prune(cursor)
+    return indexed
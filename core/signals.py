@@ -0,0 +1,127 @@
+from django.contrib.auth.signals import user_logged_in
+from django.db.models.signals import (post_save, post_delete, pre_delete,
+                                      pre_save)
+from django.db import transaction
+from django.dispatch import receiver
+from .addresses import invalidate_default_addresses
+from .cart import (invalidate_cart_counts, merge_session_cart,
+                   reprice_open_carts, resum_orders)
+from .coupons import bump_coupon_version, reprice_open_orders
+from .images import schedule_variants
+from .catalog import bump_catalog_version, invalidate_item
+from .models import Address, Cupon, Item, Order, OrderItem
+from .search import index_items, remove_item
+
+
+@receiver(post_save, sender=Item)
+@receiver(post_delete, sender=Item)
+def invalidate_catalog(sender, instance, **kwargs):
+    # a request between the save and the commit would cache the old rows
+    # under the new version
+    pk = instance.pk
+    transaction.on_commit(lambda: bump_catalog_version(pk))
+
+
+@receiver(pre_save, sender=Item)
+def remember_old_values(sender, instance, **kwargs):
+    instance._old_slug = instance._old_img = None
+    if instance.pk:
+        instance._old_slug, instance._old_img = Item.objects.filter(
+            pk=instance.pk).values_list('slug', 'img').first() or (None, None)
+
+
+@receiver(post_save, sender=Item)
+@receiver(post_delete, sender=Item)
+def invalidate_item_detail(sender, instance, **kwargs):
+    # deleted any earlier, a concurrent request would refill it from the
+    # row as it was before the commit
+    slugs = (instance.slug, getattr(instance, '_old_slug', None))
+    transaction.on_commit(lambda: invalidate_item(*slugs))
+
+
+@receiver(post_save, sender=Item)
+def update_search_index(sender, instance, **kwargs):
+    index_items([instance])
+
+
+@receiver(post_delete, sender=Item)
+def remove_from_search_index(sender, instance, **kwargs):
+    remove_item(instance.pk)
+
+
+@receiver(post_save, sender=Item)
+def generate_image_variants(sender, instance, **kwargs):
+    # resizing happens in the image pool, after the admin save has returned;
+    # price or title edits leave the image, and its variants, as they were
+    name = instance.img.name
+    if name == getattr(instance, '_old_img', None):
+        return
+    transaction.on_commit(lambda: schedule_variants(name))
+
+
+@receiver(post_save, sender=Item)
+def refresh_open_order_totals(sender, instance, created, **kwargs):
+    # a price change has to be reflected in carts that already hold the item
+    if not created:
+        reprice_open_carts(instance)
+
+
+@receiver(pre_delete, sender=Item)
+def remember_open_orders(sender, instance, **kwargs):
+    # the cascade takes the item's open lines, and with them any way of
+    # finding the carts they were in
+    instance._open_orders = list(Order.objects.filter(
+        ordered=False, items__item=instance).values_list('pk', 'user'))
+
+
+@receiver(post_delete, sender=Item)
+def refresh_deleted_item_carts(sender, instance, **kwargs):
+    # the stored totals would still charge for the deleted lines
+    open_orders = getattr(instance, '_open_orders', [])
+    if not open_orders:
+        return
+    resum_orders(Order.objects.filter(
+        pk__in=[pk for pk, _ in open_orders], ordered=False))
+    user_ids = [user_id for _, user_id in open_orders]
+    transaction.on_commit(lambda: invalidate_cart_counts(user_ids))
+
+
+@receiver(pre_delete, sender=Order)
+def delete_open_lines(sender, instance, **kwargs):
+    # the M2M only drops the link rows; open lines left behind would keep
+    # the one-open-line-per-item constraint taken
+    if not instance.ordered:
+        OrderItem.objects.filter(order=instance, ordered=False).delete()
+
+
+@receiver(post_save, sender=Address)
+@receiver(post_delete, sender=Address)
+def invalidate_address_defaults(sender, instance, **kwargs):
+    invalidate_default_addresses(instance.user_id)
+
+
+@receiver(post_save, sender=Cupon)
+@receiver(post_delete, sender=Cupon)
+def invalidate_coupons(sender, instance, **kwargs):
+    # other processes reload the coupon as soon as they see the new version
+    transaction.on_commit(bump_coupon_version)
+
+
+@receiver(post_save, sender=Cupon)
+def reprice_coupon_orders(sender, instance, created, **kwargs):
+    # open carts would otherwise keep the old discount, and their payment
+    # would be charged an amount the user never saw
+    if not created:
+        reprice_open_orders(instance, instance.amount)
+
+
+@receiver(pre_delete, sender=Cupon)
+def release_coupon_orders(sender, instance, **kwargs):
+    # before SET_NULL clears the link and leaves the discount behind
+    reprice_open_orders(instance, None)
+
+
+@receiver(user_logged_in)
+def merge_cart_on_login(sender, request, user, **kwargs):
+    if request is not None and hasattr(request, 'session'):
+        merge_session_cart(request, user)
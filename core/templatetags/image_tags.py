@@ -0,0 +1,36 @@
+from django import template
+from django.utils.html import format_html
+from core.images import get_variants
+from core.media import media_url
+
+
+register = template.Library()
+
+
+@register.simple_tag
+def srcset(image, ext='jpg'):
+    return ', '.join(f'{media_url(name)} {width}w'
+                     for name, width in get_variants(image.name, ext))
+
+
+@register.simple_tag
+def responsive_img(image, alt='', css_class='', sizes='100vw'):
+    # a <picture> with WebP and JPEG variants, falling back to the original
+    # until the variants have been generated
+    if not image:
+        return ''
+    webp = srcset(image, 'webp')
+    jpeg = srcset(image, 'jpg')
+    if jpeg:
+        img = format_html(
+            '<img src="{}" srcset="{}" sizes="{}" class="{}" alt="{}" '
+            'loading="lazy">', media_url(image.name), jpeg, sizes, css_class, alt)
+    else:
+        img = format_html(
+            '<img src="{}" class="{}" alt="{}" loading="lazy">',
+            media_url(image.name), css_class, alt)
+    if not webp:
+        return img
+    return format_html(
+        '<picture><source type="image/webp" srcset="{}" sizes="{}">{}</picture>',
+        webp, sizes, img)
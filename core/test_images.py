@@ -0,0 +1,134 @@
+import os
+import shutil
+import tempfile
+import time
+from unittest import mock
+
+from django.db.models.fields.files import ImageFieldFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from PIL import Image
+from .images import (VARIANT_RECHECK, generate_variants, get_variants,
+                     forget_variants, variant_name)
+from .models import Item
+from .templatetags.image_tags import responsive_img, srcset
+
+
+class ImageTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings = override_settings(MEDIA_ROOT=self.media_root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def make_image(self, name, width, height):
+        path = os.path.join(self.media_root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        Image.new('RGB', (width, height), 'navy').save(path, 'PNG')
+        forget_variants(name)
+        return path
+
+    def variant_size(self, name, width, ext):
+        with Image.open(os.path.join(
+                self.media_root, variant_name(name, width, ext))) as image:
+            return image.size
+
+
+class GenerateVariantsTest(ImageTestCase):
+
+    def test_never_upscales(self):
+        self.make_image('products/a.png', 400, 200)
+        self.assertEqual(generate_variants('products/a.png', self.media_root), 4)
+        for ext in ('webp', 'jpg'):
+            self.assertEqual(self.variant_size('products/a.png', 150, ext),
+                             (150, 75))
+            self.assertEqual(self.variant_size('products/a.png', 300, ext),
+                             (300, 150))
+        self.assertFalse(os.path.exists(os.path.join(
+            self.media_root, variant_name('products/a.png', 500, 'jpg'))))
+
+    def test_skips_variants_newer_than_the_source(self):
+        path = self.make_image('products/a.png', 400, 200)
+        generate_variants('products/a.png', self.media_root)
+        self.assertEqual(generate_variants('products/a.png', self.media_root), 0)
+        self.assertEqual(generate_variants('products/a.png', self.media_root,
+                                           force=True), 4)
+        later = time.time() + 60
+        os.utime(path, (later, later))
+        self.assertEqual(generate_variants('products/a.png', self.media_root), 4)
+
+
+class ImageTagsTest(ImageTestCase):
+
+    def image(self, name):
+        return ImageFieldFile(None, Item._meta.get_field('img'), name)
+
+    def test_falls_back_to_the_original(self):
+        self.make_image('products/a.png', 400, 200)
+        image = self.image('products/a.png')
+        self.assertEqual(srcset(image), '')
+        html = responsive_img(image, alt='Shirt')
+        self.assertTrue(html.startswith('<img src="/media/products/a.png?v='))
+        self.assertNotIn('srcset', html)
+
+    def test_lists_the_variants(self):
+        self.make_image('products/a.png', 400, 200)
+        generate_variants('products/a.png', self.media_root)
+        image = self.image('products/a.png')
+        self.assertRegex(srcset(image, 'webp'),
+                         r'^/media/variants/products/a-150\.webp\?v=\w+ 150w, '
+                         r'/media/variants/products/a-300\.webp\?v=\w+ 300w$')
+        html = responsive_img(image, sizes='50vw')
+        self.assertTrue(html.startswith(
+            '<picture><source type="image/webp" srcset="'))
+        self.assertIn('a-300.jpg', html)
+
+    def test_complete_sets_are_remembered(self):
+        self.make_image('products/a.png', 600, 300)
+        generate_variants('products/a.png', self.media_root)
+        self.assertEqual(len(get_variants('products/a.png', 'jpg')), 3)
+        with mock.patch('core.images.os.path.exists') as exists:
+            self.assertEqual(len(get_variants('products/a.png', 'jpg')), 3)
+        exists.assert_not_called()
+
+    def test_incomplete_sets_are_rechecked(self):
+        self.make_image('products/a.png', 600, 300)
+        self.assertEqual(get_variants('products/a.png', 'jpg'), [])
+        generate_variants('products/a.png', self.media_root)
+        self.assertEqual(get_variants('products/a.png', 'jpg'), [])
+        later = time.monotonic() + VARIANT_RECHECK
+        with mock.patch('core.images.time.monotonic', return_value=later):
+            self.assertEqual(len(get_variants('products/a.png', 'jpg')), 3)
+
+    def test_a_new_source_is_looked_at_again(self):
+        path = self.make_image('products/a.png', 600, 300)
+        generate_variants('products/a.png', self.media_root)
+        self.assertEqual(len(get_variants('products/a.png', 'jpg')), 3)
+        for width in (300, 500):
+            os.remove(os.path.join(self.media_root, variant_name(
+                'products/a.png', width, 'jpg')))
+        later = time.time() + 60
+        os.utime(path, (later, later))
+        self.assertEqual(get_variants('products/a.png', 'jpg'),
+                         [('variants/products/a-150.jpg', 150)])
+
+
+@mock.patch('core.signals.transaction.on_commit',
+            side_effect=lambda func: func())
+@mock.patch('core.signals.schedule_variants')
+class VariantSignalTest(TestCase):
+
+    def setUp(self):
+        self.item = Item.objects.create(
+            title='Shirt', slug='shirt', price=10, description='Cotton',
+            category='S', label='P', img='products/shirt.jpeg')
+
+    def test_only_a_new_image_is_scheduled(self, schedule, on_commit):
+        self.item.price = 12
+        self.item.title = 'Linen shirt'
+        self.item.save()
+        schedule.assert_not_called()
+        self.item.img = 'products/linen.jpeg'
+        self.item.save()
+        schedule.assert_called_once_with('products/linen.jpeg')
@@ -0,0 +1,142 @@
+import os
+import shutil
+import tempfile
+
+from django.test import SimpleTestCase, override_settings
+from django.utils.http import http_date
+from .media import file_digest, media_url, parse_range
+
+
+class ParseRangeTest(SimpleTestCase):
+
+    def test_ranges(self):
+        cases = {
+            'bytes=10-19': (10, 19),
+            'bytes=90-': (90, 99),
+            'bytes=-10': (90, 99),
+            'bytes=-500': (0, 99),
+            'bytes=95-500': (95, 99),
+            'bytes=5-5': (5, 5),
+        }
+        for header, expected in cases.items():
+            with self.subTest(header=header):
+                self.assertEqual(parse_range(header, 100), expected)
+
+    def test_invalid_ranges_are_ignored(self):
+        for header in ('bytes=5-2', 'bytes=-', 'bytes=a-b', 'items=0-1',
+                       'bytes=0-1,5-6'):
+            with self.subTest(header=header):
+                self.assertIsNone(parse_range(header, 100))
+
+    def test_unsatisfiable_ranges(self):
+        for header, size in (('bytes=100-', 100), ('bytes=-0', 100),
+                             ('bytes=0-', 0), ('bytes=-5', 0)):
+            with self.subTest(header=header, size=size):
+                self.assertIs(parse_range(header, size), False)
+
+
+class ServeMediaTest(SimpleTestCase):
+    body = bytes(range(100))
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.media_root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(cls.media_root, 'products'))
+        for name, content in (('a.jpg', cls.body), ('empty.jpg', b'')):
+            with open(os.path.join(cls.media_root, 'products', name),
+                      'wb') as f:
+                f.write(content)
+        cls.settings = override_settings(MEDIA_ROOT=cls.media_root)
+        cls.settings.enable()
+        cls.path = os.path.join(cls.media_root, 'products', 'a.jpg')
+        cls.digest = file_digest(cls.path)
+        cls.etag = f'"{cls.digest[:32]}"'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.settings.disable()
+        shutil.rmtree(cls.media_root)
+        super().tearDownClass()
+
+    def get(self, name='a.jpg', query='', **headers):
+        return self.client.get(f'/media/products/{name}{query}', **headers)
+
+    def content(self, response):
+        return b''.join(response.streaming_content)
+
+    def test_full_file(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.content(response), self.body)
+        self.assertEqual(response['ETag'], self.etag)
+        self.assertEqual(response['Content-Length'], '100')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['Cache-Control'],
+                         'public, max-age=0, must-revalidate')
+
+    def test_versioned_url_is_immutable(self):
+        url = media_url('products/a.jpg')
+        self.assertTrue(url.endswith(f'?v={self.digest[:12]}'))
+        response = self.client.get(url)
+        self.assertIn('immutable', response['Cache-Control'])
+        stale = self.get(query='?v=000000000000')
+        self.assertNotIn('immutable', stale['Cache-Control'])
+
+    def test_not_modified(self):
+        for headers in ({'HTTP_IF_NONE_MATCH': self.etag},
+                        {'HTTP_IF_NONE_MATCH': f'"other", {self.etag}'},
+                        {'HTTP_IF_MODIFIED_SINCE': http_date(
+                            os.stat(self.path).st_mtime)}):
+            with self.subTest(headers=headers):
+                response = self.get(**headers)
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response['ETag'], self.etag)
+        self.assertEqual(
+            self.get(HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+    def test_partial_content(self):
+        response = self.get(HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(self.content(response), self.body[10:20])
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/100')
+        self.assertEqual(response['Content-Length'], '10')
+
+        response = self.get(HTTP_RANGE='bytes=-10')
+        self.assertEqual(self.content(response), self.body[90:])
+        self.assertEqual(response['Content-Range'], 'bytes 90-99/100')
+
+    def test_if_range(self):
+        response = self.get(HTTP_RANGE='bytes=10-19',
+                            HTTP_IF_RANGE=self.etag)
+        self.assertEqual(response.status_code, 206)
+        response = self.get(HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE='"old"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.content(response), self.body)
+
+    def test_invalid_range_serves_the_whole_file(self):
+        response = self.get(HTTP_RANGE='bytes=5-2')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.content(response), self.body)
+        self.assertNotIn('Content-Range', response)
+
+    def test_unsatisfiable_range(self):
+        response = self.get(HTTP_RANGE='bytes=100-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */100')
+
+    def test_empty_file(self):
+        response = self.get('empty.jpg')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.content(response), b'')
+        response = self.get('empty.jpg', HTTP_RANGE='bytes=-5')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */0')
+
+    def test_missing_and_unsafe_paths(self):
+        self.assertEqual(self.get('missing.jpg').status_code, 404)
+        # safe_join refuses to leave MEDIA_ROOT
+        self.assertEqual(
+            self.client.get('/media/../manage.py').status_code, 400)
+        self.assertEqual(
+            self.client.post('/media/products/a.jpg').status_code, 405)
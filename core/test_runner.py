@@ -0,0 +1,22 @@
+import shutil
+import tempfile
+
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+class TestRunner(DiscoverRunner):
+    # test requests go through the timing middleware like any other; their
+    # snapshots go to a throwaway directory, not the real REQUEST_TIMING_DIR
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.timing_dir = tempfile.mkdtemp(prefix='djecommerce-timings-')
+        self.timing_settings = override_settings(
+            REQUEST_TIMING_DIR=self.timing_dir)
+        self.timing_settings.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.timing_settings.disable()
+        shutil.rmtree(self.timing_dir, ignore_errors=True)
+        super().teardown_test_environment(**kwargs)
@@ -1,3 +1,1606 @@
-from django.test import TestCase
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import (IntegrityError, OperationalError, connection,
+                       transaction)
+from django.db.models import QuerySet, Sum
+from django.forms import modelform_factory
+from django.template.base import Node
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from .addresses import get_default_address, resolve_address
+from .autocomplete import PrefixIndex, warm
+from .caching import bump_version, cache_timeout, get_version
+from .catalog import (CATALOG_VERSION_KEY, get_catalog_version,
+                      get_category_page, get_item)
+from .cart import (CART_MAX_QUANTITY, CartLocked, SessionCart, add_item,
+                   get_cart_count, merge_items, remove_item,
+                   remove_single_item)
+from .models import (Address, CategorySales, CouponSales, Cupon, DailySales,
+                     Item, ItemSales, Order, OrderItem, Payment, PaymentJob,
+                     Refund, RollupState)
+from .coupons import (get_coupon, get_coupon_version, redeem_coupon,
+                      release_coupon)
+from .exports import export_orders, parse_day
+from .payments import (FakeGateway, claim_jobs, enqueue_payment,
+                       finalize_order, process_job, set_gateway)
+from .refunds import grant_pending_refunds, grant_refunds, request_refund
+from .rollups import ROLLUP_NAME, day_start, refresh_rollups
+from .search import get_backend, rebuild_index, search_items
+from .timing import load_timings, store
+
+
+def run_on_commit():
+    # a TestCase transaction never commits, so run the callbacks at once
+    return mock.patch('core.signals.transaction.on_commit',
+                      side_effect=lambda func: func())
+
+
+class ConcurrentAddToCartTest(TransactionTestCase):
+    threads = 8
+    clicks = 10
+
+    def setUp(self):
+        self.user = User.objects.create_user('shopper', password='secret')
+        self.item = Item.objects.create(
+            title='Shirt', slug='shirt', price=10, discount_price=7.5,
+            description='Cotton', category='S', label='P',
+            img='products/shirt.jpeg')
+
+    def click(self, barrier, errors):
+        try:
+            barrier.wait()
+            for _ in range(self.clicks):
+                add_item(self.user, self.item)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connection.close()
+
+    def test_parallel_clicks_keep_exact_quantity(self):
+        barrier = threading.Barrier(self.threads)
+        errors = []
+        workers = [threading.Thread(target=self.click, args=(barrier, errors))
+                   for _ in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(errors, [])
+        order_item = OrderItem.objects.get(user=self.user, ordered=False)
+        self.assertEqual(order_item.quantity, self.threads * self.clicks)
+        order = Order.objects.get(user=self.user, ordered=False)
+        self.assertEqual(list(order.items.all()), [order_item])
+        self.assertAlmostEqual(order.total, 7.5 * self.threads * self.clicks)
+        self.assertAlmostEqual(order.total, order.compute_totals()[2])
+
+
+class ConcurrentRedeemCouponTest(TransactionTestCase):
+    threads = 8
+    max_uses = 3
+
+    def setUp(self):
+        self.cupon = Cupon.objects.create(
+            cupon='LAST3', amount=5, max_uses=self.max_uses)
+
+    def redeem(self, barrier, results):
+        try:
+            barrier.wait()
+            results.append(redeem_coupon(self.cupon.pk))
+        except Exception as e:
+            results.append(e)
+        finally:
+            connection.close()
+
+    def test_cap_holds_and_release_hands_a_use_back(self):
+        barrier = threading.Barrier(self.threads)
+        results = []
+        workers = [threading.Thread(target=self.redeem,
+                                    args=(barrier, results))
+                   for _ in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(sorted(results, key=str),
+                         [False] * (self.threads - self.max_uses) +
+                         [True] * self.max_uses)
+        self.cupon.refresh_from_db()
+        self.assertEqual(self.cupon.times_used, self.max_uses)
+        self.assertFalse(redeem_coupon(self.cupon.pk))
+
+        self.assertTrue(release_coupon(self.cupon.pk))
+        self.assertTrue(redeem_coupon(self.cupon.pk))
+        self.cupon.refresh_from_db()
+        self.assertEqual(self.cupon.times_used, self.max_uses)
+
+
+class CouponOrderTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('buyer', password='secret')
+        self.item = Item.objects.create(
+            title='Shirt', slug='shirt', price=30, description='Cotton',
+            category='S', label='P', img='products/shirt.jpeg')
+        add_item(self.user, self.item)
+        self.cupon = Cupon.objects.create(cupon='SAVE5', amount=5)
+        self.order = Order.objects.get(user=self.user, ordered=False)
+        self.order.set_cupon(self.cupon)
+        self.client.force_login(self.user)
+
+    def totals(self):
+        self.order.refresh_from_db()
+        return self.order.cupon_id, self.order.discount, self.order.total
+
+    def test_remove_cupon(self):
+        response = self.client.post(reverse('core:remove-cupon'))
+        self.assertRedirects(response, reverse('core:checkout'),
+                             fetch_redirect_response=False)
+        self.assertEqual(self.totals(), (None, 0, 30))
+
+    def test_editing_the_amount_reprices_open_orders(self):
+        self.cupon.amount = 8
+        self.cupon.save()
+        self.assertEqual(self.totals(), (self.cupon.pk, 8, 22))
+
+    def test_edits_reach_the_coupon_cache_once_committed(self):
+        self.assertEqual(get_coupon('SAVE5').amount, 5)
+        version = get_coupon_version()
+        self.cupon.amount = 8
+        self.cupon.save()
+        self.assertEqual(get_coupon_version(), version)
+        with run_on_commit():
+            self.cupon.save()
+        self.assertEqual(get_coupon('SAVE5').amount, 8)
+
+    def test_deleting_the_cupon_drops_the_discount(self):
+        self.cupon.delete()
+        self.assertEqual(self.totals(), (None, 0, 30))
+
+    @override_settings(
+        STATICFILES_STORAGE='django.contrib.staticfiles.storage.'
+                            'StaticFilesStorage')
+    def test_checkout_drops_a_used_up_cupon(self):
+        Cupon.objects.filter(pk=self.cupon.pk).update(
+            max_uses=1, times_used=1)
+        response = self.client.get(reverse('core:checkout'))
+        self.assertContains(response, 'no longer valid')
+        self.assertEqual(self.totals(), (None, 0, 30))
+
+
+class OrderTotalsTest(TestCase):
+    # the stored totals are kept up incrementally; compute_totals is the
+    # slow, from-the-lines answer they must always agree with
+
+    def setUp(self):
+        self.user = User.objects.create_user('buyer', password='secret')
+        self.shirt = Item.objects.create(
+            title='Shirt', slug='shirt', price=10, description='Cotton',
+            category='S', label='P', img='products/shirt.jpeg')
+        self.hoodie = Item.objects.create(
+            title='Hoodie', slug='hoodie', price=30, discount_price=25,
+            description='Fleece', category='SW', label='P',
+            img='products/hoodie.jpeg')
+        self.cupon = Cupon.objects.create(cupon='SAVE5', amount=5)
+
+    def assertTotalsMatch(self, user=None):
+        order = Order.objects.get(user=user or self.user, ordered=False)
+        stored = (order.subtotal, order.discount, order.total)
+        for got, expected in zip(stored, order.compute_totals()):
+            self.assertAlmostEqual(got, expected)
+        return stored
+
+    def test_incremental_totals_match_compute_totals(self):
+        add_item(self.user, self.shirt, 2)
+        self.assertEqual(self.assertTotalsMatch(), (20, 0, 20))
+        add_item(self.user, self.hoodie)
+        add_item(self.user, self.shirt)
+        self.assertEqual(self.assertTotalsMatch(), (55, 0, 55))
+        remove_single_item(self.user, self.shirt)
+        self.assertTotalsMatch()
+        Order.objects.get(user=self.user, ordered=False).set_cupon(self.cupon)
+        self.assertEqual(self.assertTotalsMatch(), (45, 5, 40))
+        remove_item(self.user, self.hoodie)
+        merge_items(self.user, {self.shirt.pk: 3})
+        self.assertEqual(self.assertTotalsMatch(), (50, 5, 45))
+        Order.objects.get(user=self.user, ordered=False).set_cupon(None)
+        self.assertEqual(self.assertTotalsMatch(), (50, 0, 50))
+
+    def test_lines_stop_at_the_cap(self):
+        add_item(self.user, self.shirt, CART_MAX_QUANTITY - 1)
+        add_item(self.user, self.hoodie)
+        for _ in range(2):
+            add_item(self.user, self.shirt, 5)
+        line = OrderItem.objects.get(user=self.user, item=self.shirt)
+        self.assertEqual(line.quantity, CART_MAX_QUANTITY)
+        self.assertEqual(self.assertTotalsMatch(),
+                         (10 * CART_MAX_QUANTITY + 25, 0,
+                          10 * CART_MAX_QUANTITY + 25))
+
+    def test_price_change_reprices_open_carts_in_one_update(self):
+        users = [User.objects.create_user(f'shopper{n}') for n in range(3)]
+        for user in users:
+            add_item(user, self.shirt, 2)
+        add_item(self.user, self.hoodie)
+        Order.objects.get(user=users[0], ordered=False).set_cupon(self.cupon)
+
+        self.shirt.discount_price = 8
+        with CaptureQueriesContext(connection) as queries:
+            self.shirt.save()
+        updates = [query['sql'] for query in queries.captured_queries
+                   if query['sql'].startswith('UPDATE "core_order" ')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(self.assertTotalsMatch(users[0]), (16, 5, 11))
+        for user in users[1:]:
+            self.assertEqual(self.assertTotalsMatch(user), (16, 0, 16))
+        self.assertEqual(self.assertTotalsMatch(), (25, 0, 25))
+
+    def test_deleting_an_item_reprices_open_carts(self):
+        add_item(self.user, self.shirt)
+        add_item(self.user, self.hoodie)
+        self.assertEqual(get_cart_count(self.user), 2)
+        with run_on_commit():
+            self.hoodie.delete()
+        self.assertEqual(self.assertTotalsMatch(), (10, 0, 10))
+        # a fresh user, the count is memoized on the one of the request
+        self.assertEqual(get_cart_count(User.objects.get(pk=self.user.pk)), 1)
+
+        self.shirt.delete()
+        self.assertEqual(self.assertTotalsMatch(), (0, 0, 0))
+
+    def test_rebuild_order_totals(self):
+        add_item(self.user, self.shirt, 2)
+        Order.objects.update(total=99)
+        out = StringIO()
+        with self.assertRaisesMessage(CommandError, '1 mismatches left'):
+            call_command('rebuild_order_totals', '--check', stdout=out)
+        self.assertIn('found 1 mismatches', out.getvalue())
+        self.assertEqual(Order.objects.get().total, 99)
+
+        call_command('rebuild_order_totals', stdout=out)
+        self.assertIn('fixed 1', out.getvalue())
+        self.assertEqual(self.assertTotalsMatch(), (20, 0, 20))
+        call_command('rebuild_order_totals', '--check', stdout=out)
+
+    def test_placed_orders_are_only_reported(self):
+        add_item(self.user, self.shirt, 2)
+        order = Order.objects.get(user=self.user, ordered=False)
+        order.set_cupon(self.cupon)
+        finalize_order(order, self.user, 'ch_test', order.total)
+        # the coupon the order was placed with is gone now
+        self.cupon.delete()
+        out = StringIO()
+        call_command('rebuild_order_totals', stdout=out)
+        self.assertIn('Checked 0 orders', out.getvalue())
+
+        with self.assertRaisesMessage(CommandError, '1 mismatches left'):
+            call_command('rebuild_order_totals', '--placed', stdout=out)
+        order.refresh_from_db()
+        self.assertEqual((order.subtotal, order.discount, order.total),
+                         (20, 5, 15))
+
+
+class FinalizeOrderQueryTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('buyer', password='secret')
+
+    def place_order(self, lines):
+        Order.objects.filter(user=self.user).delete()
+        OrderItem.objects.filter(user=self.user).delete()
+        items = [Item.objects.create(
+            title=f'Item {n}', slug=f'item-{lines}-{n}', price=5,
+            description='Cotton', category='S', label='P',
+            img='products/item.jpeg') for n in range(lines)]
+        merge_items(self.user, {item.pk: 2 for item in items})
+        order = Order.objects.get(user=self.user, ordered=False)
+
+        with CaptureQueriesContext(connection) as queries:
+            payment = finalize_order(order, self.user, 'ch_test', order.total)
+
+        order.refresh_from_db()
+        self.assertTrue(order.ordered)
+        self.assertEqual(order.payment, payment)
+        self.assertEqual(payment.amount, 10 * lines)
+        self.assertFalse(order.items.filter(ordered=False).exists())
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_cart_size(self):
+        self.assertEqual(self.place_order(1), self.place_order(25))
+
+
+class PaymentJobTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('buyer', password='secret')
+        self.item = Item.objects.create(
+            title='Shirt', slug='shirt', price=10, description='Cotton',
+            category='S', label='P', img='products/shirt.jpeg')
+        add_item(self.user, self.item, 2)
+        self.order = Order.objects.get(user=self.user, ordered=False)
+        self.gateway = FakeGateway(latency=0, failure_rate=0)
+        set_gateway(self.gateway)
+
+    def tearDown(self):
+        set_gateway(None)
+
+    def run_jobs(self):
+        # process_job, not run_job: that one recycles the connection, and
+        # with it the test transaction
+        for pk in claim_jobs(10):
+            process_job(PaymentJob.objects.select_related(
+                'order', 'user').get(pk=pk))
+
+    def test_double_submit_makes_one_job_and_one_charge(self):
+        job, created = enqueue_payment(self.order, self.user, 'tok_1')
+        again, created_again = enqueue_payment(self.order, self.user, 'tok_2')
+        self.assertTrue(created)
+        self.assertFalse(created_again)
+        self.assertEqual(job, again)
+        self.run_jobs()
+        self.assertEqual(len(self.gateway.charges), 1)
+        self.assertEqual(
+            list(PaymentJob.objects.values_list('status', flat=True)), ['S'])
+
+    def test_retry_after_a_decline_gets_a_new_key(self):
+        first, _ = enqueue_payment(self.order, self.user, 'tok_1')
+        PaymentJob.objects.filter(pk=first.pk).update(status='F')
+        second, created = enqueue_payment(self.order, self.user, 'tok_2')
+        self.assertTrue(created)
+        self.assertNotEqual(first.idempotency_key, second.idempotency_key)
+
+    def test_cart_is_locked_while_paying(self):
+        enqueue_payment(self.order, self.user, 'tok_1')
+        with self.assertRaises(CartLocked):
+            add_item(self.user, self.item)
+        with self.assertRaises(CartLocked):
+            remove_single_item(self.user, self.item)
+        self.client.force_login(self.user)
+        response = self.client.post(
+            reverse('core:cart-api'),
+            json.dumps({'operations': [{'slug': 'shirt', 'delta': 1}]}),
+            content_type='application/json')
+        self.assertEqual(response.status_code, 409)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.total, 20)
+
+        self.run_jobs()
+        self.assertTrue(add_item(self.user, self.item))
+
+    def test_charge_is_refunded_when_the_order_cannot_be_placed(self):
+        enqueue_payment(self.order, self.user, 'tok_1')
+        charge = self.gateway.charge
+
+        def charge_and_change_cart(*args):
+            # the cart total moves while the gateway call is in flight
+            Order.objects.filter(pk=self.order.pk).update(total=25)
+            return charge(*args)
+
+        self.gateway.charge = charge_and_change_cart
+        self.run_jobs()
+        job = PaymentJob.objects.get()
+        self.assertEqual(job.status, 'F')
+        self.assertIn('refunded', job.error)
+        self.assertEqual(self.gateway.refunds,
+                         set(self.gateway.charges.values()))
+        self.assertFalse(Order.objects.filter(ordered=True).exists())
+
+    def claim_last_attempt(self, last):
+        job, _ = enqueue_payment(self.order, self.user, 'tok_1')
+        PaymentJob.objects.filter(pk=job.pk).update(
+            attempts=settings.PAYMENT_MAX_ATTEMPTS - (1 if last else 2))
+        claim_jobs(1)
+        return PaymentJob.objects.select_related('order', 'user').get()
+
+    def test_unexpected_error_is_retried_with_the_same_charge(self):
+        job = self.claim_last_attempt(last=False)
+        locked = OperationalError('database is locked')
+        with mock.patch('core.payments.finalize_order', side_effect=locked):
+            with self.assertRaises(OperationalError):
+                process_job(job)
+        self.assertEqual(self.gateway.refunds, set())
+
+    def test_unexpected_error_on_the_last_attempt_refunds(self):
+        job = self.claim_last_attempt(last=True)
+        locked = OperationalError('database is locked')
+        with mock.patch('core.payments.finalize_order', side_effect=locked):
+            process_job(job)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'F')
+        self.assertIn('refunded', job.error)
+        self.assertEqual(self.gateway.refunds,
+                         set(self.gateway.charges.values()))
+
+    def test_requeued_job_keeps_the_order_its_charge_placed(self):
+        # the stale copy was read before the first attempt placed the order
+        enqueue_payment(self.order, self.user, 'tok_1')
+        pk, = claim_jobs(1)
+        stale = PaymentJob.objects.select_related('order', 'user').get(pk=pk)
+        process_job(PaymentJob.objects.select_related(
+            'order', 'user').get(pk=pk))
+        process_job(stale)
+        job = PaymentJob.objects.get()
+        self.assertEqual(job.status, 'S')
+        self.assertEqual(len(self.gateway.charges), 1)
+        self.assertEqual(self.gateway.refunds, set())
+        self.assertEqual(job.payment, Order.objects.get(ordered=True).payment)
+
+    def test_retry_after_placing_the_order_succeeds(self):
+        # the worker died between placing the order and marking the job
+        enqueue_payment(self.order, self.user, 'tok_1')
+        self.run_jobs()
+        PaymentJob.objects.update(status='P', payment=None)
+        self.run_jobs()
+        job = PaymentJob.objects.get()
+        self.assertEqual((job.status, job.error), ('S', ''))
+        self.assertEqual(job.payment, Order.objects.get(ordered=True).payment)
+        self.assertEqual(len(self.gateway.charges), 1)
+
+        # any other job for the order was not what placed it
+        other = PaymentJob.objects.create(
+            order=self.order, user=self.user, amount=20,
+            idempotency_key='other')
+        claim_jobs(1)
+        process_job(PaymentJob.objects.select_related(
+            'order', 'user').get(pk=other.pk))
+        other.refresh_from_db()
+        self.assertEqual(other.status, 'F')
+        self.assertEqual(len(self.gateway.charges), 1)
+
+    def test_payment_view_rejects_unpayable_orders(self):
+        self.client.force_login(self.user)
+        url = reverse('core:payment', args=['credit'])
+        self.client.post(url, {'stripeToken': 'tok_1'})
+        self.assertFalse(PaymentJob.objects.exists())
+
+        address = Address.objects.create(
+            user=self.user, address='1 Main St', secondary_addrs='',
+            division='DHA', country='BD', zip_code='1000', address_type='B')
+        Order.objects.filter(pk=self.order.pk).update(
+            billing_address=address, discount=20, total=0)
+        self.client.post(url, {'stripeToken': 'tok_1'})
+        Order.objects.filter(pk=self.order.pk).update(
+            subtotal=0, discount=0, total=0)
+        self.client.post(url, {'stripeToken': 'tok_1'})
+        self.assertFalse(PaymentJob.objects.exists())
+
+        Order.objects.filter(pk=self.order.pk).update(subtotal=20, total=20)
+        self.client.post(url, {'stripeToken': 'tok_1'})
+        self.assertTrue(PaymentJob.objects.exists())
+
+    @override_settings(
+        STATICFILES_STORAGE='django.contrib.staticfiles.storage.'
+                            'StaticFilesStorage')
+    def test_a_failure_is_reported_once(self):
+        job, _ = enqueue_payment(self.order, self.user, 'tok_1')
+        PaymentJob.objects.filter(pk=job.pk).update(
+            status='F', error='Your card was declined.')
+        address = Address.objects.create(
+            user=self.user, address='1 Main St', secondary_addrs='',
+            division='DHA', country='BD', zip_code='1000', address_type='B')
+        Order.objects.filter(pk=self.order.pk).update(billing_address=address)
+        self.client.force_login(self.user)
+        url = reverse('core:payment', args=['credit'])
+        shown = [[str(message) for message in
+                  self.client.get(url).context['messages']]
+                 for _ in range(2)]
+        self.assertEqual(shown, [['Your card was declined.'], []])
+
+    def test_placed_lines_keep_the_price_paid(self):
+        enqueue_payment(self.order, self.user, 'tok_1')
+        self.run_jobs()
+        Item.objects.filter(pk=self.item.pk).update(price=12)
+        line = OrderItem.objects.select_related('item').get()
+        self.assertEqual(line.unit_price, 10)
+        self.assertEqual(line.get_final_price(), 20)
+
+    def test_charge_amount_is_rounded_to_cents(self):
+        Order.objects.filter(pk=self.order.pk).update(total=19.99)
+        enqueue_payment(self.order, self.user, 'tok_1')
+        amounts = []
+        charge = self.gateway.charge
+
+        def record(amount, *args):
+            amounts.append(amount)
+            return charge(amount, *args)
+
+        self.gateway.charge = record
+        self.run_jobs()
+        self.assertEqual(amounts, [1999])
+
+
+class DeletedCartTest(TestCase):
+    # the M2M from Order to its lines doesn't cascade on its own
+
+    def setUp(self):
+        self.user = User.objects.create_user('shopper', password='secret')
+        self.item = Item.objects.create(
+            title='Shirt', slug='shirt', price=10, description='Cotton',
+            category='S', label='P', img='products/shirt.jpeg')
+        add_item(self.user, self.item, 2)
+        Order.objects.filter(user=self.user, ordered=False).delete()
+
+    def test_open_lines_go_with_the_order(self):
+        self.assertFalse(OrderItem.objects.filter(user=self.user).exists())
+
+    def test_add_item_starts_a_new_cart(self):
+        self.assertTrue(add_item(self.user, self.item))
+        order = Order.objects.get(user=self.user, ordered=False)
+        self.assertEqual(
+            [(line.item_id, line.quantity) for line in order.items.all()],
+            [(self.item.pk, 1)])
+        self.assertAlmostEqual(order.total, 10)
+
+    def test_detached_lines_are_never_updated(self):
+        # e.g. a line detached before the signal existed
+        detached = OrderItem.objects.create(
+            user=self.user, item=self.item, quantity=2)
+        self.assertFalse(remove_single_item(self.user, self.item))
+        self.assertFalse(remove_item(self.user, self.item))
+        with self.assertRaises(IntegrityError):
+            add_item(self.user, self.item)
+        detached.refresh_from_db()
+        self.assertEqual(detached.quantity, 2)
+
+
+class CartApiTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('shopper', password='secret')
+        self.item = Item.objects.create(
+            title='Shirt', slug='shirt', price=10, description='Cotton',
+            category='S', label='P', img='products/shirt.jpeg')
+        self.client.force_login(self.user)
+
+    def send(self, *operations):
+        return self.client.post(
+            reverse('core:cart-api'),
+            json.dumps({'operations': [
+                {'slug': 'shirt', 'delta': delta} for delta in operations]}),
+            content_type='application/json')
+
+    def test_rejects_bad_deltas(self):
+        for operations in ([True], [False], [10 ** 20], [1.5],
+                           [CART_MAX_QUANTITY + 1], [600, 600]):
+            with self.subTest(operations=operations):
+                self.assertEqual(self.send(*operations).status_code, 400)
+        self.assertFalse(OrderItem.objects.exists())
+
+    def test_clamps_the_line_quantity(self):
+        self.send(CART_MAX_QUANTITY)
+        response = self.send(CART_MAX_QUANTITY)
+        self.assertEqual(response.json()['lines'][0]['quantity'],
+                         CART_MAX_QUANTITY)
+        self.assertAlmostEqual(response.json()['total'],
+                               10 * CART_MAX_QUANTITY)
+
+    def test_single_removals_keep_totals(self):
+        add_item(self.user, self.item, 2)
+        self.assertTrue(remove_single_item(self.user, self.item))
+        self.assertTrue(remove_single_item(self.user, self.item))
+        self.assertFalse(remove_single_item(self.user, self.item))
+        order = Order.objects.get(user=self.user, ordered=False)
+        self.assertEqual((order.subtotal, order.total), (0, 0))
+
+
+@override_settings(
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.'
+                        'StaticFilesStorage')
+class SessionCartTest(TestCase):
+    # carts live in the session, logged in or not, until checkout merges
+    # them into the database cart; a login only merges into a cart that
+    # has already been saved
+
+    def setUp(self):
+        self.user = User.objects.create_user('shopper', password='secret')
+        self.shirt = Item.objects.create(
+            title='Shirt', slug='shirt', price=10, description='Cotton',
+            category='S', label='P', img='products/shirt.jpeg')
+        self.hoodie = Item.objects.create(
+            title='Hoodie', slug='hoodie', price=30, discount_price=25,
+            description='Fleece', category='SW', label='P',
+            img='products/hoodie.jpeg')
+
+    def fill(self):
+        for item in (self.shirt, self.shirt, self.hoodie):
+            self.client.get(reverse('core:add-to-cart', args=[item.slug]))
+
+    def session_cart(self):
+        return SessionCart(self.client.session)
+
+    def test_anonymous_add_remove_and_summary(self):
+        self.fill()
+        self.assertEqual(self.session_cart().quantities(),
+                         {self.shirt.pk: 2, self.hoodie.pk: 1})
+        response = self.client.get(reverse('core:order-summary'))
+        self.assertEqual(response.context['object'].total, 45)
+
+        self.client.get(reverse('core:remove-single-item-from-cart',
+                                args=['shirt']))
+        self.client.get(reverse('core:remove-from-cart', args=['hoodie']))
+        self.assertEqual(self.session_cart().quantities(), {self.shirt.pk: 1})
+        summary = self.session_cart().summary()
+        self.assertEqual((summary['count'], summary['total']), (1, 10))
+        self.assertFalse(Order.objects.exists())
+
+    def test_logged_in_carts_reach_the_database_at_checkout(self):
+        self.client.login(username='shopper', password='secret')
+        self.fill()
+        self.assertFalse(Order.objects.exists())
+        response = self.client.get(reverse('core:order-summary'))
+        self.assertEqual(response.context['object'].total, 45)
+
+        self.client.get(reverse('core:checkout'))
+        order = Order.objects.get(user=self.user, ordered=False)
+        self.assertEqual(
+            dict(order.items.values_list('item__slug', 'quantity')),
+            {'shirt': 2, 'hoodie': 1})
+        self.assertEqual(self.session_cart().count(), 0)
+        # from here on the saved cart is edited in place
+        self.client.get(reverse('core:add-to-cart', args=['shirt']))
+        order.refresh_from_db()
+        self.assertEqual(order.total, 55)
+
+        order.delete()
+        self.client.get(reverse('core:add-to-cart', args=['shirt']))
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(self.session_cart().quantities(), {self.shirt.pk: 1})
+
+    def test_login_without_a_saved_cart_keeps_the_session_cart(self):
+        self.fill()
+        self.client.login(username='shopper', password='secret')
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(self.session_cart().count(), 2)
+
+    def test_add_clamps_the_line_quantity(self):
+        cart = SessionCart(self.client.session)
+        cart.add(self.shirt, CART_MAX_QUANTITY)
+        self.assertFalse(cart.add(self.shirt))
+        self.assertEqual(cart.quantities(), {self.shirt.pk: CART_MAX_QUANTITY})
+        cart.lines[str(self.shirt.pk)] = CART_MAX_QUANTITY * 2
+        cart.remove_single(self.shirt)
+        self.assertEqual(cart.quantities(), {self.shirt.pk: CART_MAX_QUANTITY})
+
+    def test_login_merges_into_the_database_cart(self):
+        add_item(self.user, self.shirt)
+        self.fill()
+        self.client.login(username='shopper', password='secret')
+        order = Order.objects.get(user=self.user, ordered=False)
+        self.assertEqual(
+            dict(order.items.values_list('item__slug', 'quantity')),
+            {'shirt': 3, 'hoodie': 1})
+        self.assertEqual((order.subtotal, order.total), (55, 55))
+        self.assertAlmostEqual(order.total, order.compute_totals()[2])
+        self.assertEqual(self.session_cart().count(), 0)
+
+    def test_locked_cart_keeps_the_session_cart(self):
+        add_item(self.user, self.shirt)
+        order = Order.objects.get(user=self.user, ordered=False)
+        enqueue_payment(order, self.user, 'tok_1')
+        self.fill()
+        self.client.login(username='shopper', password='secret')
+        self.assertEqual(self.session_cart().quantities(),
+                         {self.shirt.pk: 2, self.hoodie.pk: 1})
+        order.refresh_from_db()
+        self.assertEqual((order.items.count(), order.total), (1, 10))
+
+    def test_count_drops_deleted_items(self):
+        self.fill()
+        self.hoodie.delete()
+        cart = self.session_cart()
+        self.assertEqual(cart.count(), 1)
+        self.assertEqual(len(cart.get_order_items()), 1)
+
+
+@override_settings(
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.'
+                        'StaticFilesStorage')
+class ConditionalGetTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('shopper', password='secret')
+        self.item = Item.objects.create(
+            title='Shirt', slug='shirt', price=10, description='Cotton',
+            category='S', label='P', img='products/shirt.jpeg')
+        self.url = reverse('core:product', args=['shirt'])
+
+    def test_revalidation_returns_304(self):
+        first = self.client.get(self.url)
+        self.assertEqual(first.status_code, 200)
+        again = self.client.get(self.url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(again.status_code, 304)
+        again = self.client.get(
+            self.url, HTTP_IF_MODIFIED_SINCE=first['Last-Modified'])
+        self.assertEqual(again.status_code, 304)
+
+        home = self.client.get(reverse('core:home'))
+        again = self.client.get(reverse('core:home'),
+                                HTTP_IF_NONE_MATCH=home['ETag'])
+        self.assertEqual(again.status_code, 304)
+
+    def test_item_save_changes_the_etag(self):
+        first = self.client.get(self.url)
+        home = self.client.get(reverse('core:home'))
+        self.item.title = 'Linen shirt'
+        with run_on_commit():
+            self.item.save()
+        again = self.client.get(self.url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(again.status_code, 200)
+        self.assertNotEqual(again['ETag'], first['ETag'])
+        again = self.client.get(reverse('core:home'),
+                                HTTP_IF_NONE_MATCH=home['ETag'])
+        self.assertEqual(again.status_code, 200)
+
+    def test_item_page_is_dropped_once_committed(self):
+        self.client.get(self.url)
+        self.item.title = 'Linen shirt'
+        self.item.save()
+        # the cached row is only dropped once the save has committed
+        self.assertEqual(get_item('shirt').title, 'Shirt')
+        with run_on_commit():
+            self.item.save()
+        self.assertEqual(get_item('shirt').title, 'Linen shirt')
+
+    def test_cart_change_changes_the_etag(self):
+        self.client.force_login(self.user)
+        first = self.client.get(self.url)
+        session = self.client.session
+        SessionCart(session).add(self.item)
+        session.save()
+        again = self.client.get(self.url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(again.status_code, 200)
+        self.assertNotEqual(again['ETag'], first['ETag'])
+
+    def test_logged_in_users_never_get_last_modified(self):
+        self.client.force_login(self.user)
+        response = self.client.get(self.url)
+        self.assertIn('ETag', response)
+        self.assertNotIn('Last-Modified', response)
+        self.assertNotIn('Last-Modified', self.client.get(reverse('core:home')))
+
+    def test_pending_messages_turn_validation_off(self):
+        first = self.client.get(self.url)
+        # leaves a flash message and the cart as it was
+        self.client.get(reverse('core:remove-from-cart', args=['shirt']))
+        again = self.client.get(self.url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(again.status_code, 200)
+        self.assertNotIn('ETag', again)
+        self.assertContains(again, 'not in your cart')
+
+
+@override_settings(
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.'
+                        'StaticFilesStorage')
+class RequestTimingMiddlewareTest(TestCase):
+
+    def setUp(self):
+        self.staff = User.objects.create_superuser(
+            'staff', 'staff@example.com', 'secret')
+
+    def test_server_timing_is_sent_to_staff_only(self):
+        self.assertNotIn('Server-Timing', self.client.get(reverse('core:home')))
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse('core:home'))
+        self.assertRegex(response['Server-Timing'],
+                         r'^db;dur=[\d.]+;desc="\d+ queries", tpl;dur=')
+        with override_settings(SERVER_TIMING_HEADER=False):
+            self.assertNotIn('Server-Timing',
+                             self.client.get(reverse('core:home')))
+
+    def test_user_is_not_loaded_for_the_header(self):
+        # the autocomplete view never looks at request.user
+        self.client.force_login(self.staff)
+        warm()
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('core:autocomplete') + '?q=x')
+        self.assertNotIn('Server-Timing', response)
+
+    def test_requests_are_recorded_per_route(self):
+        def home_count():
+            store.flush()
+            route = load_timings().get('core:home')
+            return route['count'] if route else 0
+
+        before = home_count()
+        self.client.get(reverse('core:home'))
+        self.client.get(reverse('core:home'))
+        self.assertEqual(home_count(), before + 2)
+
+    def test_snapshots_stay_out_of_the_real_directory(self):
+        # the suite's runner points them at a throwaway directory
+        self.assertTrue(os.path.basename(settings.REQUEST_TIMING_DIR)
+                        .startswith('djecommerce-timings-'))
+
+
+class AddressTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('shopper', password='secret')
+        self.item = Item.objects.create(
+            title='Shirt', slug='shirt', price=10, description='Cotton',
+            category='S', label='P', img='products/shirt.jpeg')
+
+    def resolve(self, street, address_type='S', default=False):
+        return resolve_address(self.user, address_type, street, '', 'DHA',
+                               'BD', '1000', default=default)
+
+    def test_repeat_checkout_reuses_rows(self):
+        add_item(self.user, self.item)
+        self.client.force_login(self.user)
+        for street in ('1 Main St', '  1 main  st '):
+            response = self.client.post(reverse('core:checkout'), {
+                'shipping_address': street, 'shipping_address2': '',
+                'shipping_country': 'BD', 'shipping_division': 'DHA',
+                'shipping_zip': '1000', 'billing_division': 'DHA',
+                'billing_zip': '1000', 'same_billing_address': 'on',
+                'payment_option': 'C'})
+            self.assertEqual(response.status_code, 302)
+        self.assertEqual(
+            sorted(Address.objects.values_list('address_type', flat=True)),
+            ['B', 'S'])
+        order = Order.objects.get()
+        self.assertEqual(order.shipping_address.address, '1 Main St')
+        self.assertEqual(order.billing_address.address_type, 'B')
+
+    def test_set_default_clears_the_old_default(self):
+        home = self.resolve('1 Main St', default=True)
+        self.assertEqual(get_default_address(self.user, 'S'), home)
+        office = self.resolve('2 Office Rd', default=True)
+        self.assertEqual(get_default_address(self.user, 'S'), office)
+        self.assertEqual(
+            list(Address.objects.filter(default=True)), [office])
+        # picking an existing row as the default again reuses it
+        self.assertEqual(self.resolve('1 Main St', default=True), home)
+        self.assertEqual(get_default_address(self.user, 'S'), home)
+        self.assertEqual(Address.objects.count(), 2)
+
+    def test_a_lost_insert_race_reuses_the_winner(self):
+        home = self.resolve('1 Main St')
+        real_get = QuerySet.get
+        calls = []
+
+        def get(queryset, *args, **kwargs):
+            # the first lookup misses, as if the other checkout had not
+            # committed yet
+            calls.append(kwargs)
+            if len(calls) == 1:
+                raise Address.DoesNotExist
+            return real_get(queryset, *args, **kwargs)
+
+        with mock.patch.object(QuerySet, 'get', autospec=True,
+                               side_effect=get):
+            self.assertEqual(self.resolve(' 1 main st'), home)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(Address.objects.count(), 1)
+
+    def test_admin_form_reports_a_copy(self):
+        home, office = [resolve_address(
+            self.user, 'S', street, 'Flat 2', 'DHA', 'BD', '1000')
+            for street in ('1 Main St', '2 Office Rd')]
+        AddressForm = modelform_factory(Address, fields='__all__')
+        data = {'user': self.user.pk, 'address': ' 1 main st',
+                'secondary_addrs': 'Flat 2', 'division': 'DHA',
+                'country': 'BD', 'zip_code': '1000', 'address_type': 'S'}
+        form = AddressForm(data, instance=office)
+        self.assertFalse(form.is_valid())
+        self.assertIn('already has the same address',
+                      str(form.non_field_errors()))
+        # saving a row unchanged is not a copy of itself
+        self.assertTrue(AddressForm(data, instance=home).is_valid())
+        data['address_type'] = 'B'
+        self.assertTrue(AddressForm(data, instance=office).is_valid())
+
+    def test_dedupe_repoints_orders_before_deleting(self):
+        rows = [Address.objects.create(
+            user=self.user, address=f'{n} Main St', secondary_addrs='',
+            division='DHA', country='BD', zip_code='1000',
+            address_type='S', default=n == 2) for n in range(3)]
+        # rows edited with .update() kept the hash of their old content
+        Address.objects.filter(pk__in=[rows[1].pk, rows[2].pk]).update(
+            address='0 Main St')
+        Address.objects.filter(pk=rows[1].pk).update(content_hash='')
+        first, second = [Order.objects.create(
+            user=self.user, order_date=timezone.now(), ordered=True,
+            shipping_address=rows[n], billing_address=rows[n])
+            for n in (1, 2)]
+
+        out = StringIO()
+        call_command('dedupe_addresses', '--dry-run', stdout=out)
+        self.assertIn('Found 2 stale hashes, 2 duplicates', out.getvalue())
+        self.assertEqual(Address.objects.count(), 3)
+
+        call_command('dedupe_addresses', '--batch-size', '2', stdout=out)
+        self.assertIn('removed 2 duplicates', out.getvalue())
+        keep = Address.objects.get()
+        self.assertEqual(keep.pk, rows[0].pk)
+        self.assertTrue(keep.default)
+        for order in (first, second):
+            order.refresh_from_db()
+            self.assertEqual((order.shipping_address_id,
+                              order.billing_address_id), (keep.pk, keep.pk))
+
+    def test_dedupe_leaves_one_default_per_type(self):
+        home, office = [self.resolve(street)
+                        for street in ('1 Main St', '2 Office Rd')]
+        billing = self.resolve('1 Main St', address_type='B', default=True)
+        Address.objects.filter(address_type='S').update(default=True)
+
+        out = StringIO()
+        call_command('dedupe_addresses', stdout=out)
+        self.assertIn('cleared 1 extra defaults', out.getvalue())
+        self.assertEqual(
+            set(Address.objects.filter(default=True)), {home, billing})
+        self.assertEqual(get_default_address(self.user, 'S'), home)
+
+
+class RefundTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('buyer', password='secret')
+        self.orders = [Order.objects.create(
+            user=self.user, order_date=timezone.now(), ordered=True,
+            ref_code=f'ref{n}') for n in range(5)]
+        for order in self.orders:
+            request_refund(order.ref_code, 'buyer@example.com', 'Too small')
+        # a second request for the same order is still one order to grant
+        request_refund('ref0', 'buyer@example.com', 'Still too small')
+
+    def flags(self):
+        return {order.pk: (order.refund_requested, order.refund_granted)
+                for order in Order.objects.order_by('pk')}
+
+    def accepted(self):
+        return {pk: set(Refund.objects.filter(order_id=pk).values_list(
+            'accepted', flat=True)) for pk in self.flags()}
+
+    def test_order_and_refund_rows_flip_together(self):
+        self.assertEqual(set(self.flags().values()), {(True, False)})
+        granted = [self.orders[0].pk, self.orders[3].pk]
+        self.assertEqual(grant_refunds(granted, chunk_size=1), 2)
+        for pk, flags in self.flags().items():
+            done = pk in granted
+            self.assertEqual(flags, (not done, done))
+            self.assertEqual(self.accepted()[pk], {done})
+
+    def test_limit_pages_through_the_oldest_first(self):
+        out = StringIO()
+        call_command('process_refunds', '--limit', '3', '--chunk-size', '2',
+                     stdout=out)
+        self.assertIn('Granted refunds on 3 orders', out.getvalue())
+        done = [order.pk for order in self.orders[:3]]
+        self.assertEqual(
+            [pk for pk, (_, granted) in self.flags().items() if granted],
+            done)
+
+        call_command('process_refunds', '--dry-run', stdout=out)
+        self.assertIn('2 orders have pending refunds', out.getvalue())
+        self.assertEqual(grant_pending_refunds(chunk_size=2), 2)
+        self.assertFalse(Refund.objects.filter(accepted=False).exists())
+
+
+class QueryRecorder:
+    # an execute_wrapper that remembers each statement and where it came
+    # from: the innermost template node and the innermost project frame,
+    # or the innermost frame outside the ORM when no project code is involved
+
+    ignored = tuple(os.path.join(settings.BASE_DIR, name) for name in (
+        'manage.py', 'core/tests.py', 'core/timing.py', 'core/middleware.py'))
+    orm = os.path.join('django', 'db', '')
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries.append((sql, self.call_site(sys._getframe(1))))
+        return execute(sql, params, many, context)
+
+    def call_site(self, frame):
+        template = code = fallback = None
+        while frame is not None and (template is None or code is None):
+            # type(), not isinstance(): a lazy object would evaluate itself
+            # on __class__ and run a query from inside this wrapper
+            node = frame.f_locals.get('self')
+            if template is None and issubclass(type(node), Node) and \
+                    getattr(node, 'token', None) and node.origin:
+                template = '{}:{}'.format(
+                    os.path.relpath(node.origin.name, settings.BASE_DIR),
+                    node.token.lineno)
+            filename = os.path.abspath(frame.f_code.co_filename)
+            site = '{}:{} in {}'.format(
+                os.path.relpath(filename, settings.BASE_DIR)
+                if filename.startswith(settings.BASE_DIR) else filename,
+                frame.f_lineno, frame.f_code.co_name)
+            if filename not in self.ignored:
+                if fallback is None and self.orm not in filename:
+                    fallback = site
+                if code is None and filename.startswith(settings.BASE_DIR):
+                    code = site
+            frame = frame.f_back
+        return ' via '.join(
+            site for site in (template, code or fallback) if site)
+
+    def report(self):
+        sites = defaultdict(list)
+        for sql, site in self.queries:
+            sites[site].append(sql)
+        lines = []
+        for site, statements in sorted(sites.items(),
+                                       key=lambda s: -len(s[1])):
+            lines.append(f'{len(statements):>4}x {site or "unknown"}')
+            lines.append(f'       {statements[0][:200]}')
+        return '\n'.join(lines)
+
+
+# the manifest only exists after collectstatic
+@override_settings(
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class QueryBudgetTestCase(TestCase):
+    # every view gets a fixed number of queries, whatever the size of the
+    # cart or the catalog, and a wall-time ceiling
+    catalog_size = 10000
+    cart_sizes = (1, 10, 100)
+    max_seconds = 1.0
+
+    @classmethod
+    def setUpTestData(cls):
+        categories = ('S', 'SW', 'OW')
+        Item.objects.bulk_create([
+            Item(title=f'Item {n}', slug=f'item-{n}', price=10 + n % 50,
+                 discount_price=(5 + n % 40) if n % 3 == 0 else None,
+                 description=f'Cotton shirt number {n}',
+                 category=categories[n % 3], label='P',
+                 img=f'products/item-{n}.jpeg')
+            for n in range(cls.catalog_size)
+        ], batch_size=1000)
+        rebuild_index()
+        cls.items = list(Item.objects.order_by('pk')[:max(cls.cart_sizes)])
+        cls.item = cls.items[0]
+        cls.cupon = Cupon.objects.create(cupon='SAVE5', amount=5)
+
+        cls.shoppers = {}
+        for size in cls.cart_sizes:
+            user = User.objects.create_user(f'shopper{size}', password='secret')
+            merge_items(user, {item.pk: 2 for item in cls.items[:size]})
+            shipping, billing = [Address.objects.create(
+                user=user, address='1 Main St', secondary_addrs='',
+                division='DHA', country='BD', zip_code='1000',
+                address_type=address_type, default=True)
+                for address_type in ('S', 'B')]
+            Order.objects.filter(user=user, ordered=False).update(
+                shipping_address=shipping, billing_address=billing)
+            cls.shoppers[size] = user
+
+        buyer = User.objects.create_user('buyer', password='secret')
+        merge_items(buyer, {cls.item.pk: 1})
+        order = Order.objects.get(user=buyer, ordered=False)
+        finalize_order(order, buyer, 'ch_test', order.total)
+        cls.ref_code = Order.objects.get(pk=order.pk).ref_code
+
+        cls.staff = User.objects.create_superuser(
+            'staff', 'staff@example.com', 'secret')
+
+    def setUp(self):
+        # measure the cold path: nothing left in the catalog or cart caches,
+        # only the version keys, which are re-read once per cache timeout
+        cache.clear()
+        warm()
+        get_coupon_version()
+
+    @contextmanager
+    def budget(self, queries, seconds=None):
+        recorder = QueryRecorder()
+        start = time.perf_counter()
+        with connection.execute_wrapper(recorder):
+            yield
+        elapsed = time.perf_counter() - start
+        if len(recorder.queries) > queries:
+            self.fail(f'{len(recorder.queries)} queries, budget is {queries}'
+                      f'\n{recorder.report()}')
+        seconds = seconds or self.max_seconds
+        if elapsed > seconds:
+            self.fail(f'took {elapsed:.3f}s, ceiling is {seconds}s'
+                      f'\n{recorder.report()}')
+
+    def login(self, user):
+        self.client.force_login(user)
+        return user
+
+    def get(self, url, queries, status=200, **extra):
+        with self.budget(queries):
+            response = self.client.get(url, **extra)
+        self.assertEqual(response.status_code, status)
+        return response
+
+    def post(self, url, data, queries, status=302, **extra):
+        with self.budget(queries):
+            response = self.client.post(url, data, **extra)
+        self.assertEqual(response.status_code, status)
+        return response
+
+    def per_cart_size(self, url, queries, method='get', status=200, **kwargs):
+        for size, user in self.shoppers.items():
+            with self.subTest(cart=size):
+                self.login(user)
+                getattr(self, method)(url, queries=queries, status=status,
+                                      **kwargs)
+
+    def test_home(self):
+        self.get(reverse('core:home'), 5)
+
+    def test_product(self):
+        self.get(reverse('core:product', args=[self.item.slug]), 1)
+
+    def test_category_pages(self):
+        url = reverse('core:category-product', args=['S'])
+        response = self.get(url, 2)
+        after = response.context['next_cursor']
+        self.get(f'{url}?after={after}', 2)
+        self.get(f'{url}?format=json', 2)
+
+    def test_search(self):
+        self.get(reverse('core:search') + '?q=cotton', 2)
+
+    def test_autocomplete(self):
+        self.get(reverse('core:autocomplete') + '?q=item 12', 0)
+
+    def test_order_summary(self):
+        self.get(reverse('core:order-summary'), 0, status=302)
+        self.per_cart_size(reverse('core:order-summary'), 5)
+
+    def test_checkout(self):
+        self.per_cart_size(reverse('core:checkout'), 6)
+
+    def test_checkout_post(self):
+        self.per_cart_size(reverse('core:checkout'), 6, method='post', data={
+            'use_default_shipping': 'on', 'same_billing_address': 'on',
+            'shipping_division': 'DHA', 'shipping_zip': '1000',
+            'billing_division': 'DHA', 'billing_zip': '1000',
+            'payment_option': 'C'}, status=302)
+
+    def test_payment(self):
+        self.per_cart_size(reverse('core:payment', args=['credit']), 6)
+
+    def test_payment_post(self):
+        # the order lock and the job check that stop a double submit
+        self.per_cart_size(reverse('core:payment', args=['credit']), 9,
+                           method='post', data={'stripeToken': 'tok_visa'},
+                           status=302)
+
+    def test_add_cupon(self):
+        self.per_cart_size(reverse('core:add-cupon'), 5, method='post',
+                           data={'cupon': 'SAVE5'}, status=302)
+
+    def test_remove_cupon(self):
+        url = reverse('core:remove-cupon')
+        for order in Order.objects.filter(ordered=False):
+            order.set_cupon(self.cupon)
+        self.per_cart_size(url, 4, method='post', data={}, status=302)
+        self.assertFalse(Order.objects.filter(
+            ordered=False, cupon__isnull=False).exists())
+        # and again, with nothing left to remove
+        self.per_cart_size(url, 3, method='post', data={}, status=302)
+
+    def test_cart_mutations(self):
+        item = self.items[0]
+        self.per_cart_size(
+            reverse('core:add-to-cart', args=[item.slug]), 7, status=302)
+        self.per_cart_size(
+            reverse('core:remove-single-item-from-cart', args=[item.slug]),
+            6, status=302)
+        self.per_cart_size(
+            reverse('core:remove-from-cart', args=[item.slug]), 8,
+            status=302)
+
+    def test_cart_api(self):
+        body = json.dumps({'operations': [
+            {'slug': item.slug, 'delta': 1} for item in self.items[:20]]})
+        self.per_cart_size(reverse('core:cart-api'), 15, method='post',
+                           data=body, content_type='application/json',
+                           status=200)
+
+    def test_request_refund(self):
+        url = reverse('core:request-refund')
+        self.get(url, 0)
+        self.post(url, {'ref_code': self.ref_code, 'email': 'a@example.com',
+                        'message': 'Too small'}, 5)
+
+    def test_request_timings(self):
+        self.login(self.staff)
+        response = self.get(reverse('core:request-timings'), 2)
+        self.assertEqual(set(response.json()['catalog_cache']),
+                         {'hits', 'misses'})
+
+    def test_order_export(self):
+        # session, user, the orders and one prefetch of lines per chunk;
+        # the body streams after the view returns, so it's read in budget
+        self.login(self.staff)
+        url = reverse('core:order-export')
+        for format in ('csv', 'jsonl'):
+            with self.subTest(format=format), self.budget(4):
+                response = self.client.get(url, {'format': format})
+                body = b''.join(response.streaming_content).decode()
+            self.assertIn(self.ref_code, body)
+            self.assertIn(self.item.slug, body)
+        self.get(url + '?since=yesterday', 2, status=400)
+
+    def test_sales_dashboard(self):
+        refresh_rollups()
+        self.login(self.staff)
+        url = reverse('core:sales-dashboard')
+        response = self.get(url, 9)
+        self.assertContains(response, self.item.title)
+        self.get(url + '?since=2020-01-01&until=2020-12-31', 9)
+        self.get(url + '?since=yesterday', 2, status=400)
+
+
+class SalesRollupTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('buyer', password='secret')
+        self.shirt = Item.objects.create(
+            title='Shirt', slug='shirt', price=10, discount_price=7.5,
+            description='Cotton', category='S', label='P',
+            img='products/shirt.jpeg')
+        self.hoodie = Item.objects.create(
+            title='Hoodie', slug='hoodie', price=30, description='Fleece',
+            category='SW', label='P', img='products/hoodie.jpeg')
+        self.cupon = Cupon.objects.create(cupon='SAVE5', amount=5)
+        self.day = timezone.now().replace(hour=12, minute=0, second=0,
+                                          microsecond=0) - timedelta(days=3)
+
+    def place(self, lines, when, cupon=None):
+        # a placed order paid at `when`, built directly like finalize_order
+        subtotal = sum(item.get_price() * quantity for item, quantity in lines)
+        discount = cupon.amount if cupon else 0
+        payment = Payment.objects.create(
+            stripe_charge_id='ch_test', user=self.user,
+            amount=subtotal - discount)
+        Payment.objects.filter(pk=payment.pk).update(timestamp=when)
+        order = Order.objects.create(
+            user=self.user, ordered=True, order_date=when, payment=payment,
+            cupon=cupon, subtotal=subtotal, discount=discount,
+            total=subtotal - discount)
+        order.items.set([OrderItem.objects.create(
+            user=self.user, ordered=True, item=item, quantity=quantity,
+            unit_price=item.get_price())
+            for item, quantity in lines])
+        return order
+
+    def test_refresh_matches_orders(self):
+        self.place([(self.shirt, 2), (self.hoodie, 1)], self.day, self.cupon)
+        self.place([(self.shirt, 1)], self.day + timedelta(hours=1))
+        self.place([(self.hoodie, 2)], self.day + timedelta(days=1))
+        self.assertEqual(refresh_rollups(), 2)
+
+        day = timezone.localdate(self.day)
+        daily = DailySales.objects.get(day=day)
+        self.assertEqual((daily.orders, daily.subtotal, daily.discount,
+                          daily.total), (2, 52.5, 5, 47.5))
+        shirts = CategorySales.objects.get(day=day, category='S')
+        self.assertEqual((shirts.orders, shirts.units, shirts.revenue),
+                         (2, 3, 22.5))
+        hoodies = ItemSales.objects.get(day=day + timedelta(days=1),
+                                        item=self.hoodie)
+        self.assertEqual((hoodies.orders, hoodies.units, hoodies.revenue),
+                         (1, 2, 60))
+        coupon = CouponSales.objects.get()
+        self.assertEqual((coupon.day, coupon.orders, coupon.discount),
+                         (day, 1, 5))
+
+    def test_refresh_is_incremental(self):
+        self.place([(self.shirt, 1)], self.day)
+        refresh_rollups()
+        state = RollupState.objects.get(name=ROLLUP_NAME)
+        self.assertEqual(state.high_water, self.day)
+
+        # a payment that committed late on the same day, and a later one;
+        # days before the mark, like this marker row, are left alone
+        earlier = timezone.localdate(self.day) - timedelta(days=1)
+        DailySales.objects.create(day=earlier, orders=99)
+        self.place([(self.shirt, 1)], self.day - timedelta(minutes=5))
+        self.place([(self.hoodie, 1)], self.day + timedelta(days=1))
+        self.assertEqual(refresh_rollups(), 2)
+        self.assertEqual(DailySales.objects.get(day=earlier).orders, 99)
+        DailySales.objects.filter(day=earlier).delete()
+        self.assertEqual(
+            list(DailySales.objects.order_by('day').values_list(
+                'orders', flat=True)), [2, 1])
+
+        # nothing new: only the last day is read again, with the same result
+        self.assertEqual(refresh_rollups(), 1)
+        self.assertEqual(DailySales.objects.count(), 2)
+        self.assertEqual(ItemSales.objects.get(item=self.shirt).units, 2)
+
+    def test_price_change_keeps_history(self):
+        self.place([(self.shirt, 2), (self.hoodie, 1)], self.day)
+        refresh_rollups()
+        Item.objects.filter(pk=self.shirt.pk).update(discount_price=5)
+        refresh_rollups(full=True)
+
+        day = timezone.localdate(self.day)
+        self.assertEqual(ItemSales.objects.get(item=self.shirt).revenue, 15)
+        self.assertEqual(
+            CategorySales.objects.filter(day=day).aggregate(
+                revenue=Sum('revenue'))['revenue'],
+            DailySales.objects.get(day=day).subtotal)
+
+    def test_export_matches_rollups(self):
+        # half past midnight in Dhaka is the evening before in UTC, and the
+        # cart was started days before it was paid for
+        with timezone.override('Asia/Dhaka'):
+            day = timezone.localdate(self.day)
+            paid = day_start(day) + timedelta(minutes=30)
+            order = self.place([(self.shirt, 1)], paid)
+            Order.objects.filter(pk=order.pk).update(
+                order_date=paid - timedelta(days=5))
+            refresh_rollups()
+
+            def exported(day):
+                chunks = export_orders('jsonl', parse_day(day.isoformat()),
+                                       parse_day(day.isoformat(), end=True))
+                return ''.join(chunks).splitlines()
+
+            self.assertEqual(len(exported(day)),
+                             DailySales.objects.get(day=day).orders)
+            self.assertEqual(exported(day - timedelta(days=1)), [])
+
+
+class SearchTest(TestCase):
+
+    def setUp(self):
+        self.denim = Item.objects.create(
+            title='Blue denim shirt', slug='denim-shirt', price=10,
+            description='Cotton', category='S', label='P',
+            img='products/shirt.jpeg')
+        self.linen = Item.objects.create(
+            title='Linen shirt', slug='linen-shirt', price=10,
+            description='Looks like denim', category='S', label='P',
+            img='products/shirt.jpeg')
+
+    def found(self, query):
+        return [item.slug for item in search_items(query)['products']]
+
+    def test_title_matches_rank_first(self):
+        self.assertEqual(self.found('denim'), ['denim-shirt', 'linen-shirt'])
+        self.assertEqual(sorted(self.found('shirts')),
+                         ['denim-shirt', 'linen-shirt'])
+        self.assertEqual(self.found('wool'), [])
+
+    def test_item_changes_reach_the_index(self):
+        self.denim.title = 'Blue wool shirt'
+        self.denim.description = 'Wool'
+        self.denim.save()
+        self.assertEqual(self.found('wool'), ['denim-shirt'])
+        self.assertEqual(self.found('denim'), ['linen-shirt'])
+        self.linen.delete()
+        self.assertEqual(self.found('denim'), [])
+
+    def test_rebuild_keeps_results_and_drops_stale_rows(self):
+        with connection.cursor() as cursor:
+            get_backend().index(cursor, [(10 ** 6, 'Denim gone', '')])
+        seen = []
+        index = type(get_backend()).index
+
+        def index_and_search(backend, cursor, rows):
+            seen.append(self.found('denim'))
+            index(backend, cursor, rows)
+
+        with mock.patch.object(type(get_backend()), 'index',
+                               index_and_search):
+            self.assertEqual(rebuild_index(chunk_size=1), 2)
+        self.assertEqual(seen, [['denim-shirt', 'linen-shirt']] * 2)
+        with connection.cursor() as cursor:
+            self.assertEqual(get_backend().search(cursor, 'gone', 10, 0), [])
+
+
+class GenerateDataTest(TestCase):
+    options = {'items': 5, 'users': 3, 'orders': 40, 'coupons': 2,
+               'coupon_rate': 0.5, 'refund_rate': 0.5, 'seed': 7,
+               'prefix': 'test', 'no_index': True, 'stdout': StringIO()}
+
+    def generate(self, **options):
+        call_command('generate_data', **dict(self.options, **options))
+
+    def snapshot(self):
+        return {
+            'items': list(Item.objects.order_by('slug').values_list(
+                'slug', 'title', 'price', 'discount_price', 'category')),
+            'orders': list(Order.objects.order_by('ref_code').values_list(
+                'ref_code', 'user__username', 'start_date', 'total',
+                'cupon__cupon', 'refund_requested')),
+            'lines': list(OrderItem.objects.order_by(
+                'order__ref_code', 'item__slug').values_list(
+                'order__ref_code', 'item__slug', 'quantity', 'unit_price')),
+            'refunds': sorted(Refund.objects.values_list(
+                'order__ref_code', flat=True)),
+        }
+
+    def test_same_seed_same_rows(self):
+        try:
+            with transaction.atomic():
+                self.generate()
+                first = self.snapshot()
+                raise IntegrityError('roll back')
+        except IntegrityError:
+            pass
+        self.assertFalse(Item.objects.exists())
+        self.generate()
+        self.assertEqual(self.snapshot(), first)
+
+        self.assertEqual(Item.objects.count(), 5)
+        self.assertEqual(User.objects.count(), 3)
+        self.assertEqual(Address.objects.count(), 6)
+        self.assertEqual(Cupon.objects.count(), 2)
+        self.assertEqual(Order.objects.count(), 40)
+        self.assertEqual(Payment.objects.count(), 40)
+        # a Refund row for every request, and only for those
+        requested = Order.objects.filter(refund_requested=True)
+        self.assertTrue(requested.exists())
+        self.assertEqual(
+            set(Refund.objects.values_list('order', flat=True)),
+            set(requested.values_list('pk', flat=True)))
+        for order in Order.objects.all():
+            self.assertAlmostEqual(order.total, order.payment.amount)
+
+    def test_rejects_orders_without_items_or_users(self):
+        for options in ({'items': 0}, {'users': 0}, {'lines': 0},
+                        {'orders': -1}, {'refund_rate': 2}):
+            with self.subTest(**options), self.assertRaises(CommandError):
+                self.generate(**options)
+        self.assertFalse(Item.objects.exists())
+        self.generate(items=0, users=0, orders=0)
+        self.assertFalse(Order.objects.exists())
+
+
+class CategoryPageTest(TestCase):
+
+    def setUp(self):
+        self.items = [Item.objects.create(
+            title=f'Shirt {n}', slug=f'shirt-{n}', price=10,
+            description='Cotton', category='S', label='P',
+            img='products/shirt.jpeg') for n in range(3)]
+        cache.clear()
+        get_catalog_version()
+
+    def test_first_page_is_cached(self):
+        with self.assertNumQueries(1):
+            page = get_category_page('S', size=2)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_category_page('S', size=2), page)
+        self.assertEqual(page['next_cursor'], self.items[1].pk)
+        self.assertIsNone(page['prev_cursor'])
+
+    def test_cursor_pages_are_not_cached(self):
+        # any value a client sends would otherwise get its own entry
+        for _ in range(2):
+            with self.assertNumQueries(1):
+                page = get_category_page('S', after=self.items[1].pk, size=2)
+        self.assertEqual(page['products'], [self.items[0]])
+        self.assertEqual(page['prev_cursor'], self.items[0].pk)
+        with self.assertNumQueries(1):
+            page = get_category_page('S', before=self.items[0].pk, size=2)
+        self.assertEqual(page['products'], self.items[:0:-1])
+        self.assertIsNone(page['prev_cursor'])
+
+    def test_edits_show_once_committed(self):
+        page = get_category_page('S', size=2)
+        self.items[2].title = 'Linen shirt'
+        self.items[2].save()
+        # the version only moves once the save has committed
+        self.assertEqual(get_category_page('S', size=2), page)
+        with run_on_commit():
+            self.items[2].save()
+        self.assertEqual(get_category_page('S', size=2)['products'][0].title,
+                         'Linen shirt')
+
+
+class PrefixIndexTest(TestCase):
+
+    def setUp(self):
+        Item.objects.create(
+            title='Denim shirt', slug='denim-shirt', price=10,
+            description='Cotton', category='S', label='P',
+            img='products/shirt.jpeg')
+        cache.clear()
+        self.index = PrefixIndex()
+        self.index.refresh()
+
+    def test_expired_version_key_keeps_the_index(self):
+        cache.delete(CATALOG_VERSION_KEY)
+        with mock.patch.object(self.index, 'start_rebuild') as start, \
+                self.assertNumQueries(1):
+            for _ in range(3):
+                self.assertEqual(self.index.lookup('den'), [
+                    {'title': 'Denim shirt', 'slug': 'denim-shirt'}])
+        start.assert_not_called()
+
+    def test_gap_in_the_change_log_rebuilds_off_the_request(self):
+        # another process's bumps never reach a per-process change log
+        version = self.index.version + 10 ** 6
+        cache.set(CATALOG_VERSION_KEY, version)
+        with mock.patch.object(self.index, 'start_rebuild') as start, \
+                self.assertNumQueries(0):
+            for _ in range(3):
+                self.assertEqual(self.index.lookup('den'), [
+                    {'title': 'Denim shirt', 'slug': 'denim-shirt'}])
+        start.assert_called_once_with(version)
+
+    @mock.patch('core.autocomplete.connection')
+    def test_a_late_rebuild_never_sets_the_index_back(self, connection):
+        item = Item.objects.get()
+        item.title = 'Linen shirt'
+        item.save()
+        self.index.lookup('linen')
+        version = self.index.version
+        self.index.rebuild(version - 1)
+        self.assertEqual(self.index.version, version)
+        self.index.rebuild(version + 1)
+        self.assertEqual(self.index.version, version + 1)
+        self.assertEqual(self.index.lookup('linen'), [
+            {'title': 'Linen shirt', 'slug': 'denim-shirt'}])
+        connection.close.assert_called()
+
+    def test_logged_changes_apply_in_place(self):
+        item = Item.objects.get()
+        item.title = 'Linen shirt'
+        with run_on_commit():
+            item.save()
+        self.assertEqual(self.index.lookup('linen'), [
+            {'title': 'Linen shirt', 'slug': 'denim-shirt'}])
+        self.assertEqual(self.index.lookup('denim'), [])
+
+
+class CacheTimeoutTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    @override_settings(CACHE_SHARED=False, LOCAL_CACHE_TIMEOUT=30)
+    def test_local_cache_entries_age_out(self):
+        # version keys included, or a bump in another process never arrives
+        self.assertEqual(cache_timeout(None), 30)
+        self.assertEqual(cache_timeout(60 * 60), 30)
+        self.assertEqual(cache_timeout(10), 10)
+
+    @override_settings(CACHE_SHARED=True, LOCAL_CACHE_TIMEOUT=30)
+    def test_shared_cache_keeps_timeouts(self):
+        self.assertIsNone(cache_timeout(None))
+        self.assertEqual(cache_timeout(60 * 60), 60 * 60)
+
+    def test_expired_version_key_keeps_its_number(self):
+        version = get_version('test-version')
+        cache.delete('test-version')
+        self.assertEqual(get_version('test-version'), version)
+        self.assertEqual(bump_version('test-version'), version + 1)
+        cache.delete('test-version')
+        self.assertEqual(get_version('test-version'), version + 1)
+
+    def test_rolled_back_bumps_are_never_reused(self):
+        version = get_version('test-version')
+        try:
+            with transaction.atomic():
+                bump_version('test-version')
+                raise IntegrityError('roll back')
+        except IntegrityError:
+            pass
+        self.assertEqual(get_version('test-version'), version + 1)
+        self.assertEqual(bump_version('test-version'), version + 2)
+        cache.delete('test-version')
+        self.assertEqual(get_version('test-version'), version + 2)
@@ -0,0 +1,227 @@
+import bisect
+import contextvars
+import json
+import os
+import socket
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+
+
+# upper bounds of the histogram buckets; the last bucket is open ended
+TIME_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+METRICS = {
+    'view': TIME_BUCKETS,
+    'db': TIME_BUCKETS,
+    'template': TIME_BUCKETS,
+    'queries': QUERY_BUCKETS,
+}
+
+current = contextvars.ContextVar('request_timing', default=None)
+
+# {name: callable returning a dict of counts} added to every snapshot;
+# filled in by the modules that keep the counts (see CoreConfig.ready)
+counters = {}
+
+
+def register_counters(name, get_counts):
+    counters[name] = get_counts
+
+
+class RequestTiming:
+    __slots__ = ('queries', 'db', 'template', 'view')
+
+    def __init__(self):
+        self.queries = 0
+        self.db = 0.0
+        self.template = 0.0
+        self.view = 0.0
+
+
+def record_query(execute, sql, params, many, context):
+    # installed with connection.execute_wrapper() for the whole request
+    timing = current.get()
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        if timing is not None:
+            timing.queries += 1
+            timing.db += time.perf_counter() - start
+
+
+_template_render = None
+
+
+def install_template_timer():
+    # the django backend's Template.render is only entered for top-level
+    # renders; {% include %} and {% extends %} stay inside it
+    global _template_render
+    from django.template.backends.django import Template
+    if _template_render is not None:
+        return
+    _template_render = Template.render
+
+    def render(self, context=None, request=None):
+        timing = current.get()
+        if timing is None:
+            return _template_render(self, context, request)
+        start = time.perf_counter()
+        try:
+            return _template_render(self, context, request)
+        finally:
+            timing.template += time.perf_counter() - start
+
+    Template.render = render
+
+
+def new_route():
+    route = {'count': 0, 'queries_max': 0}
+    for metric, buckets in METRICS.items():
+        route[metric] = [0] * (len(buckets) + 1)
+        route[f'{metric}_sum'] = 0
+    return route
+
+
+def merge_route(into, route):
+    into['count'] += route['count']
+    into['queries_max'] = max(into['queries_max'], route['queries_max'])
+    for metric in METRICS:
+        into[metric] = [a + b for a, b in zip(into[metric], route[metric])]
+        into[f'{metric}_sum'] += route[f'{metric}_sum']
+    return into
+
+
+class TimingStore:
+    # per-process histograms in fixed time windows; only the most recent
+    # windows are kept, and each process snapshots them to its own file
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.windows = {}
+        self.flushed = 0
+
+    def add(self, name, timing):
+        window = int(time.time()) // settings.REQUEST_TIMING_WINDOW
+        values = {
+            'view': timing.view * 1000,
+            'db': timing.db * 1000,
+            'template': timing.template * 1000,
+            'queries': timing.queries,
+        }
+        with self.lock:
+            routes = self.windows.setdefault(window, {})
+            route = routes.get(name)
+            if route is None:
+                route = routes[name] = new_route()
+            route['count'] += 1
+            route['queries_max'] = max(route['queries_max'], timing.queries)
+            for metric, value in values.items():
+                route[metric][bisect.bisect_left(METRICS[metric], value)] += 1
+                route[f'{metric}_sum'] += value
+            for old in sorted(self.windows)[:-settings.REQUEST_TIMING_WINDOWS]:
+                del self.windows[old]
+
+    def maybe_flush(self):
+        now = time.monotonic()
+        if now - self.flushed < settings.REQUEST_TIMING_FLUSH:
+            return
+        self.flushed = now
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            snapshot = json.dumps({
+                'window': settings.REQUEST_TIMING_WINDOW,
+                'windows': self.windows,
+                'counters': {name: get_counts()
+                             for name, get_counts in counters.items()},
+            })
+        directory = settings.REQUEST_TIMING_DIR
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(
+            directory, f'{socket.gethostname()}-{os.getpid()}.json')
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(snapshot)
+        os.replace(tmp, path)
+
+
+store = TimingStore()
+
+
+def load_snapshots():
+    directory = settings.REQUEST_TIMING_DIR
+    if not os.path.isdir(directory):
+        return
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, filename)) as f:
+                yield json.load(f)
+        except (OSError, ValueError):
+            continue
+
+
+def load_timings(since=None):
+    # every process's snapshot, merged per route over the windows kept
+    since = since if since is not None else \
+        time.time() - settings.REQUEST_TIMING_WINDOW * \
+        settings.REQUEST_TIMING_WINDOWS
+    routes = {}
+    for snapshot in load_snapshots():
+        for window, window_routes in snapshot['windows'].items():
+            if (int(window) + 1) * snapshot['window'] < since:
+                continue
+            for name, route in window_routes.items():
+                merge_route(routes.setdefault(name, new_route()), route)
+    return routes
+
+
+def load_counters(name):
+    # one set of registered counts, summed over every process since it started
+    totals = Counter()
+    for snapshot in load_snapshots():
+        totals.update(snapshot.get('counters', {}).get(name, {}))
+    return dict(totals)
+
+
+def percentile(route, metric, q):
+    # upper bound of the bucket holding the q-th quantile
+    buckets = METRICS[metric]
+    target = q * route['count']
+    seen = 0
+    for bound, count in zip(buckets + (None,), route[metric]):
+        seen += count
+        if count and seen >= target:
+            return bound
+    return None
+
+
+def summarize(routes):
+    summary = []
+    for name, route in sorted(routes.items(),
+                              key=lambda r: -r[1]['view_sum']):
+        count = route['count'] or 1
+        summary.append({
+            'route': name,
+            'count': route['count'],
+            'view_avg': route['view_sum'] / count,
+            'view_p50': percentile(route, 'view', 0.5),
+            'view_p95': percentile(route, 'view', 0.95),
+            'view_p99': percentile(route, 'view', 0.99),
+            'db_avg': route['db_sum'] / count,
+            'template_avg': route['template_sum'] / count,
+            'queries_avg': route['queries_sum'] / count,
+            'queries_p95': percentile(route, 'queries', 0.95),
+            'queries_max': route['queries_max'],
+            'histograms': {metric: {
+                'buckets': list(METRICS[metric]) + [None],
+                'counts': route[metric],
+            } for metric in METRICS},
+        })
+    return summary
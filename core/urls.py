@@ -8,8 +8,15 @@ from .views import (HomeView,
                     remove_single_item_from_cart,
                     PaymentView,
                     AddCuponView,
+                    RemoveCuponView,
                     RequestRefundView,
-                    category_product_view
+                    category_product_view,
+                    search_view,
+                    autocomplete_view,
+                    cart_api_view,
+                    request_timings_view,
+                    order_export_view,
+                    sales_dashboard_view
                     )
 
 app_name = 'core'
@@ -21,11 +28,18 @@ urlpatterns = [
     path('product/<slug>/', ItemDetailView.as_view(), name='product'),
     path('category/<category>/',
          category_product_view, name='category-product'),
+    path('search/', search_view, name='search'),
+    path('autocomplete/', autocomplete_view, name='autocomplete'),
     path('add-to-cart/<slug>/', add_to_cart, name='add-to-cart'),
+    path('api/cart/', cart_api_view, name='cart-api'),
     path('add-cupon/', AddCuponView.as_view(), name='add-cupon'),
+    path('remove-cupon/', RemoveCuponView.as_view(), name='remove-cupon'),
     path('remove-from-cart/<slug>/', remove_from_cart, name='remove-from-cart'),
     path('remove-item-from-cart/<slug>/', remove_single_item_from_cart,
          name='remove-single-item-from-cart'),
     path('payment/<payment_option>/', PaymentView.as_view(), name='payment'),
     path('request-refund', RequestRefundView.as_view(), name='request-refund'),
+    path('staff/timings/', request_timings_view, name='request-timings'),
+    path('staff/orders/export/', order_export_view, name='order-export'),
+    path('staff/sales/', sales_dashboard_view, name='sales-dashboard'),
 ]
@@ -1,24 +1,36 @@
-from django.conf import settings
 from django.contrib import messages
 from django.core.exceptions import ObjectDoesNotExist
-from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.shortcuts import render, get_object_or_404, redirect
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import (JsonResponse, Http404, HttpResponseBadRequest,
+                         StreamingHttpResponse)
+from django.shortcuts import render, redirect, reverse
 from django.utils import timezone
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import require_POST
 from django.views.generic import ListView, DetailView, View
-from .models import Item, Order, OrderItem, Address, Payment, Cupon, Refund
+from .models import Item, Order
 from .forms import CheckoutForm, CuponForm, RefundForm
-
-import random
-import string
-import stripe
-stripe.api_key = settings.STRIPE_SECRET_KEY
-
-
-def create_ref_code():
-    return ''.join(random.choices(string.ascii_lowercase + string.digits, k=20))
-
-
+from .cart import (add_item, remove_item, remove_single_item, apply_changes,
+                   get_summary, SessionCart, CartLocked, CART_MAX_QUANTITY,
+                   cart_in_database, save_session_cart, forget_database_cart)
+from .catalog import get_home_listings, get_category_page, get_item, serialize_item
+from .search import search_items
+from .autocomplete import autocomplete, AUTOCOMPLETE_LIMIT
+from .conditional import catalog_condition, item_condition
+from .payments import enqueue_payment
+from .coupons import check_coupon, drop_invalid_coupon, CouponError
+from .refunds import request_refund
+from .timing import load_counters, load_timings, store, summarize
+from .exports import EXPORT_FORMATS, export_orders, parse_day
+from .rollups import parse_date, sales_report
+from .addresses import get_default_address, get_default_addresses, resolve_address
+
+import json
+from datetime import timedelta
+
+
+@method_decorator(catalog_condition, name='dispatch')
 class HomeView(ListView):
     # paginate_by = 10
     model = Item
@@ -32,34 +44,48 @@ class HomeView(ListView):
     def get_context_data(self, *args, **kwargs):
         # Call the base implementation first to get a context
         context = super().get_context_data(*args, **kwargs)
-        # Add in a QuerySet of all the books
-        context['items'] = Item.objects.all().order_by('-id')[:8]
-        context['shirts'] = Item.objects.filter(
-            category='S').order_by('-id')[:4]
-        context['outwears'] = Item.objects.filter(
-            category='OW').order_by('-id')[:4]
-        context['sportwears'] = Item.objects.filter(
-            category='SW').order_by('-id')[:4]
+        # the listings come from the versioned catalog cache
+        context.update(get_home_listings())
         return context
 
 
-class OrderSummaryView(LoginRequiredMixin, View):
+class OrderSummaryView(View):
     def get(self, *args, **kwargs):
-        try:
-            order = Order.objects.get(user=self.request.user, ordered=False)
-            context = {
-                'object': order
-            }
-            return render(self.request, 'order_summary.html', context)
-        except ObjectDoesNotExist:
+        if cart_in_database(self.request):
+            try:
+                order = Order.objects.select_related('cupon').get(
+                    user=self.request.user, ordered=False)
+                context = {
+                    'object': order,
+                    'order_items': order.items.select_related('item')
+                }
+                return render(self.request, 'order_summary.html', context)
+            except ObjectDoesNotExist:
+                forget_database_cart(self.request)
+
+        cart = SessionCart(self.request.session)
+        order_items = cart.get_order_items()
+        if not order_items:
             messages.warning(self.request, 'You do not have an active order.')
             return redirect('/')
+        context = {
+            'object': cart.as_order(order_items),
+            'order_items': order_items
+        }
+        return render(self.request, 'order_summary.html', context)
 
 
+@method_decorator(item_condition, name='dispatch')
 class ItemDetailView(DetailView):
     model = Item
     template_name = 'product.html'
 
+    def get_object(self, queryset=None):
+        item = get_item(self.kwargs['slug'])
+        if item is None:
+            raise Http404('No item found matching the query')
+        return item
+
 
 def is_valid_form(values):
     valid = True
@@ -69,8 +95,27 @@ def is_valid_form(values):
     return valid
 
 
+def parse_cursor(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+@catalog_condition
 def category_product_view(request, category):
-    products = Item.objects.filter(category=category).order_by('-id')
+    page = get_category_page(
+        category,
+        after=parse_cursor(request.GET.get('after')),
+        before=parse_cursor(request.GET.get('before'))
+    )
+
+    if request.GET.get('format') == 'json':
+        return JsonResponse({
+            'products': [serialize_item(item) for item in page['products']],
+            'next_cursor': page['next_cursor'],
+            'prev_cursor': page['prev_cursor'],
+        })
 
     if category == 'S':
         title = 'shirt'
@@ -82,12 +127,41 @@ def category_product_view(request, category):
         title = None
 
     context = {
-        'products': products,
+        'products': page['products'],
+        'next_cursor': page['next_cursor'],
+        'prev_cursor': page['prev_cursor'],
         'title': title
     }
     return render(request, 'category_product.html', context)
 
 
+def search_view(request):
+    query = request.GET.get('q', '').strip()
+    page = max(parse_cursor(request.GET.get('page')) or 1, 1)
+    results = search_items(query, page=page) if query else {
+        'products': [], 'has_next': False, 'has_previous': False}
+
+    context = {
+        'query': query,
+        'page': page,
+        'products': results['products'],
+        'has_next': results['has_next'],
+        'has_previous': results['has_previous'],
+    }
+    return render(request, 'search.html', context)
+
+
+def autocomplete_view(request):
+    try:
+        limit = min(int(request.GET.get('limit', AUTOCOMPLETE_LIMIT)), 20)
+    except ValueError:
+        limit = AUTOCOMPLETE_LIMIT
+    results = autocomplete(request.GET.get('q', ''), limit)
+    for result in results:
+        result['url'] = reverse('core:product', kwargs={'slug': result['slug']})
+    return JsonResponse({'results': results})
+
+
 # class CategoryProductView(View):
 #     def get(self, *args, **kwargs):
 #         products = Item.objects.filter(category='S').order_by('-id')
@@ -97,36 +171,39 @@ def category_product_view(request, category):
 #         return render(self.request, 'category_product.html', context)
 
 
-class CheckoutView(View):
+def warn_dropped_coupon(request, order):
+    coupon = drop_invalid_coupon(order)
+    if coupon is not None:
+        messages.warning(
+            request, f'The cupon {coupon.cupon} is no longer valid and was '
+            f'removed from your order.')
+
+
+class CheckoutView(LoginRequiredMixin, View):
+    def dispatch(self, request, *args, **kwargs):
+        # the cart reaches the database here, not with every click
+        if request.user.is_authenticated:
+            save_session_cart(request, request.user)
+        return super().dispatch(request, *args, **kwargs)
+
     def get(self, *args, **kwargs):
         try:
-            order = Order.objects.get(user=self.request.user, ordered=False)
+            order = Order.objects.select_related('cupon').get(
+                user=self.request.user, ordered=False)
+            warn_dropped_coupon(self.request, order)
             form = CheckoutForm()
             context = {
                 'form': form,
                 'order': order,
+                'order_items': order.items.select_related('item'),
                 'cuponform': CuponForm
             }
 
-            shipping_address_qs = Address.objects.filter(
-                user=self.request.user,
-                address_type='S',
-                default=True
-            )
-            if shipping_address_qs.exists():
-                context.update(
-                    {'default_shipping_address': shipping_address_qs[0]}
-                )
-
-            billing_address_qs = Address.objects.filter(
-                user=self.request.user,
-                address_type='B',
-                default=True
-            )
-            if billing_address_qs.exists():
-                context.update(
-                    {'default_billing_address': billing_address_qs[0]}
-                )
+            defaults = get_default_addresses(self.request.user)
+            if 'S' in defaults:
+                context['default_shipping_address'] = defaults['S']
+            if 'B' in defaults:
+                context['default_billing_address'] = defaults['B']
 
             return render(self.request, 'checkout.html', context)
 
@@ -138,157 +215,114 @@ class CheckoutView(View):
         form = CheckoutForm(self.request.POST or None)
         try:
             order = Order.objects.get(user=self.request.user, ordered=False)
-
-            if form.is_valid():
-                # shipping address
-                use_default_shipping = form.cleaned_data.get(
-                    'use_default_shipping')
-                if use_default_shipping:
-                    print('Using default shipping')
-                    address_qs = Address.objects.filter(
-                        user=self.request.user,
-                        address_type='S',
-                        default=True
-                    )
-                    if address_qs.exists():
-                        shipping_address = address_qs[0]
-                        order.shipping_address = shipping_address
-                        order.save()
-                    else:
-                        messages.info(
-                            self.request, 'No default shipping address')
-                        return redirect('core:checkout')
-                else:
-                    print('User is entering a new shipping address')
-                    shipping_address1 = form.cleaned_data.get(
-                        'shipping_address')
-                    shipping_address2 = form.cleaned_data.get(
-                        'shipping_address2')
-                    shipping_country = form.cleaned_data.get(
-                        'shipping_country')
-                    shipping_division = form.cleaned_data.get(
-                        'shipping_division')
-                    shipping_zip = form.cleaned_data.get('shipping_zip')
-
-                    if is_valid_form([shipping_address1, shipping_country, shipping_division, shipping_zip]):
-                        shipping_address = Address(
-                            user=self.request.user,
-                            address=shipping_address1,
-                            secondary_addrs=shipping_address2,
-                            division=shipping_division,
-                            country=shipping_country,
-                            zip_code=shipping_zip,
-                            address_type='S'
-                        )
-                        shipping_address.save()
-
-                        order.shipping_address = shipping_address
-                        order.save()
-
-                        # default shipping address
-                        set_default_shipping = form.cleaned_data.get(
-                            'set_default_shipping')
-                        if set_default_shipping:
-                            shipping_address.default = True
-                            shipping_address.save()
-
-                    else:
-                        messages.info(
-                            self.request, 'Please fill in the required shipping address fields')
-
-                # Billing address
-                use_default_billing = form.cleaned_data.get(
-                    'use_default_billing')
-                same_billing_address = form.cleaned_data.get(
-                    'same_billing_address')
-
-                if same_billing_address:
-                    billing_address = shipping_address
-                    billing_address.pk = None
-                    billing_address.save()
-                    billing_address.address_type = 'B'
-                    billing_address.save()
-                    order.billing_address = billing_address
-                    order.save()
-
-                elif use_default_shipping:
-                    print('Using default billing')
-                    address_qs = Address.objects.filter(
-                        user=self.request.user,
-                        address_type='B',
-                        default=True
-                    )
-                    if address_qs.exists():
-                        billing_address = address_qs[0]
-                        order.billing_address = billing_address
-                        order.save()
-                    else:
-                        messages.info(
-                            self.request, 'No default billing address')
-                        return redirect('core:checkout')
-                else:
-                    print('User is entering a new billing address')
-                    billing_address1 = form.cleaned_data.get(
-                        'billing_address')
-                    billing_address2 = form.cleaned_data.get(
-                        'billing_address2')
-                    billing_country = form.cleaned_data.get(
-                        'billing_country')
-                    billing_division = form.cleaned_data.get(
-                        'billing_division')
-                    billing_zip = form.cleaned_data.get('billing_zip')
-
-                    if is_valid_form([billing_address1, billing_country, billing_division, billing_zip]):
-                        billing_address = Address(
-                            user=self.request.user,
-                            address=billing_address1,
-                            secondary_addrs=billing_address2,
-                            division=billing_division,
-                            country=billing_country,
-                            zip_code=billing_zip,
-                            address_type='B'
-                        )
-                        billing_address.save()
-
-                        order.billing_address = billing_address
-                        order.save()
-
-                        # set default billing address
-                        set_default_billing = form.cleaned_data.get(
-                            'set_default_billing')
-                        if set_default_billing:
-                            billing_address.default = True
-                            billing_address.save()
-                    else:
-                        messages.info(
-                            self.request, 'Please fill in the required billing address fields')
-
-                # payment
-                payment_option = form.cleaned_data.get('payment_option')
-
-                if payment_option == 'C':
-                    return redirect('core:payment', payment_option='credit')
-                elif payment_option == 'P':
-                    return redirect('core:payment', payment_option='paypal')
-                else:
-                    messages.warning(
-                        self.request, 'Invalid Payment Option...!!!')
-                    return redirect('core:checkout')
-            else:
-                messages.warning(self.request, 'Form is not valid')
-                return redirect('core:checkout')
-
         except ObjectDoesNotExist:
             messages.warning(self.request, 'You do not have an active order.')
             return redirect('core:order-summary')
 
+        if not form.is_valid():
+            messages.warning(self.request, 'Form is not valid')
+            return redirect('core:checkout')
+        data = form.cleaned_data
+        changes = {}
+
+        # shipping address
+        shipping_address = None
+        if data.get('use_default_shipping'):
+            shipping_address = get_default_address(self.request.user, 'S')
+            if shipping_address is None:
+                messages.info(self.request, 'No default shipping address')
+                return redirect('core:checkout')
+        elif is_valid_form([data.get('shipping_address'),
+                            data.get('shipping_country'),
+                            data.get('shipping_division'),
+                            data.get('shipping_zip')]):
+            shipping_address = resolve_address(
+                self.request.user, 'S',
+                data.get('shipping_address'),
+                data.get('shipping_address2'),
+                data.get('shipping_division'),
+                data.get('shipping_country'),
+                data.get('shipping_zip'),
+                default=data.get('set_default_shipping')
+            )
+        else:
+            messages.info(
+                self.request, 'Please fill in the required shipping address fields')
+        if shipping_address:
+            changes['shipping_address'] = shipping_address
+
+        # billing address
+        billing_address = None
+        if data.get('same_billing_address'):
+            if shipping_address:
+                billing_address = resolve_address(
+                    self.request.user, 'B',
+                    shipping_address.address,
+                    shipping_address.secondary_addrs,
+                    shipping_address.division,
+                    shipping_address.country,
+                    shipping_address.zip_code
+                )
+        elif data.get('use_default_billing'):
+            billing_address = get_default_address(self.request.user, 'B')
+            if billing_address is None:
+                messages.info(self.request, 'No default billing address')
+                return redirect('core:checkout')
+        elif is_valid_form([data.get('billing_address'),
+                            data.get('billing_country'),
+                            data.get('billing_division'),
+                            data.get('billing_zip')]):
+            billing_address = resolve_address(
+                self.request.user, 'B',
+                data.get('billing_address'),
+                data.get('billing_address2'),
+                data.get('billing_division'),
+                data.get('billing_country'),
+                data.get('billing_zip'),
+                default=data.get('set_default_billing')
+            )
+        else:
+            messages.info(
+                self.request, 'Please fill in the required billing address fields')
+        if billing_address:
+            changes['billing_address'] = billing_address
+
+        # a single write for the order, whatever was resolved above
+        if changes:
+            Order.objects.filter(pk=order.pk).update(**changes)
+
+        # payment
+        payment_option = data.get('payment_option')
+        if payment_option == 'C':
+            return redirect('core:payment', payment_option='credit')
+        elif payment_option == 'P':
+            return redirect('core:payment', payment_option='paypal')
+        else:
+            messages.warning(self.request, 'Invalid Payment Option...!!!')
+            return redirect('core:checkout')
+
+
+PAYMENT_ERROR_SHOWN_KEY = 'payment-error-shown'
 
-class PaymentView(View):
+
+class PaymentView(LoginRequiredMixin, View):
     def get(self, *args, **kwargs):
-        order = Order.objects.get(user=self.request.user, ordered=False)
-        if order.billing_address:
+        order = Order.objects.select_related('cupon').get(
+            user=self.request.user, ordered=False)
+        warn_dropped_coupon(self.request, order)
+        job = order.paymentjob_set.order_by('-pk').first()
+        if job and job.status in ('P', 'R'):
+            messages.info(
+                self.request, 'Your last payment is still being processed.')
+        elif job and job.status == 'F' and \
+                self.request.session.get(PAYMENT_ERROR_SHOWN_KEY) != job.pk:
+            # said once, not on every visit until the next payment
+            self.request.session[PAYMENT_ERROR_SHOWN_KEY] = job.pk
+            messages.warning(self.request, job.error)
+        if order.billing_address_id:
             context = {
-                'order': order
+                'order': order,
+                'order_items': order.items.select_related('item')
             }
             return render(self.request, 'stripe.html', context)
         else:
@@ -297,177 +331,177 @@ class PaymentView(View):
             return redirect(('core:checkout'))
 
     def post(self, *args, **kwargs):
-        order = Order.objects.get(user=self.request.user, ordered=False)
-        token = self.request.POST.get('stripeToken')
-        amount = int(order.get_total() * 100)  # cents
-
-        try:
-            charge = stripe.Charge.create(
-                amount=amount,
-                currency="usd",
-                source=token
-            )
-
-            # create the payment
-            payment = Payment()
-            payment.stripe_charge_id = charge['id']
-            payment.user = self.request.user
-            payment.amount = order.get_total()
-            payment.save()
-
-            # assign the payment to order
-            order_items = order.items.all()
-            order_items.update(ordered=True)
-            for item in order_items:
-                item.save()
-
-            order.ordered = True
-            order.payment = payment
-            order.ref_code = create_ref_code()
-            order.save()
-
-            messages.success(self.request, 'Your order successfully placed.')
-            return redirect('/')
-
-        except stripe.error.CardError as e:
-            # Since it's a decline, stripe.error.CardError will be caught
-            messages.warning(self.request, f'{e.error.message}')
-            return redirect('/')
-
-        except stripe.error.RateLimitError as e:
-            # Too many requests made to the API too quickly
-            messages.warning(self.request, 'Rate limit error')
-            return redirect('/')
-
-        except stripe.error.InvalidRequestError as e:
-            # Invalid parameters were supplied to Stripe's API
-            messages.warning(self.request, 'Invalid parameters')
-            return redirect('/')
-
-        except stripe.error.AuthenticationError as e:
-            # Authentication with Stripe's API failed
-            # (maybe you changed API keys recently)
-            messages.warning(self.request, 'Not authenticated')
-            return redirect('/')
-
-        except stripe.error.APIConnectionError as e:
-            # Network communication with Stripe failed
-            messages.warning(self.request, 'Network error')
+        order = Order.objects.filter(
+            user=self.request.user, ordered=False).first()
+        # the stored subtotal is the sum of the lines, so an empty cart
+        # needs no query of its own
+        if order is None or order.subtotal <= 0:
+            messages.warning(self.request, 'You do not have an active order.')
             return redirect('/')
-
-        except stripe.error.StripeError as e:
-            # Display a very generic error to the user, and maybe send
-            # yourself an email
+        if not order.billing_address_id:
             messages.warning(
-                self.request, 'Something went wrong. You were not charged. Pleage try again.')
-            return redirect('/')
-
-        except Exception as e:
-            # send email to ourselves
+                self.request, 'You have not added a billing address')
+            return redirect('core:checkout')
+        if order.total <= 0:
             messages.warning(
-                self.request, 'A serious error occured. We have been notified.')
+                self.request, 'There is nothing to pay for this order.')
+            return redirect('core:checkout')
+        token = self.request.POST.get('stripeToken')
+
+        # the charge runs on the payment workers, not in this request
+        job, created = enqueue_payment(order, self.request.user, token)
+        if not created:
+            messages.info(
+                self.request, 'Your last payment is still being processed.')
             return redirect('/')
+        messages.info(
+            self.request, 'Your payment is being processed. Your order will '
+            'be placed as soon as it goes through.')
+        return redirect('/')
 
 
-@login_required
 def add_to_cart(request, slug):
-    item = get_object_or_404(Item, slug=slug)
-    order_item, created = OrderItem.objects.get_or_create(
-        item=item, user=request.user, ordered=False)
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if the order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item.quantity += 1
-            order_item.save()
-            messages.info(request, 'This item quantity was updated.')
-            return redirect('core:order-summary')
-        else:
-            order.items.add(order_item)
-            messages.info(request, 'This item was added to your cart.')
+    item = get_item(slug)
+    if item is None:
+        raise Http404('No item found matching the query')
+    created = None
+    if cart_in_database(request):
+        try:
+            created = add_item(request.user, item, create=False)
+        except CartLocked as e:
+            messages.warning(request, e.message)
             return redirect('core:order-summary')
-    else:
-        order_date = timezone.now()
-        order = Order.objects.create(
-            user=request.user, order_date=order_date)
-        order.items.add(order_item)
+        if created is None:
+            forget_database_cart(request)
+    if created is None:
+        created = SessionCart(request.session).add(item)
+    if created:
         messages.info(request, 'This item was added to your cart.')
-        return redirect('core:order-summary')
+    else:
+        messages.info(request, 'This item quantity was updated.')
+    return redirect('core:order-summary')
 
 
-@login_required
 def remove_from_cart(request, slug):
-    item = get_object_or_404(Item, slug=slug)
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if the order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item = OrderItem.objects.filter(
-                item=item, user=request.user, ordered=False)[0]
-            order.items.remove(order_item)
-            messages.info(request, 'This item was removed from your cart.')
+    item = get_item(slug)
+    if item is None:
+        raise Http404('No item found matching the query')
+    if cart_in_database(request):
+        try:
+            removed = remove_item(request.user, item)
+        except CartLocked as e:
+            messages.warning(request, e.message)
             return redirect('core:order-summary')
-        else:
-            messages.info(request, 'This item was not in your cart.')
-            return redirect('core:product', slug=slug)
     else:
-        # add a message saying the doesnt have an order
-        messages.info(request, 'You do not have an active order.')
+        removed = SessionCart(request.session).remove(item)
+    if removed:
+        messages.info(request, 'This item was removed from your cart.')
+        return redirect('core:order-summary')
+    else:
+        messages.info(request, 'This item was not in your cart.')
         return redirect('core:product', slug=slug)
 
 
-@login_required
 def remove_single_item_from_cart(request, slug):
-    item = get_object_or_404(Item, slug=slug)
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if the order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item = OrderItem.objects.filter(
-                item=item, user=request.user, ordered=False)[0]
-            if order_item.quantity > 1:
-                order_item.quantity -= 1
-                order_item.save()
-            else:
-                order.items.remove(order_item)
-            messages.info(request, 'This item quantity updated')
+    item = get_item(slug)
+    if item is None:
+        raise Http404('No item found matching the query')
+    if cart_in_database(request):
+        try:
+            removed = remove_single_item(request.user, item)
+        except CartLocked as e:
+            messages.warning(request, e.message)
             return redirect('core:order-summary')
-        else:
-            messages.info(request, 'This item was not in your cart.')
-            return redirect('core:product', slug=slug)
     else:
-        # add a message saying the doesnt have an order
-        messages.info(request, 'You do not have an active order.')
+        removed = SessionCart(request.session).remove_single(item)
+    if removed:
+        messages.info(request, 'This item quantity updated')
+        return redirect('core:order-summary')
+    else:
+        messages.info(request, 'This item was not in your cart.')
         return redirect('core:product', slug=slug)
 
 
-def get_cupon(request, cupon):
+CART_API_MAX_OPERATIONS = 50
+
+
+def parse_cart_operations(body):
+    operations = json.loads(body)['operations']
+    if not isinstance(operations, list) or \
+            len(operations) > CART_API_MAX_OPERATIONS:
+        raise ValueError('Invalid operations')
+    deltas = {}
+    for operation in operations:
+        slug, delta = operation['slug'], operation['delta']
+        # bool is an int subclass; true must not read as +1
+        if not isinstance(slug, str) or type(delta) is not int:
+            raise ValueError('Invalid operation')
+        deltas[slug] = deltas.get(slug, 0) + delta
+        if abs(deltas[slug]) > CART_MAX_QUANTITY:
+            raise ValueError('Invalid quantity')
+    return deltas
+
+
+@require_POST
+def cart_api_view(request):
     try:
-        cupon = Cupon.objects.get(cupon=cupon)
-        return cupon
-    except ObjectDoesNotExist:
-        messages.info(request, 'This Cupon does not exist')
-        return redirect('core:checkout')
+        deltas = parse_cart_operations(request.body)
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'error': 'Invalid cart operations'}, status=400)
+
+    items = Item.objects.in_bulk(list(deltas), field_name='slug')
+    missing = sorted(set(deltas) - set(items))
+    if missing:
+        return JsonResponse(
+            {'error': 'Unknown items', 'slugs': missing}, status=400)
+
+    deltas = {items[slug].pk: delta for slug, delta in deltas.items()}
+    if cart_in_database(request):
+        try:
+            applied = apply_changes(
+                request.user, {item.pk: item for item in items.values()},
+                deltas, create=False)
+        except CartLocked as e:
+            return JsonResponse({'error': e.message}, status=409)
+        if applied:
+            return JsonResponse(get_summary(request.user))
+        forget_database_cart(request)
 
+    cart = SessionCart(request.session)
+    cart.apply(deltas)
+    return JsonResponse(cart.summary())
 
-class AddCuponView(View):
+
+class AddCuponView(LoginRequiredMixin, View):
     def post(self, *args, **kwargs):
         form = CuponForm(self.request.POST or None)
         if form.is_valid():
             try:
-                cupon = form.cleaned_data.get('cupon')
+                cupon = check_coupon(form.cleaned_data.get('cupon'))
                 order = Order.objects.get(
                     user=self.request.user, ordered=False)
-                order.cupon = get_cupon(self.request, cupon)
-                order.save()
+                order.set_cupon(cupon)
                 messages.success(self.request, 'Successfully added cupon')
                 return redirect('core:checkout')
+            except CouponError as e:
+                messages.info(self.request, e.message)
+                return redirect('core:checkout')
             except ObjectDoesNotExist:
                 messages.info(self.request, 'You do not have an active order')
                 return redirect('core:checkout')
+        return redirect('core:checkout')
+
+
+class RemoveCuponView(LoginRequiredMixin, View):
+    def post(self, *args, **kwargs):
+        order = Order.objects.filter(
+            user=self.request.user, ordered=False).first()
+        if order is None or order.cupon_id is None:
+            messages.info(self.request, 'There is no cupon on your order')
+            return redirect('core:checkout')
+        order.set_cupon(None)
+        messages.success(self.request, 'Successfully removed cupon')
+        return redirect('core:checkout')
 
 
 class RequestRefundView(View):
@@ -484,22 +518,52 @@ class RequestRefundView(View):
             ref_code = form.cleaned_data.get('ref_code')
             email = form.cleaned_data.get('email')
             message = form.cleaned_data.get('message')
-            # edit the order
-            try:
-                order = Order.objects.get(ref_code=ref_code)
-                order.refund_requested = True
-                order.save()
-
-                # store the refund
-                refund = Refund()
-                refund.order = order
-                refund.reason = message
-                refund.email = email
-                refund.save()
-
-                messages.info(self.request, 'Your request was received')
-                return redirect('core:request-refund')
-
-            except ObjectDoesNotExist:
+            if request_refund(ref_code, email, message) is None:
                 messages.info(self.request, 'Order Does not exist')
                 return redirect('core:request-refund')
+            messages.info(self.request, 'Your request was received')
+            return redirect('core:request-refund')
+
+
+@staff_member_required
+def request_timings_view(request):
+    # this process's latest numbers first, then every process's snapshot
+    store.flush()
+    return JsonResponse({'routes': summarize(load_timings()),
+                         'catalog_cache': load_counters('catalog_cache')})
+
+
+EXPORT_CONTENT_TYPES = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+
+
+@staff_member_required
+def order_export_view(request):
+    # streamed chunk by chunk, so a year of orders never sits in memory
+    format = request.GET.get('format', 'csv')
+    if format not in EXPORT_FORMATS:
+        return HttpResponseBadRequest('format must be csv or jsonl')
+    try:
+        since = parse_day(request.GET.get('since'))
+        until = parse_day(request.GET.get('until'), end=True)
+    except ValueError:
+        return HttpResponseBadRequest('since and until must be YYYY-MM-DD')
+    response = StreamingHttpResponse(export_orders(format, since, until),
+                                     content_type=EXPORT_CONTENT_TYPES[format])
+    response['Content-Disposition'] = f'attachment; filename="orders.{format}"'
+    return response
+
+
+SALES_DASHBOARD_DAYS = 30
+
+
+@staff_member_required
+def sales_dashboard_view(request):
+    # only the rollup tables are read; refresh_rollups keeps them current
+    try:
+        last = parse_date(request.GET.get('until')) or timezone.localdate()
+        first = (parse_date(request.GET.get('since'))
+                 or last - timedelta(days=SALES_DASHBOARD_DAYS - 1))
+    except ValueError:
+        return HttpResponseBadRequest('since and until must be YYYY-MM-DD')
+    return render(request, 'sales_dashboard.html',
+                  {'report': sales_report(first, last)})
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/3.0/ref/settings/
 """
 
 import os
+import tempfile
 import django_heroku
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -50,6 +51,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.middleware.RequestTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -94,6 +96,10 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'TEST': {
+            # file backed, so concurrent tests get SQLite's real locking
+            'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3'),
+        },
     }
 }
 
@@ -140,6 +146,34 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# The catalog, item, cart-count, coupon and default-address caches are
+# invalidated by signals, which only reach the cache of the process they
+# fire in. Web workers, the admin and the process_payments worker must
+# therefore share one cache: set MEMCACHED_LOCATION to host:port (comma
+# separated for several servers) in production. Without it each process
+# gets its own LocMemCache and every timeout is capped at LOCAL_CACHE_TIMEOUT
+# seconds so stale entries age out. The version keys are a copy of their
+# CacheVersion row, so aging out re-reads the same number, not a new one.
+MEMCACHED_LOCATION = os.environ.get('MEMCACHED_LOCATION')
+CACHE_SHARED = bool(MEMCACHED_LOCATION)
+LOCAL_CACHE_TIMEOUT = int(os.environ.get('LOCAL_CACHE_TIMEOUT', 30))
+if CACHE_SHARED:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+            'LOCATION': MEMCACHED_LOCATION.split(','),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# processes that render the responsive image variants
+IMAGE_VARIANT_WORKERS = int(os.environ.get('IMAGE_VARIANT_WORKERS', 2))
+
 django_heroku.settings(locals())
 
 
@@ -152,5 +186,25 @@ LOGIN_REDIRECT_URL = '/'
 STRIPE_SECRET_KEY = 'sk_test_6HOfOh9sG7vDFK5ZfZFtSqmL00CyZeD8mI'
 STRIPE_PUBLIC_KEY = 'pk_test_QPTzT1QOtD4Vpwwu8RazUVtA00ZM6ynfmH'
 
+# payments are charged by `manage.py process_payments`, not in the request
+PAYMENT_GATEWAY = os.environ.get(
+    'PAYMENT_GATEWAY', 'core.payments.StripeGateway')
+PAYMENT_MAX_ATTEMPTS = 3
+FAKE_GATEWAY_LATENCY = float(os.environ.get('FAKE_GATEWAY_LATENCY', 0.5))
+FAKE_GATEWAY_FAILURE_RATE = float(
+    os.environ.get('FAKE_GATEWAY_FAILURE_RATE', 0))
+
 EMAIL_BACKEND = "django.core.mail.backends.filebased.EmailBackend"
 EMAIL_FILE_PATH = os.path.join(BASE_DIR, "sent_emails")
+
+# per-request query/template/view timings (core.middleware); the
+# Server-Timing header is only ever sent to staff
+SERVER_TIMING_HEADER = os.environ.get('SERVER_TIMING_HEADER', '1') == '1'
+REQUEST_TIMING_DIR = os.environ.get(
+    'REQUEST_TIMING_DIR',
+    os.path.join(tempfile.gettempdir(), 'djecommerce-timings'))
+REQUEST_TIMING_WINDOW = 10 * 60
+REQUEST_TIMING_WINDOWS = 6
+REQUEST_TIMING_FLUSH = 10
+# keeps the test suite's snapshots out of REQUEST_TIMING_DIR
+TEST_RUNNER = 'core.test_runner.TestRunner'
@@ -1,16 +1,19 @@
 from django.conf import settings
 from django.conf.urls.static import static
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, include, re_path
+from core.media import serve_media
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('accounts/', include('allauth.urls')),
+    # WhiteNoise only covers STATIC_ROOT; uploads are served here, with
+    # validators, ranges and sendfile through the server's file_wrapper
+    re_path(r'^%s(?P<path>.*)$' % settings.MEDIA_URL.lstrip('/'),
+            serve_media, name='media'),
     path('', include('core.urls', namespace='core'))
 ]
 
 if settings.DEBUG:
     urlpatterns += static(settings.STATIC_URL,
                           document_root=settings.STATIC_ROOT)
-    urlpatterns += static(settings.MEDIA_URL,
-                          document_root=settings.MEDIA_ROOT)
@@ -14,3 +14,12 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ecommerce.settings')
 
 application = get_wsgi_application()
+
+# build the in-memory autocomplete index before the worker takes traffic
+from django.db import DatabaseError  # noqa: E402
+from core.autocomplete import warm  # noqa: E402
+
+try:
+    warm()
+except DatabaseError:
+    pass